@@ -1 +1,37 @@
-from .android_backup import AndroidBackup, CompressionType, EncryptionType
+"""
+Unpack and repack android backups
+
+The classes are imported on first use, so the command line tools start
+quickly.
+"""
+import importlib
+
+# name -> module
+_EXPORTS = {
+    'AndroidBackup': 'android_backup',
+    'BackupError': 'android_backup',
+    'CompressionType': 'android_backup',
+    'EncryptionType': 'android_backup',
+    'KeyCache': 'keycache',
+    'MemberFilter': 'filters',
+    'ObjectStore': 'store',
+    'PasswordError': 'android_backup',
+    'Stats': 'stats',
+    'probe': 'probe',
+    'verify': 'verify',
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
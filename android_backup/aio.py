@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+asyncio interface for reading backups from non-blocking sources
+"""
+import asyncio
+
+from .android_backup import AndroidBackup
+
+
+class _AsyncSource:
+    """
+    Uniform read/readline over an asyncio.StreamReader (or any object with
+    coroutine read and readline methods) or an async iterator of bytes
+    """
+    def __init__(self, source):
+        self._reader = None
+        self._iterator = None
+        if hasattr(source, 'read') and hasattr(source, 'readline'):
+            self._reader = source
+        else:
+            self._iterator = source.__aiter__()
+        self._buffer = bytearray()
+        self._eof = False
+
+    async def _more(self):
+        """
+        Appends the next chunk of an async iterator to the buffer
+
+        :returns: False at the end of the data
+        """
+        if self._eof:
+            return False
+        try:
+            chunk = await self._iterator.__anext__()
+        except StopAsyncIteration:
+            self._eof = True
+            return False
+        self._buffer += chunk
+        return True
+
+    async def read(self, n):
+        if self._reader is not None:
+            return await self._reader.read(n)
+        if not self._buffer:
+            await self._more()
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    async def readline(self):
+        if self._reader is not None:
+            return await self._reader.readline()
+        while b'\n' not in self._buffer and await self._more():
+            pass
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        data = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        return data
+
+
+class _BlockingReader:
+    """
+    Blocking, non-seekable file object for executor threads, reading from
+    an _AsyncSource on the event loop
+    """
+    def __init__(self, source, loop):
+        self.source = source
+        self.loop = loop
+        # set by cancel(), makes waiting and further reads fail
+        self.cancelled = False
+        self._cancel_event = asyncio.Event()
+
+    async def _race(self, coro):
+        """
+        Awaits coro unless the reader is cancelled first
+        """
+        read = asyncio.ensure_future(coro)
+        cancelled = asyncio.ensure_future(self._cancel_event.wait())
+        try:
+            await asyncio.wait([read, cancelled], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            cancelled.cancel()
+            if not read.done():
+                read.cancel()
+        if read.cancelled():
+            raise IOError("Reading the backup was cancelled")
+        return read.result()
+
+    def _call(self, func, *args):
+        if self.cancelled:
+            raise IOError("Reading the backup was cancelled")
+        return asyncio.run_coroutine_threadsafe(
+            self._race(func(*args)), self.loop).result()
+
+    def cancel(self):
+        """
+        Makes the current and all further reads fail (on the event loop)
+        """
+        self.cancelled = True
+        self._cancel_event.set()
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            return b''.join(iter(lambda: self.read(1024 * 1024), b''))
+        return self._call(self.source.read, n)
+
+    def readline(self):
+        return self._call(self.source.readline)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        # the source belongs to the caller
+        pass
+
+
+class MemberData:
+    """
+    Async iterator over the data chunks of a member, as they are decoded
+    """
+    def __init__(self, backup):
+        self._backup = backup
+        self.done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.done:
+            raise StopAsyncIteration
+        kind, value = await self._backup._get()
+        if kind == 'data':
+            return value
+        self.done = True
+        raise StopAsyncIteration
+
+    async def read(self):
+        """
+        :returns: the (remaining) data of the member
+        """
+        return b''.join([chunk async for chunk in self])
+
+
+class AsyncBackup:
+    """
+    Reads a backup from an asyncio.StreamReader or an async iterator of
+    bytes without blocking the event loop. Parsing, key derivation,
+    decryption and inflating run in an executor thread, members and their
+    data are handed over as they are decoded.
+
+    The data of a member has to be read before the next member is
+    requested, otherwise it is skipped.
+
+    >>> reader, writer = await asyncio.open_connection(host, port)
+    >>> async with AsyncBackup(reader, password='secret') as ab:
+    >>>   async for member, data in ab.members():
+    >>>     async for chunk in data:
+    >>>       client.write(chunk)
+    """
+    def __init__(self, source, password=None, executor=None, chunk_size=64 * 1024,
+                 depth=16, **kwargs):
+        """
+        :param source: an asyncio.StreamReader or an async iterator of bytes
+        :param password: optional password for decrypting the backup
+        :param executor: the concurrent.futures.Executor running the
+                         blocking work (default: the loop's default executor)
+        :param chunk_size: maximal size of the data chunks of members
+        :param depth: maximal number of chunks decoded ahead
+        :param kwargs: further arguments of AndroidBackup (e.g. key_cache, stats)
+        """
+        self.source = _AsyncSource(source)
+        self.password = password
+        self.executor = executor
+        self.chunk_size = chunk_size
+        self.depth = depth
+        self.kwargs = kwargs
+        self.backup = None
+        self._loop = None
+        self._reader = None
+        self._queue = None
+        self._producer = None
+        self._closed = False
+        self._current = None
+
+    @property
+    def version(self):
+        return self.backup.version
+
+    @property
+    def compression(self):
+        return self.backup.compression
+
+    @property
+    def encryption(self):
+        return self.backup.encryption
+
+    async def parse(self):
+        """
+        Parses the backup header (done by `async with`)
+        """
+        self._loop = asyncio.get_running_loop()
+        self._reader = _BlockingReader(self.source, self._loop)
+        self.backup = AndroidBackup(self._reader, password=self.password, **self.kwargs)
+        await self._loop.run_in_executor(self.executor, self.backup.parse)
+
+    def _put(self, item):
+        """
+        Hands an item over to the event loop, waits while the queue is full
+
+        :returns: False if the backup was closed
+        """
+        if self._closed:
+            return False
+        asyncio.run_coroutine_threadsafe(self._queue.put(item), self._loop).result()
+        return not self._closed
+
+    def _produce(self):
+        """
+        Reads the tar stream (in the executor)
+        """
+        try:
+            for member, data in self.backup.iter_members():
+                if not self._put(('member', member)):
+                    return
+                if data is not None:
+                    for chunk in iter(lambda: data.read(self.chunk_size), b''):
+                        if not self._put(('data', chunk)):
+                            return
+                if not self._put(('end', None)):
+                    return
+            self._put(('eof', None))
+        except Exception as e:
+            self._put(('error', e))
+
+    async def _get(self):
+        kind, value = await self._queue.get()
+        if kind == 'error':
+            raise value
+        return kind, value
+
+    async def members(self):
+        """
+        Yields (tarfile.TarInfo, MemberData) for each member
+        """
+        assert self._producer is None, "members() can only be iterated once"
+        if self.backup is None:
+            await self.parse()
+        self._queue = asyncio.Queue(self.depth)
+        self._producer = self._loop.run_in_executor(self.executor, self._produce)
+
+        while True:
+            if self._current is not None:
+                # skip the unread data of the previous member
+                async for _ in self._current:
+                    pass
+            kind, member = await self._get()
+            if kind == 'eof':
+                break
+            self._current = MemberData(self)
+            yield member, self._current
+
+    async def close(self):
+        """
+        Stops decoding (the source is not closed)
+        """
+        self._closed = True
+        if self._reader is not None:
+            # before unblocking the producer, so it can not start another read
+            self._reader.cancel()
+        if self._producer is not None:
+            # unblock the producer
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            try:
+                await self._producer
+            finally:
+                self._producer = None
+        if self.backup is not None:
+            self.backup.close()
+
+    async def __aenter__(self):
+        await self.parse()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
@@ -5,18 +5,144 @@ import tarfile
 import zlib
 import enum
 import io
-import pickle
 import os
-import getpass
 import binascii
-import sys
+import contextlib
+import errno
+import threading
 
-try:
-    from Crypto.Cipher import AES
-    from Crypto.Protocol.KDF import PBKDF2
-    from Crypto import Random
-except ImportError:
-    AES = None
+from . import crypto
+
+
+def _load_crypto():
+    """
+    Loads the crypto backend (see crypto.select), the libraries take
+    longer to import than everything else
+
+    :raises ImportError: if neither pycryptodome nor cryptography is installed
+    """
+    return crypto.backend()
+
+
+def _aes_cbc(key, iv):
+    """
+    :returns: a new AES cipher in CBC mode
+    """
+    return _load_crypto().aes_cbc(key, iv)
+
+
+def _pbkdf2(password, salt, rounds):
+    """
+    :returns: the 256 bit PBKDF2-HMAC-SHA1 key of a password
+    """
+    return _load_crypto().pbkdf2(password, salt, rounds, 256 // 8)
+
+
+def _random_bytes(n):
+    return _load_crypto().random_bytes(n)
+
+
+def _copy_file_range(src, offset, dst, count):
+    return os.copy_file_range(src, dst, count, offset)
+
+
+def _sendfile(src, offset, dst, count):
+    return os.sendfile(dst, src, offset, count)
+
+
+def _pread_write(src, offset, dst, count):
+    return os.write(dst, os.pread(src, min(count, 1024 * 1024), offset))
+
+
+# copy functions tried in this order, ones the kernel lacks are removed
+# (the tuple is replaced, so concurrent _splice calls keep a consistent one)
+_SPLICE_FUNCS = tuple(func for func, name in ((_copy_file_range, 'copy_file_range'),
+                                              (_sendfile, 'sendfile'),
+                                              (_pread_write, 'pread'))
+                      if hasattr(os, name))
+_SPLICE_LOCK = threading.Lock()
+
+# errors signalling that a copy function does not support the files
+_SPLICE_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                  errno.ENOTSUP, errno.ETXTBSY, errno.EBADF)
+
+
+def _disable_splice(func):
+    """
+    Removes a copy function the kernel does not implement
+    """
+    global _SPLICE_FUNCS
+    with _SPLICE_LOCK:
+        if func in _SPLICE_FUNCS[:-1]:
+            _SPLICE_FUNCS = tuple(f for f in _SPLICE_FUNCS if f is not func)
+
+
+def _splice(src, offset, dst, count):
+    """
+    Copies count bytes at offset of the file descriptor src to the current
+    position of the file descriptor dst, in the kernel where possible
+    (copy_file_range, sendfile). The position of src is not changed.
+
+    If a copy function does not support the files, the next one is used for
+    the rest of this call only; it is removed for good only if the kernel
+    lacks it (ENOSYS).
+
+    :raises ValueError: if src ends before
+    """
+    funcs = _SPLICE_FUNCS
+    i = 0
+    while count:
+        func = funcs[i]
+        try:
+            n = func(src, offset, dst, count)
+        except OSError as e:
+            if e.errno not in _SPLICE_ERRORS or i == len(funcs) - 1:
+                raise
+            if e.errno == errno.ENOSYS:
+                _disable_splice(func)
+            i += 1
+            continue
+        if not n:
+            raise ValueError("Unexpected end of data at offset {}".format(offset))
+        offset += n
+        count -= n
+
+
+def _fileno(fp):
+    """
+    :returns: the file descriptor of a file object, None if it has none
+    """
+    try:
+        return fp.fileno()
+    except (AttributeError, io.UnsupportedOperation, ValueError):
+        return None
+
+
+# context manager of stages which are not measured
+_NOT_TIMED = contextlib.nullcontext()
+
+
+class BackupError(ValueError):
+    """
+    Raised for corrupt backup files
+    """
+
+
+class PasswordError(BackupError):
+    """
+    Raised if the master key cannot be decrypted with the password
+    """
+
+
+def _unpad(data):
+    """
+    :returns: data without its PKCS#7 padding
+    :raises BackupError: if the padding is invalid
+    """
+    pad = data[-1] if data else 0
+    if not 0 < pad <= 16 or not data.endswith(bytearray([pad] * pad)):
+        raise BackupError("Invalid padding {!r}".format(bytes(data[-16:])))
+    return data[:-pad]
 
 
 class CompressionType(enum.IntEnum):
@@ -32,56 +158,342 @@ class EncryptionType(enum.Enum):
 class Proxy:
     """
     Proxy class for applying a transformer function around each read call
+
+    Transformed data is kept in a single buffer together with the offset of
+    the first unread byte, so reads only copy the bytes they return instead
+    of re-slicing the remaining buffer each time.
     """
-    def __init__(self, transformer, source, chunk_size=4096):
+    def __init__(self, transformer, source, chunk_size=4096, flush=None):
+        """
+        :param transformer: called with each chunk read from source,
+                            returns the transformed data (may be empty)
+        :param source: the file-like object to read from
+        :param chunk_size: number of bytes to read from source at once
+        :param flush: optional function returning the remaining transformed
+                      data once source is exhausted
+        """
         self.transformer = transformer
         self.source = source
+        self.flush = flush
         self.pos = 0
         self._buffer = bytearray()
+        # offset of the first unread byte in _buffer
+        self._offset = 0
         self.chunk_size = chunk_size
 
-    def read(self, n=0):
-        data = self._buffer
-        if len(data) < n:
-            for chunk in iter(lambda: self.source.read(self.chunk_size), b''):
-                res = self.transformer(chunk)
-                if not res:
-                    break
-                data.extend(res)
-                if n and len(data) >= n:
-                    break
-            else:
-                pass
-                #raise IOError("No data after {} bytes, was expecting another {} bytes".format(self.pos, n - len(data)))
+    def _fill(self, n):
+        """
+        Transforms source chunks until at least n bytes are buffered
+        (or everything if n is negative)
 
-        if len(data) > n:
-            self._buffer = data[n:]
-            data = data[:n]
+        :returns: the number of buffered bytes
+        """
+        available = len(self._buffer) - self._offset
+        if 0 <= n <= available:
+            return available
+
+        # drop consumed data before appending (cheap for bytearrays)
+        del self._buffer[:self._offset]
+        self._offset = 0
+
+        for chunk in iter(lambda: self.source.read(self.chunk_size), b''):
+            self._buffer += self.transformer(chunk)
+            if 0 <= n <= len(self._buffer):
+                break
         else:
-            self._buffer = bytearray()
+            if self.flush is not None:
+                self._buffer += self.flush()
+                self.flush = None
+
+        return len(self._buffer)
+
+    def _consume(self, n):
+        """
+        Marks n buffered bytes as read
+        """
+        self._offset += n
+        self.pos += n
+        if self._offset == len(self._buffer):
+            del self._buffer[:]
+            self._offset = 0
+
+    def read(self, n=-1):
+        if n is None:
+            n = -1
+        available = self._fill(n)
+        if n < 0 or n > available:
+            n = available
+
+        with memoryview(self._buffer) as view:
+            data = view[self._offset:self._offset + n].tobytes()
+        self._consume(n)
+        return data
+
+    def readinto(self, b):
+        """
+        Reads up to len(b) bytes directly into the writable buffer b
+
+        :returns: the number of bytes read
+        """
+        with memoryview(b) as target:
+            target = target.cast('B')
+            n = min(target.nbytes, self._fill(target.nbytes))
+            with memoryview(self._buffer) as view:
+                target[:n] = view[self._offset:self._offset + n]
+        self._consume(n)
+        return n
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+
+class WriteProxy:
+    """
+    Proxy class for applying a transformer function around each write call
+    """
+    def __init__(self, transformer, sink, flush=None):
+        """
+        :param transformer: called with the data of each write call,
+                            returns the transformed data (may be empty)
+        :param sink: the file-like object to write the transformed data to
+        :param flush: optional function returning the remaining transformed
+                      data when the proxy is closed
+        """
+        self.transformer = transformer
+        self.sink = sink
+        self.flush = flush
+        self.pos = 0
 
+    def write(self, data):
+        res = self.transformer(data)
+        if res:
+            self.sink.write(res)
         self.pos += len(data)
-        return bytes(data)
+        return len(data)
+
+    def writable(self):
+        return True
 
     def tell(self):
         return self.pos
 
+    def close(self):
+        """
+        Writes the remaining data and closes chained proxies.
+        The underlying file object is left open.
+        """
+        if self.flush is not None:
+            self.sink.write(self.flush())
+            self.flush = None
+        if isinstance(self.sink, WriteProxy):
+            self.sink.close()
+
+
+class _BackupTarFile(tarfile.TarFile):
+    """
+    TarFile which closes its WriteProxy chain when closed.
+
+    If `splice` is set (uncompressed, unencrypted backups), the data of
+    regular files is passed to splice(fileobj, size) instead of being
+    copied through the chain.
+    """
+    splice = None
+
+    def addfile(self, tarinfo, fileobj=None):
+        if self.splice is None or fileobj is None or _fileno(fileobj) is None:
+            return tarfile.TarFile.addfile(self, tarinfo, fileobj)
+
+        tarfile.TarFile.addfile(self, tarinfo)
+        self.splice(fileobj, tarinfo.size)
+        blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+        if remainder > 0:
+            self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        self.offset += blocks * tarfile.BLOCKSIZE
+
+    def close(self):
+        closed = self.closed
+        tarfile.TarFile.close(self)
+        if not closed:
+            self.fileobj.close()
+
+
+class _OffsetFile:
+    """
+    Read-only file object starting at offset of another one
+    """
+    def __init__(self, fp, offset):
+        self.fp = fp
+        self.offset = offset
+        fp.seek(offset)
+
+    def read(self, n=-1):
+        return self.fp.read(n)
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            pos += self.offset
+        return self.fp.seek(pos, whence) - self.offset
+
+    def tell(self):
+        return self.fp.tell() - self.offset
+
+    def fileno(self):
+        return self.fp.fileno()
+
+
+class _SpliceTarFile(tarfile.TarFile):
+    """
+    TarFile reading an uncompressed tar from an _OffsetFile, which copies
+    the data of extracted files within the kernel instead of reading it
+    """
+    def makefile(self, tarinfo, targetpath):
+        if tarinfo.sparse is not None:
+            return tarfile.TarFile.makefile(self, tarinfo, targetpath)
+        with open(targetpath, 'wb') as target:
+            _splice(self.fileobj.fileno(), self.fileobj.offset + tarinfo.offset_data,
+                    target.fileno(), tarinfo.size)
+
+
+class _SyncFlushCompressor:
+    """
+    zlib compressor which ends the compressed data on a byte boundary
+    (sync flush) every `interval` input bytes. Inflating can be resumed at
+    those points, which is used by BackupIndex
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self._compressor = zlib.compressobj(method=zlib.DEFLATED)
+        # number of bytes since the last sync flush
+        self._pending = 0
+
+    def compress(self, data):
+        res = self._compressor.compress(data)
+        self._pending += len(data)
+        if self._pending >= self.interval:
+            res += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._pending = 0
+        return res
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class _CBCEncryptor:
+    """
+    Incremental AES-CBC encryption which appends the PKCS#7 padding at the end
+    """
+    def __init__(self, cipher):
+        self.cipher = cipher
+        self._pending = bytearray()
+
+    def encrypt(self, data):
+        pending = self._pending
+        pending += data
+        n = len(pending) // 16 * 16
+        if not n:
+            return b''
+        with memoryview(pending) as view:
+            data = self.cipher.encrypt(view[:n])
+        del pending[:n]
+        return data
+
+    def flush(self):
+        pad = 16 - len(self._pending)
+        data = self.cipher.encrypt(bytes(self._pending + bytearray([pad] * pad)))
+        self._pending = bytearray()
+        return data
+
+
+class _CBCDecryptor:
+    """
+    Incremental AES-CBC decryption which strips the PKCS#7 padding at the end
+
+    The last complete block is held back until more data arrives, so the
+    padding can be removed in flush() without knowing the length of the
+    encrypted data in advance.
+    """
+    def __init__(self, cipher):
+        self.cipher = cipher
+        self._pending = bytearray()
+
+    def decrypt(self, data):
+        pending = self._pending
+        pending += data
+        # keep the last block (and any incomplete one) for the next call
+        n = (len(pending) - 1) // 16 * 16
+        if n <= 0:
+            return b''
+        with memoryview(pending) as view:
+            data = self.cipher.decrypt(view[:n])
+        del pending[:n]
+        return data
+
+    def flush(self):
+        if len(self._pending) != 16:
+            raise BackupError("Encrypted data is not a multiple of the block size")
+        data = bytearray(self.cipher.decrypt(bytes(self._pending)))
+        self._pending = bytearray()
+        return _unpad(data)
+
+
+class _Inflater:
+    """
+    Incremental zlib decompression which checks that the stream is complete
+    (zlib checks the Adler-32 at its end)
+    """
+    def __init__(self):
+        self._decompressor = zlib.decompressobj()
+
+    def decompress(self, data):
+        try:
+            return self._decompressor.decompress(data)
+        except zlib.error as e:
+            raise BackupError("Corrupt compressed data ({})".format(e))
+
+    def flush(self):
+        data = self._decompressor.flush()
+        if not self._decompressor.eof:
+            raise BackupError("Compressed data is truncated")
+        return data
+
 
 class AndroidBackup:
     """
     Handles android backup files (.ab).
 
-    Supports compression and AES encryption (via pycrypto)
+    Supports compression and AES encryption (via pycryptodome or cryptography)
 
     >>> with AndroidBackup('backup.ab') as ab:
     >>>   ab.list()
     """
-    def __init__(self, fname=None, password=None, stream=True):
+    # number of uncompressed bytes between two sync flushes while packing
+    SYNC_FLUSH_INTERVAL = 16 * 1024 * 1024
+    # PBKDF2 rounds of encrypted backups (like Android)
+    ROUNDS = 10000
+
+    def __init__(self, fname=None, password=None, stream=True,
+                 chunk_size=1024 * 1024, threaded=False, key_cache=None,
+                 use_mmap=False, stats=None):
         """
         :param fname: The filename of the backup file or a file-like object
         :param password: The password to use for the en-/decryption
         :param stream: Open the backup file in stream mode. Reduces memory usage
                        but allows only sequential reads. Default: True 
+        :param chunk_size: Number of bytes decrypted at once in stream mode.
+                           Default: 1 MiB
+        :param threaded: Read, decrypt and decompress in background threads
+                         (stream mode only). Default: False
+        :param key_cache: Optional KeyCache for skipping the key derivation
+                          of previously opened backups
+        :param use_mmap: In non-stream mode, memory-map the backup file and
+                         decode it into a memory-mapped temporary file instead
+                         of memory. Default: False
+        :param stats: Optional Stats collecting the bytes and time per
+                      processing stage
         """
         self.fname = 'unknown'
         self.fp = None
@@ -89,9 +501,20 @@ class AndroidBackup:
         self.compression = None
         self.encryption = None
         self.stream = stream
+        self.chunk_size = chunk_size
+        self.threaded = threaded
+        self.key_cache = key_cache
+        self.use_mmap = use_mmap
+        self.stats = stats
+        # memory maps and temporary files used in mmap mode
+        self._maps = []
+        # the Pipeline used by the last read_data call in threaded mode
+        self.pipeline = None
         self.password = password
         # position of the actual file data (after the header)
         self.__data_start = 0
+        # BackupIndex used by open_member
+        self._index = None
 
         if isinstance(fname, str):
             self.open(fname)
@@ -108,11 +531,18 @@ class AndroidBackup:
         self.close()
         self.fp = open(fname, mode)
         self.fname = fname
+        self._index = None
 
     def close(self):
         """
         Closes the filedescriptor for a backup file
         """
+        if self.pipeline is not None:
+            self.pipeline.close()
+            self.pipeline = None
+        for obj in reversed(self._maps):
+            obj.close()
+        self._maps = []
         if self.fp is not None:
             self.fp.close()
 
@@ -121,19 +551,89 @@ class AndroidBackup:
         Returns True if the header indicates an encryption scheme
         """
         return self.encryption == EncryptionType.AES256
-    
+
+    @property
+    def data_start(self):
+        """
+        Position of the actual file data (after the header)
+        """
+        return self.__data_start
+
+    def _can_splice(self):
+        """
+        Internal function checking whether the tar data can be copied
+        straight from the backup file (uncompressed, unencrypted, seekable)
+        """
+        return (not self.is_encrypted() and self.compression == CompressionType.NONE
+                and _fileno(self.fp) is not None and self.fp.seekable())
+
+    def _splice_into(self, fp, data, size):
+        """
+        Internal function copying size bytes from the current position of
+        the file object data to fp within the kernel
+        """
+        fp.flush()
+        fd = fp.fileno()
+        with self._timed('write', size, size):
+            _splice(data.fileno(), data.tell(), fd, size)
+        # let fp know about the new position
+        fp.seek(os.lseek(fd, 0, os.SEEK_CUR))
+
+    def _timed(self, stage, bytes_in=0, bytes_out=0):
+        """
+        Internal function returning a context manager measuring a stage
+        (if stats are collected)
+        """
+        if self.stats is None:
+            return _NOT_TIMED
+        return self.stats.timed(stage, bytes_in, bytes_out)
+
+    def _wrap(self, stage, func):
+        """
+        Internal function wrapping a transformer or flush function for the stats
+        """
+        if self.stats is None or func is None:
+            return func
+        return self.stats.wrap(stage, func)
+
+    def _wrap_file(self, stage, fp):
+        """
+        Internal function wrapping a file object for the stats
+        """
+        if self.stats is None:
+            return fp
+        return self.stats.wrap_file(stage, fp)
+
+    def _iterate(self, stage, iterable):
+        """
+        Internal function measuring the iteration over iterable
+        """
+        if self.stats is None:
+            return iterable
+        return self.stats.iterate(stage, iterable)
+
+    def _seek(self, offset):
+        """
+        Seeks to the given offset. Non-seekable files (pipes, sockets)
+        are expected to be positioned there already
+        """
+        seekable = getattr(self.fp, 'seekable', None)
+        if seekable is None or seekable():
+            self.fp.seek(offset)
+
     def parse(self):
         """
         Parses a backup file header. Will be done automatically if
         used together with the 'with' statement
         """
-        self.fp.seek(0)
-        magic = self.fp.readline()
-        assert magic == b'ANDROID BACKUP\n'
-        self.version = int(self.fp.readline().strip())
-        self.compression = CompressionType(int(self.fp.readline().strip()))
-        self.encryption = EncryptionType(self.fp.readline().strip().decode())
-        self.__data_start = self.fp.tell()
+        self._seek(0)
+        lines = [self.fp.readline() for _ in range(4)]
+        if lines[0] != b'ANDROID BACKUP\n':
+            raise BackupError("Not an android backup")
+        self.version = int(lines[1].strip())
+        self.compression = CompressionType(int(lines[2].strip()))
+        self.encryption = EncryptionType(lines[3].strip().decode())
+        self.__data_start = sum(map(len, lines))
 
     def __str__(self):
         return '\n'.join([
@@ -142,19 +642,41 @@ class AndroidBackup:
             "Encryption: {}".format(self.encryption),
         ])
 
-    def _decrypt(self, fp, password=None):
+    def _read_encryption_header(self, fp):
         """
-        Internal decryption function
+        Internal function reading the PBKDF2 parameters and the encrypted
+        master key which precede the encrypted data
+
+        :param fp: a file object or similar which supports the readline method
+        :returns: (user salt, checksum salt, rounds, IV, encrypted master key,
+                   length of the encryption header)
+        """
+        lines = [fp.readline() for _ in range(5)]
+        # read the PBKDF2 parameters
+        # salt
+        user_salt = binascii.a2b_hex(lines[0].strip())
+        # checksum salt
+        ck_salt = binascii.a2b_hex(lines[1].strip())
+        # hashing rounds
+        rounds = int(lines[2].strip())
+        # encryption IV
+        iv = binascii.a2b_hex(lines[3].strip())
+        # encrypted master key
+        master_key = binascii.a2b_hex(lines[4].strip())
+        return user_salt, ck_salt, rounds, iv, master_key, sum(map(len, lines))
+
+    def _unlock(self, header, password=None):
+        """
+        Internal function decrypting the master key of an encrypted backup
 
         Uses either the password argument for the decryption,
         or, if not supplied, the password field of the object
 
-        :param fp: a file object or similar which supports the readline and read methods
-        :rtype: Proxy
+        :param header: the encryption header as returned by _read_encryption_header
+        :returns: (master key, master IV)
         """
-        if AES is None:
-            raise ImportError("PyCrypto required")
-        
+        _load_crypto()
+
         if password is None:
             password = self.password
 
@@ -162,78 +684,82 @@ class AndroidBackup:
             raise ValueError(
                 "Password need to be provided to extract encrypted archives")
 
-        # read the PBKDF2 parameters
-        # salt
-        user_salt = fp.readline().strip()
-        user_salt = binascii.a2b_hex(user_salt)
-        # checksum salt
-        ck_salt = fp.readline().strip()
-        ck_salt = binascii.a2b_hex(ck_salt)
-        # hashing rounds
-        rounds = fp.readline().strip()
-        rounds = int(rounds)
-        # encryption IV
-        iv = fp.readline().strip()
-        iv = binascii.a2b_hex(iv)
-        # encrypted master key
-        master_key = fp.readline().strip()
-        master_key = binascii.a2b_hex(master_key)
+        user_salt, ck_salt, rounds, iv, master_key = header[:5]
+
+        if self.key_cache is not None:
+            cached = self.key_cache.get(password, user_salt, rounds, master_key)
+            if cached is not None:
+                return cached
+        master_blob = master_key
 
         # generate key for decrypting the master key
-        user_key = PBKDF2(password, user_salt, dkLen=256 // 8, count=rounds)
+        with self._timed('key_derivation'):
+            user_key = _pbkdf2(password, user_salt, rounds)
         # decrypt the master key and iv
-        cipher = AES.new(user_key,
-                         mode=AES.MODE_CBC,
-                         IV=iv)
+        cipher = _aes_cbc(user_key, iv)
         master_key = bytearray(cipher.decrypt(master_key))
         # format: <len IV: 1 byte><IV: n bytes><len key: 1 byte><key: m bytes><len checksum: 1 byte><checksum: k bytes>
-        # get IV
-        l = master_key.pop(0)
-        master_iv = bytes(master_key[:l])
-        master_key = master_key[l:]
-        # get key
-        l = master_key.pop(0)
-        mk = bytes(master_key[:l])
-        master_key = master_key[l:]
-        # get checksum
-        l = master_key.pop(0)
-        master_ck = bytes(master_key[:l])
-
-        # double encode utf8
-        utf8mk = self.encode_utf8(mk)
+        try:
+            # get IV
+            l = master_key.pop(0)
+            master_iv = bytes(master_key[:l])
+            master_key = master_key[l:]
+            # get key
+            l = master_key.pop(0)
+            mk = bytes(master_key[:l])
+            master_key = master_key[l:]
+            # get checksum
+            l = master_key.pop(0)
+            master_ck = bytes(master_key[:l])
+            # double encode utf8
+            utf8mk = self.encode_utf8(mk)
+        except IndexError:
+            # garbage decrypted with a wrong password
+            raise PasswordError("Wrong password or corrupt master key")
         # calculate checksum by using PBKDF2
-        calc_ck = PBKDF2(utf8mk, ck_salt, dkLen=256//8, count=rounds)
-        assert calc_ck == master_ck
-        # install decryption key
-        cipher = AES.new(mk,
-                         mode=AES.MODE_CBC,
-                         IV=master_iv)
+        with self._timed('key_derivation'):
+            calc_ck = _pbkdf2(utf8mk, ck_salt, rounds)
+        if calc_ck != master_ck:
+            raise PasswordError("Wrong password or corrupt master key")
 
-        off = fp.tell()
-        fp.seek(0, 2)
-        length = fp.tell() - off
-        fp.seek(off)
+        if self.key_cache is not None:
+            self.key_cache.put(password, user_salt, rounds, master_blob, mk, master_iv)
+        return mk, master_iv
 
-        if self.stream:
-            # decryption transformer for Proxy class
-            def decrypt(data):
-                data = bytearray(cipher.decrypt(data))
+    def _cipher(self, fp, password=None):
+        """
+        Internal function reading the encryption header from fp and
+        returning the cipher for decrypting the data
+        """
+        header = self._read_encryption_header(fp)
+        mk, master_iv = self._unlock(header, password)
 
-                if fp.tell() - off >= length:
-                    # check padding (PKCS#7)
-                    pad = data[-1]
-                    assert data.endswith(bytearray([pad] * pad)), "Expected {!r} got {!r}".format(bytearray([pad] * pad), data[-pad:])
-                    data = data[:-pad]
+        # install decryption key
+        return _aes_cbc(mk, master_iv)
+
+    def _decrypt(self, fp, password=None):
+        """
+        Internal decryption function
 
-                return data
+        Uses either the password argument for the decryption,
+        or, if not supplied, the password field of the object
 
-            return Proxy(decrypt, fp, cipher.block_size)
+        :param fp: a file object or similar which supports the readline and read methods
+        :rtype: Proxy
+        """
+        cipher = self._cipher(fp, password)
+
+        if self.stream:
+            decryptor = _CBCDecryptor(cipher)
+            return Proxy(self._wrap('decrypt', decryptor.decrypt), fp, self.chunk_size,
+                         flush=self._wrap('decrypt', decryptor.flush))
         else:
-            data = bytearray(cipher.decrypt(fp.read()))
-            pad = data[-1]
-            assert data.endswith(bytearray([pad] * pad)), "Expected {!r} got {!r}".format(bytearray([pad] * pad), data[-pad:])
-            data = data[:-pad]
-            return io.BytesIO(data)
+            data = fp.read()
+            if len(data) % 16:
+                raise BackupError("Encrypted data is not a multiple of the block size")
+            with self._timed('decrypt', len(data), len(data)):
+                data = bytearray(cipher.decrypt(data))
+            return io.BytesIO(_unpad(data))
 
     @staticmethod
     def encode_utf8(mk):
@@ -242,31 +768,29 @@ class AndroidBackup:
 
         Tries to behave like the Java implementation
         """
-        utf8mk = mk.decode('raw_unicode_escape')
-        utf8mk = list(utf8mk)
-        to_char = chr
-        if sys.version_info[0] < 3:
-            to_char = unichr
+        # one char per byte (raw_unicode_escape would decode \uXXXX escapes)
+        utf8mk = list(mk.decode('latin-1'))
         for i in range(len(utf8mk)):
             c = ord(utf8mk[i])
             # fix java encoding (add 0xFF00 to non ascii chars)
             if 0x7f < c < 0x100:
                 c += 0xff00
-                utf8mk[i] = to_char(c)
+                utf8mk[i] = chr(c)
         return ''.join(utf8mk).encode('utf-8')
 
-    def _encrypt(self, dec, password=None):
+    def _encryptor(self, password=None, rounds=None):
         """
-        Internal encryption function
+        Internal function generating the encryption parameters
 
         Uses either the password argument for the encryption,
         or, if not supplied, the password field of the object
 
-        :param dec: a byte string representing the to be encrypted data
-        :rtype: bytes
+        :param rounds: the number of PBKDF2 rounds (default: ROUNDS)
+        :returns: the encryption header which precedes the encrypted data
+                  and the cipher for encrypting the data
+        :rtype: (bytes, cipher)
         """
-        if AES is None:
-            raise ImportError("PyCrypto required")
+        _load_crypto()
 
         if password is None:
             password = self.password
@@ -276,46 +800,65 @@ class AndroidBackup:
                 "Password need to be provided to create encrypted archives")
 
         # generate the different encryption parts (non-secure!)
-        master_key = Random.get_random_bytes(32)
-        master_salt = Random.get_random_bytes(64)
-        user_salt = Random.get_random_bytes(64)
-        master_iv = Random.get_random_bytes(16)
-        user_iv = Random.get_random_bytes(16)
-        rounds = 10000
-
-        # create the PKCS#7 padding
-        l = len(dec)
-        pad = 16 - (l % 16)
-        dec += bytes([pad] * pad)
+        master_key = _random_bytes(32)
+        master_iv = _random_bytes(16)
+        header = self._wrap_master_key(password, master_key, master_iv, rounds)
+
+        # cipher for the data
+        cipher = _aes_cbc(master_key, master_iv)
+        return header, cipher
+
+    def _wrap_master_key(self, password, master_key, master_iv, rounds=None):
+        """
+        Internal function encrypting the master key with a key derived
+        from the password (with new salts)
+
+        :param rounds: the number of PBKDF2 rounds (default: ROUNDS)
+        :returns: the encryption header which precedes the encrypted data
+        """
+        _load_crypto()
 
-        # encrypt the data
-        cipher = AES.new(master_key, IV=master_iv, mode=AES.MODE_CBC)
-        enc = cipher.encrypt(dec)
+        if rounds is None:
+            rounds = self.ROUNDS
+        master_salt = _random_bytes(64)
+        user_salt = _random_bytes(64)
+        user_iv = _random_bytes(16)
 
-        # generate the master key checksum
-        master_ck = PBKDF2(self.encode_utf8(master_key),
-                           master_salt, dkLen=256//8, count=rounds)
+        with self._timed('key_derivation'):
+            # generate the master key checksum
+            master_ck = _pbkdf2(self.encode_utf8(master_key), master_salt, rounds)
 
-        # generate the user key from the given password
-        user_key = PBKDF2(password,
-                          user_salt, dkLen=256//8, count=rounds)
+            # generate the user key from the given password
+            user_key = _pbkdf2(password, user_salt, rounds)
 
         # encrypt the master key and iv
         master_dec = b"\x10" + master_iv + b"\x20" + master_key + b"\x20" + master_ck
         l = len(master_dec)
         pad = 16 - (l % 16)
         master_dec += bytes([pad] * pad)
-        cipher = AES.new(user_key, IV=user_iv, mode=AES.MODE_CBC)
+        cipher = _aes_cbc(user_key, user_iv)
         master_enc = cipher.encrypt(master_dec)
 
-        # put everything together
-        enc = binascii.b2a_hex(user_salt).upper() + b"\n" + \
+        header = binascii.b2a_hex(user_salt).upper() + b"\n" + \
                 binascii.b2a_hex(master_salt).upper() + b"\n" + \
                 str(rounds).encode() + b"\n" + \
                 binascii.b2a_hex(user_iv).upper() + b"\n" + \
-                binascii.b2a_hex(master_enc).upper() + b"\n" + enc
+                binascii.b2a_hex(master_enc).upper() + b"\n"
+        return header
 
-        return enc
+    def _encrypt(self, dec, password=None):
+        """
+        Internal encryption function
+
+        Uses either the password argument for the encryption,
+        or, if not supplied, the password field of the object
+
+        :param dec: a byte string representing the to be encrypted data
+        :rtype: bytes
+        """
+        header, cipher = self._encryptor(password)
+        encryptor = _CBCEncryptor(cipher)
+        return header + encryptor.encrypt(dec) + encryptor.flush()
 
     def _decompress(self, fp):
         """
@@ -323,28 +866,128 @@ class AndroidBackup:
 
         :rtype: Proxy
         """
-        decompressor = zlib.decompressobj()
+        decompressor = _Inflater()
         if self.stream:
-            return Proxy(decompressor.decompress, fp)
+            return Proxy(self._wrap('inflate', decompressor.decompress), fp,
+                         flush=self._wrap('inflate', decompressor.flush))
         else:
-            out = io.BytesIO(decompressor.decompress(fp.read()))
-            out.write(decompressor.flush())
+            data = fp.read()
+            with self._timed('inflate', len(data)) as timer:
+                out = io.BytesIO(decompressor.decompress(data))
+                out.write(decompressor.flush())
+                if timer is not None:
+                    timer.bytes_out = out.tell()
             out.seek(0)
             return out
 
-    def read_data(self, password=None):
+    def _pipeline(self, fp, password=None):
         """
-        Helper function which decrypts and decompresses the data if necessary
-        and returns a tarfile.TarFile to interact with
+        Internal function returning a Pipeline which decrypts and
+        decompresses fp in background threads
         """
+        from .pipeline import Pipeline
+
+        stages = []
+        if self.is_encrypted():
+            decryptor = _CBCDecryptor(self._cipher(fp, password))
+            stages.append(('decrypt', decryptor.decrypt, decryptor.flush, None))
+
+        if self.compression == CompressionType.ZLIB:
+            decompressor = _Inflater()
+            # small inputs bound the output of highly compressed data
+            stages.append(('inflate', decompressor.decompress, decompressor.flush, 16 * 1024))
+
+        if self.pipeline is not None:
+            self.pipeline.close()
+        self.pipeline = Pipeline(fp, stages, self.chunk_size, stats=self.stats)
+        return self.pipeline
+
+    def _mmap_data(self, password=None):
+        """
+        Internal function returning the uncompressed tar data as memory map
+
+        The backup file is mapped if possible. Encrypted or compressed data
+        is decoded into a temporary file, which is mapped in turn, so the
+        tar data is paged by the OS instead of being held in memory.
+        """
+        import mmap
+        import shutil
+        import tempfile
+
         fp = self.fp
+        try:
+            fp = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps.append(fp)
+        except (AttributeError, io.UnsupportedOperation):
+            # not backed by a file
+            pass
         fp.seek(self.__data_start)
 
+        if not self.is_encrypted() and self.compression == CompressionType.NONE:
+            # the tar offsets are relative to the start position
+            return fp
+
         if self.is_encrypted():
-            fp = self._decrypt(fp, password=password)
+            decryptor = _CBCDecryptor(self._cipher(fp, password))
+            fp = Proxy(self._wrap('decrypt', decryptor.decrypt), fp, self.chunk_size,
+                       flush=self._wrap('decrypt', decryptor.flush))
 
         if self.compression == CompressionType.ZLIB:
-            fp = self._decompress(fp)
+            decompressor = _Inflater()
+            fp = Proxy(self._wrap('inflate', decompressor.decompress), fp,
+                       flush=self._wrap('inflate', decompressor.flush))
+
+        tmp = tempfile.TemporaryFile()
+        self._maps.append(tmp)
+        shutil.copyfileobj(fp, tmp, self.chunk_size)
+        tmp.flush()
+        if not tmp.tell():
+            return io.BytesIO()
+        data = mmap.mmap(tmp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(data)
+        return data
+
+    def open_data(self, password=None):
+        """
+        Returns a file object reading the decrypted and decompressed tar data
+        """
+        fp = self.fp
+        self._seek(self.__data_start)
+
+        if self.threaded and self.stream:
+            fp = self._pipeline(fp, password)
+        elif self.use_mmap and not self.stream:
+            fp = self._mmap_data(password)
+        else:
+            fp = self._wrap_file('read', fp)
+            if self.is_encrypted():
+                fp = self._decrypt(fp, password=password)
+
+            if self.compression == CompressionType.ZLIB:
+                fp = self._decompress(fp)
+        return fp
+
+    def read_data(self, password=None, tee=None):
+        """
+        Helper function which decrypts and decompresses the data if necessary
+        and returns a tarfile.TarFile to interact with
+
+        :param tee: optional file object receiving a copy of the uncompressed
+                    tar data (in stream mode as far as it is read)
+        """
+        fp = self.open_data(password)
+        if tee is not None:
+            if self.stream:
+                def copy(data):
+                    tee.write(data)
+                    return data
+                fp = Proxy(copy, fp, self.chunk_size)
+            else:
+                import shutil
+
+                start = fp.tell()
+                shutil.copyfileobj(fp, tee, self.chunk_size)
+                fp.seek(start)
 
         if self.stream:
             mode = 'r|*'
@@ -353,59 +996,302 @@ class AndroidBackup:
         tar = tarfile.open(fileobj=fp, mode=mode)
         return tar
 
-    def unpack(self, target_dir=None, password=None, pickle_fname=None):
+    def _write_header(self, fp, encryption=None):
+        """
+        Internal function writing the backup header
+
+        :param encryption: the EncryptionType (default: the one of the backup)
+        """
+        if encryption is None:
+            encryption = self.encryption
+        fp.write(b'ANDROID BACKUP\n')
+        fp.write('{}\n'.format(self.version).encode())
+        fp.write('{:d}\n'.format(self.compression).encode())
+        fp.write('{}\n'.format(encryption.value).encode())
+
+    def write_data(self, fp, password=None, workers=None):
+        """
+        Counterpart of read_data: writes the backup header to fp and returns a
+        tarfile.TarFile whose content is compressed and encrypted (if necessary)
+        on the fly. Closing the TarFile completes the backup, fp stays open.
+
+        The fields `version`, `compression` and `encryption` have to be set before calling
+        this method.
+
+        :param workers: number of threads compressing the data
+                        (default: compress in the calling thread)
+        """
+        assert self.version is not None, "Backup version is not set"
+        assert self.compression is not None, "Compression level is not set"
+        assert self.encryption is not None, "Encryption level is not set"
+
+        fp = self._wrap_file('write', fp)
+        self._write_header(fp)
+
+        out = fp
+        if self.is_encrypted():
+            # the encryption header has to precede the data
+            header, cipher = self._encryptor(password)
+            fp.write(header)
+            encryptor = _CBCEncryptor(cipher)
+            out = WriteProxy(self._wrap('encrypt', encryptor.encrypt), out,
+                             flush=self._wrap('encrypt', encryptor.flush))
+
+        if self.compression == CompressionType.ZLIB:
+            if workers:
+                from .compress import ParallelCompressor
+
+                compressor = ParallelCompressor(workers=workers)
+            else:
+                compressor = _SyncFlushCompressor(self.SYNC_FLUSH_INTERVAL)
+            out = WriteProxy(self._wrap('deflate', compressor.compress), out,
+                             flush=self._wrap('deflate', compressor.flush))
+
+        splice = None
+        if out is fp:
+            # the tar offsets have to start at 0
+            out = WriteProxy(lambda data: data, fp)
+            if _fileno(fp) is not None and fp.seekable():
+                # the data of files can be copied within the kernel
+                splice = lambda data, size: self._splice_into(fp, data, size)
+
+        tar = _BackupTarFile(fileobj=out, mode='w', format=tarfile.PAX_FORMAT)
+        tar.splice = splice
+        return tar
+
+    def unpack(self, target_dir=None, password=None, pickle_fname=None,
+               workers=None, max_inflight=64 * 1024 * 1024, manifest_fname=None,
+               tar_fname=None, member_filter=None, store=None):
         """
         High level function for unpacking a backup file into the given
         target directory (will be generated based on the filename if not given).
 
-        Creates also a filename.pickle file containing the exact order of the included files
+        Creates also a filename.manifest file containing the exact order of the included files
         (required for repacking).
 
         :param target_dir: the directory to extract the backup file into
                            (default: filename + _unpacked)
+        :param manifest_fname: the manifest to write (default: filename + .manifest)
+        :param pickle_fname: write the member list in the former pickle format
+                             to this file instead of a manifest
         :param password: optional password for decrypting the backup
                          (can also be set in the constructor)
+        :param workers: number of threads writing the extracted files
+                        (default: write them in the calling thread)
+        :param max_inflight: maximal number of bytes waiting for the writer
+                             threads
+        :param tar_fname: optional file to keep the uncompressed tar data in,
+                          speeds up repacking (see pack)
+        :param member_filter: optional MemberFilter selecting the members to
+                              extract (only those are listed in the manifest)
+        :param store: optional ObjectStore receiving the content of the
+                      files, which are created as links to it (workers are
+                      not used then)
+
+        Uncompressed, unencrypted backups are extracted without reading the
+        file data: it is copied from the backup file within the kernel
+        (unless tar_fname is given). The manifest of those has no digests,
+        so pack recognizes changed files by size and mtime only.
         """
 
+        from .manifest import DigestReader, ManifestWriter
+
         if target_dir is None:
            target_dir = os.path.basename(self.fname) + '_unpacked'
-        if pickle_fname is None:
-            pickle_fname = os.path.basename(self.fname) + '.pickle'
+        if manifest_fname is None and pickle_fname is None:
+            manifest_fname = os.path.basename(self.fname) + '.manifest'
         if not os.path.exists(target_dir):
             os.mkdir(target_dir)
 
-        tar = self.read_data(password)
-        members = tar.getmembers()
-
-        # reopen stream (TarFile is not able to seek)
-        tar = self.read_data(password)
+        tee = None
+        if tar_fname is not None:
+            tee = open(tar_fname, 'wb')
+        splice = tee is None and store is None and self._can_splice()
+        if splice:
+            tar = _SpliceTarFile(fileobj=_OffsetFile(self.fp, self.__data_start))
+        else:
+            tar = self.read_data(password, tee=tee)
+        members = []
+        manifest = None
+        if manifest_fname is not None:
+            manifest = ManifestWriter(manifest_fname)
+
+        selected = tar
+        if member_filter is not None:
+            selected = member_filter(tar)
+        selected = self._iterate('tar', selected)
+
+        def collect():
+            # extract each member as soon as its header was read and
+            # remember the order for repacking
+            for member in selected:
+                if store is not None and member.isreg():
+                    with self._timed('write', member.size, member.size):
+                        digest = store.extract(tar, member, target_dir)
+                    if manifest is None:
+                        members.append(member)
+                    else:
+                        manifest.write(member, sha256=digest)
+                    continue
+
+                if manifest is None:
+                    members.append(member)
+                    with self._timed('write', member.size, member.size):
+                        yield member
+                    continue
+
+                # hash the content while it is extracted
+                reader = None
+                if member.isreg() and not splice:
+                    reader = tar.fileobj = DigestReader(tar.fileobj)
+                with self._timed('write', member.size, member.size):
+                    yield member
+                digest = None
+                if reader is not None:
+                    tar.fileobj = reader.fileobj
+                    if reader.size == member.size:
+                        digest = reader.hexdigest()
+                manifest.write(member, sha256=digest)
+
+        try:
+            if workers and not splice and store is None:
+                from .extract import ParallelExtractor
+
+                extractor = ParallelExtractor(tar, target_dir, workers,
+                                              max_inflight=max_inflight)
+                extractor.extract(collect())
+            else:
+                tar.extractall(path=target_dir, members=collect())
 
-        tar.extractall(path=target_dir, members=members)
+            if manifest is None:
+                import pickle
 
-        with open(pickle_fname, 'wb') as fp:
-            pickle.dump(members, fp)
+                with open(pickle_fname, 'wb') as fp:
+                    pickle.dump(members, fp)
+        finally:
+            if manifest is not None:
+                manifest.close()
+            if tee is not None:
+                tee.close()
 
-    def list(self, password=None):
+    def list(self, password=None, member_filter=None):
         """
         Lists the content of the backup to stdout
+
+        :param member_filter: optional MemberFilter selecting the members to list
         """
         tar = self.read_data(password)
-        tar.list()
+        members = tar
+        if member_filter is not None:
+            members = member_filter(tar)
+        tar.list(members=self._iterate('tar', members))
 
-    def get_files(self, password=None):
+    def get_files(self, password=None, member_filter=None):
         """
         Returns the content of the backup file
+
+        :param member_filter: optional MemberFilter selecting the members to return
         """
         tar = self.read_data(password)
-        return tar.getmembers()
+        members = tar
+        if member_filter is not None:
+            members = member_filter(tar)
+        return list(self._iterate('tar', members))
 
-    def pack(self, fname, source_dir=None, password=None, pickle_fname=None):
+    def iter_members(self, password=None, member_filter=None):
+        """
+        Yields (tarfile.TarInfo, file object) for each member in archive
+        order, also in stream mode: the file object reads the content as it
+        is decoded, so large files are processed in constant memory. It is
+        None for members without content and is closed when the next member
+        is requested (unread content is skipped).
+
+        >>> for member, data in ab.iter_members():
+        >>>   if data is not None:
+        >>>     upload(member.name, data)
+
+        :param member_filter: optional MemberFilter selecting the members
+        """
+        tar = self.read_data(password)
+        members = tar
+        if member_filter is not None:
+            members = member_filter(tar)
+        for member in self._iterate('tar', members):
+            data = None
+            if member.isreg():
+                data = tar.extractfile(member)
+            try:
+                yield member, data
+            finally:
+                if data is not None:
+                    data.close()
+
+    def _index_fname(self, index_fname):
+        """
+        Internal function returning the index file, by default next to the
+        backup file
+
+        :raises ValueError: if no index file is given for a file object
+                            without a name
+        """
+        if index_fname is not None:
+            return index_fname
+        if not isinstance(getattr(self.fp, 'name', None), str):
+            raise ValueError("index_fname required for file objects without a name")
+        return self.fname + '.abidx'
+
+    def build_index(self, index_fname=None, password=None):
+        """
+        Indexes the members of the backup for random access (see open_member)
+        and stores the index in a sidecar file.
+
+        Requires a seekable backup file.
+
+        :param index_fname: the file to write the index to
+                            (default: filename + .abidx, required for
+                            file objects without a name)
+        :param password: optional password for decrypting the backup
+                         (can also be set in the constructor)
+        :rtype: BackupIndex
+        """
+        from .index import BackupIndex
+
+        index_fname = self._index_fname(index_fname)
+        self._index = BackupIndex.build(self, password)
+        self._index.save(index_fname)
+        return self._index
+
+    def open_member(self, name, password=None, index_fname=None):
+        """
+        Returns a file-like object for reading a single member without
+        decrypting and decompressing the backup up to it. Inflating
+        starts at the nearest checkpoint of the index, the index is built
+        first if the sidecar file does not exist yet.
+
+        :param index_fname: the index file (default: filename + .abidx,
+                            required for file objects without a name)
+        :param password: optional password for decrypting the backup
+                         (can also be set in the constructor)
+        """
+        if self._index is None:
+            from .index import BackupIndex
+
+            index_fname = self._index_fname(index_fname)
+            if os.path.exists(index_fname):
+                self._index = BackupIndex.load(index_fname, self, password)
+            else:
+                self.build_index(index_fname, password)
+        return self._index.open(name)
+
+    def pack(self, fname, source_dir=None, password=None, pickle_fname=None,
+             workers=None, manifest_fname=None, tar_fname=None):
         """
         High level function for repacking a backup file from the given
         target directory (will be generated based on the filename if not given).
 
-        Requires also a filename.pickle file which was generated during the unpacking
-        step.
+        Requires also a filename.manifest (or a former filename.pickle) file
+        which was generated during the unpacking step. Files changed since
+        unpacking get the new size and mtime.
 
         The fields `version`, `compression` and `encryption` have to be set before calling
         this method.
@@ -414,48 +1300,149 @@ class AndroidBackup:
                            (default: filename + _unpacked)
         :param password: optional password for decrypting the backup
                          (can also be set in the constructor)
+        :param workers: number of threads compressing the data
+                        (default: compress in the calling thread)
+        :param manifest_fname: the manifest (or pickle) listing the members
+                               (default: filename + .manifest, or
+                               filename + .pickle if only that exists)
+        :param pickle_fname: alias of manifest_fname
+        :param tar_fname: the tar data kept by unpack; unchanged members are
+                          copied from it instead of being read from
+                          source_dir
+        :returns: the names of the changed files
         """
+        from .manifest import iter_manifest, refresh
+
         if source_dir is None:
             source_dir = os.path.basename(fname) + '_unpacked'
-        if pickle_fname is None:
-            pickle_fname = os.path.basename(fname) + '.pickle'
+        if manifest_fname is None:
+            manifest_fname = pickle_fname
+        if manifest_fname is None:
+            manifest_fname = os.path.basename(fname) + '.manifest'
+            if not os.path.exists(manifest_fname):
+                manifest_fname = os.path.basename(fname) + '.pickle'
 
         assert self.version is not None, "Backup version is not set"
         assert self.compression is not None, "Compression level is not set"
         assert self.encryption is not None, "Encryption level is not set"
 
-        data = io.BytesIO()
-        tar = tarfile.TarFile(name=fname,
-                              fileobj=data,
-                              mode='w',
-                              format=tarfile.PAX_FORMAT)
-
-        with open(pickle_fname, 'rb') as fp:
-            members = pickle.load(fp)
+        changed = []
+        base = None
+        if tar_fname is not None:
+            base = self._wrap_file('read', open(tar_fname, 'rb'))
+        # range of unchanged members to be copied from base
+        start = end = 0
+        try:
+            with open(fname, 'wb') as fp:
+                tar = self.write_data(fp, password=password, workers=workers)
+                for member in iter_manifest(manifest_fname):
+                    path = os.path.join(source_dir, member.name)
+                    if member.isreg() and refresh(member, path):
+                        changed.append(member.name)
+                    elif base is not None:
+                        if member.offset != end:
+                            self._copy_range(base, tar, start, end)
+                            start = member.offset
+                        blocks = -(-member.size // tarfile.BLOCKSIZE)
+                        end = member.offset_data + blocks * tarfile.BLOCKSIZE
+                        continue
+
+                    self._copy_range(base, tar, start, end)
+                    start = end = 0
+                    with self._timed('tar'):
+                        if member.isreg():
+                            with open(path, 'rb') as data:
+                                tar.addfile(member, self._wrap_file('read', data))
+                        else:
+                            tar.addfile(member)
+                    # TarFile remembers all members, which is not needed for writing
+                    del tar.members[:]
+                self._copy_range(base, tar, start, end)
+                tar.close()
+        finally:
+            if base is not None:
+                base.close()
+        return changed
+
+    def _copy_range(self, base, tar, start, end):
+        """
+        Internal function copying the raw members between start and end
+        of the tar data base to tar
+        """
+        if start == end:
+            return
+        base.seek(start)
+        remaining = end - start
+        if tar.splice is not None:
+            tar.splice(base, remaining)
+            remaining = 0
+        while remaining:
+            data = base.read(min(self.chunk_size, remaining))
+            if not data:
+                raise ValueError("{} ends before offset {}".format(base.name, end))
+            tar.fileobj.write(data)
+            remaining -= len(data)
+        tar.offset += end - start
+
+    def rekey(self, fname, new_password, password=None, rounds=None):
+        """
+        Writes the encrypted backup with a new password to fname. Only the
+        master key is encrypted anew (with new salts), the encrypted data
+        is copied as is, within the kernel where possible.
+
+        :param new_password: the password of the new backup
+        :param password: the current password (can also be set in the
+                         constructor)
+        :param rounds: the number of PBKDF2 rounds (default: ROUNDS)
+        """
+        assert self.is_encrypted(), "Backup is not encrypted, use encrypt"
 
-        with open(fname, 'wb') as fp:
-            os.chdir(source_dir)
-            for member in members:
-                if member.isreg():
-                    tar.addfile(member, open(member.name, 'rb'))
-                else:
-                    tar.addfile(member)
+        self._seek(self.__data_start)
+        header = self._read_encryption_header(self.fp)
+        mk, master_iv = self._unlock(header, password)
+        with open(fname, 'wb') as out:
+            self._write_header(out)
+            out.write(self._wrap_master_key(new_password, mk, master_iv, rounds))
+            self._copy_body(out, self.__data_start + header[5])
 
-            tar.close()
+    def encrypt(self, fname, password=None, rounds=None):
+        """
+        Writes the unencrypted backup encrypted to fname. The (compressed)
+        data is encrypted as is, without inflating it.
 
-            data.seek(0)
-            if self.compression == CompressionType.ZLIB:
-                compressor = zlib.compressobj(method=zlib.DEFLATED)
-                data = compressor.compress(data.read()) + compressor.flush()
-            if self.is_encrypted():
-                data = self._encrypt(data, password=password)
-        
-            fp.write(b'ANDROID BACKUP\n')
-            fp.write('{}\n'.format(self.version).encode())
-            fp.write('{:d}\n'.format(self.compression).encode())
-            fp.write('{}\n'.format(self.encryption.value).encode())
-
-            fp.write(data)
+        :param password: the password of the new backup (can also be set
+                         in the constructor)
+        :param rounds: the number of PBKDF2 rounds (default: ROUNDS)
+        """
+        assert not self.is_encrypted(), "Backup is already encrypted, use rekey"
+
+        self._seek(self.__data_start)
+        with open(fname, 'wb') as out:
+            self._write_header(out, EncryptionType.AES256)
+            header, cipher = self._encryptor(password, rounds)
+            out.write(header)
+            encryptor = _CBCEncryptor(cipher)
+            fp = Proxy(self._wrap('encrypt', encryptor.encrypt), self._wrap_file('read', self.fp),
+                       self.chunk_size, flush=self._wrap('encrypt', encryptor.flush))
+            for data in iter(lambda: fp.read(self.chunk_size), b''):
+                out.write(data)
+
+    def _copy_body(self, out, start):
+        """
+        Internal function copying the backup file from start to its end to
+        the file object out
+        """
+        fd = _fileno(self.fp)
+        if fd is not None and self.fp.seekable():
+            size = os.fstat(fd).st_size - start
+            out.flush()
+            with self._timed('write', size, size):
+                _splice(fd, start, out.fileno(), size)
+            return
+        import shutil
+
+        shutil.copyfileobj(self._wrap_file('read', self.fp), self._wrap_file('write', out),
+                           self.chunk_size)
 
     def __exit__(self, *args, **kwargs):
         self.close()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Batch processing of many backups on a process pool
+
+    $ android-backup-batch -a unpack -o out --password-file passwords.json backups/
+"""
+import argparse
+import collections
+import concurrent.futures
+import fnmatch
+import json
+import os
+import sys
+import time
+
+from .android_backup import AndroidBackup
+from .manifest import iter_manifest
+from .store import ObjectStore
+from .verify import verify
+
+
+ACTIONS = ('list', 'unpack', 'verify')
+
+# estimated memory use of a process besides the buffers
+BASE_MEMORY = 32 * 1024 * 1024
+
+
+def find_backups(inputs):
+    """
+    :param inputs: backup files and directories (searched for *.ab files)
+    :returns: list of backup files
+    """
+    return [fname for fname, name in iter_backups(inputs)]
+
+
+def iter_backups(inputs):
+    """
+    :param inputs: backup files and directories (searched for *.ab files)
+    :returns: iterator of (backup file, output name), the output name is
+              the path relative to the searched directory (the basename
+              for files)
+    """
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.endswith('.ab'):
+                        fname = os.path.join(root, name)
+                        yield fname, os.path.relpath(fname, path)
+        else:
+            yield path, os.path.basename(path)
+
+
+class PasswordLookup:
+    """
+    Finds the password of a backup file: by its path or basename, by a
+    glob pattern matching the basename, or the default password.
+
+    >>> lookup = PasswordLookup({'phone-*.ab': 'secret', 'tablet.ab': 'other'})
+    """
+    def __init__(self, passwords=None, default=None):
+        """
+        :param passwords: dict of path, basename or glob pattern to password
+        :param default: the password of the other files
+        """
+        self.passwords = passwords or {}
+        self.default = default
+
+    @classmethod
+    def load(cls, fname, default=None):
+        """
+        Reads the passwords from a JSON object
+        """
+        with open(fname) as fp:
+            return cls(json.load(fp), default)
+
+    def __call__(self, fname):
+        name = os.path.basename(fname)
+        for key in (fname, name):
+            if key in self.passwords:
+                return self.passwords[key]
+        for pattern, password in self.passwords.items():
+            if fnmatch.fnmatch(name, pattern):
+                return password
+        return self.default
+
+
+def estimate_memory(fname, stream=True, chunk_size=1024 * 1024, workers=None,
+                    max_inflight=64 * 1024 * 1024):
+    """
+    Estimates the memory needed for processing a backup file
+
+    In stream mode a few chunks are buffered (plus the payloads waiting for
+    the writer threads), otherwise the decoded backup is held in memory,
+    assumed to be four times the file size.
+    """
+    if not stream:
+        return BASE_MEMORY + 4 * os.path.getsize(fname)
+    memory = BASE_MEMORY + 4 * chunk_size
+    if workers:
+        memory += max_inflight
+    return memory
+
+
+def process(fname, action, password=None, output_dir='.', stream=True,
+            chunk_size=1024 * 1024, workers=None, max_inflight=64 * 1024 * 1024,
+            store_dir=None, name=None):
+    """
+    Processes a single backup file (in a pool process)
+
+    :param store_dir: optional ObjectStore directory for unpacking
+    :param name: the output name of the backup, relative to output_dir
+                 (default: the basename)
+    :returns: dict with the file name, action, ok, error, members, bytes
+              and seconds (for verify also the error offsets, see verify)
+    """
+    start = time.time()
+    result = {'file': fname, 'action': action, 'ok': False, 'error': None,
+              'members': 0, 'bytes': 0}
+    if action == 'verify':
+        result.update(verify(fname, password, chunk_size))
+        return result
+    try:
+        with AndroidBackup(fname, password=password, stream=stream,
+                           chunk_size=chunk_size) as ab:
+            if action == 'unpack':
+                if name is None:
+                    name = os.path.basename(fname)
+                manifest_fname = os.path.join(output_dir, name + '.manifest')
+                os.makedirs(os.path.dirname(manifest_fname), exist_ok=True)
+                store = None
+                if store_dir is not None:
+                    store = ObjectStore(store_dir)
+                ab.unpack(target_dir=os.path.join(output_dir, name + '_unpacked'),
+                          manifest_fname=manifest_fname,
+                          workers=workers, max_inflight=max_inflight, store=store)
+                members = list(iter_manifest(manifest_fname))
+            else:
+                members = ab.get_files()
+        result['members'] = len(members)
+        result['bytes'] = sum(member.size for member in members)
+        result['ok'] = True
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    result['seconds'] = time.time() - start
+    return result
+
+
+def run_batch(inputs, action='list', password=None, processes=None,
+              memory_budget=None, output_dir='.', stream=True, chunk_size=1024 * 1024,
+              workers=None, max_inflight=64 * 1024 * 1024, callback=None,
+              store_dir=None):
+    """
+    Lists, unpacks or verifies many backups on a pool of processes
+
+    Jobs are started as long as their estimated memory (see estimate_memory)
+    fits into the memory budget, a job exceeding the budget runs alone.
+    Errors are reported per file.
+
+    :param inputs: backup files and directories
+    :param action: one of ACTIONS
+    :param password: the password of all files, or a callable(fname)
+                     returning it (e.g. a PasswordLookup)
+    :param processes: the number of processes (default: number of CPUs)
+    :param memory_budget: the memory (bytes) the running jobs may use
+                          together (default: no limit)
+    :param output_dir: the directory receiving the unpacked backups
+                       (<name>_unpacked and <name>.manifest, name is the
+                       path relative to the input directory); backups with
+                       the same name fail, except the first one
+    :param workers: number of writer threads per unpacking process
+    :param callback: called with each result as soon as it is available
+    :param store_dir: optional directory of an ObjectStore shared by the
+                      unpacked backups
+    :returns: the results (see process) in input order
+    :raises ValueError: if action is not one of ACTIONS
+    """
+    if action not in ACTIONS:
+        raise ValueError("Unknown action {}".format(action))
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if not callable(password):
+        password = PasswordLookup(default=password)
+
+    if action == 'unpack' and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    backups = list(iter_backups(inputs))
+    results = [None] * len(backups)
+    pending = collections.deque()
+    # output name -> backup file unpacked into it
+    owners = {}
+    for index, (fname, name) in enumerate(backups):
+        key = os.path.normcase(os.path.normpath(name))
+        if action == 'unpack' and key in owners:
+            results[index] = {'file': fname, 'action': action, 'ok': False,
+                              'error': 'Output {} is already used by {}'.format(
+                                  os.path.join(output_dir, name), owners[key]),
+                              'members': 0, 'bytes': 0, 'seconds': None}
+            if callback is not None:
+                callback(results[index])
+            continue
+        owners[key] = fname
+        pending.append((index, fname, name))
+    running = {}
+    used = 0
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        while pending or running:
+            # start the next jobs while they fit into the budget
+            while pending and len(running) < processes:
+                index, fname, name = pending[0]
+                try:
+                    memory = estimate_memory(fname, stream, chunk_size, workers, max_inflight)
+                except OSError:
+                    # reported by the job
+                    memory = BASE_MEMORY
+                if running and memory_budget is not None and used + memory > memory_budget:
+                    break
+                pending.popleft()
+                future = pool.submit(process, fname, action, password(fname), output_dir,
+                                     stream, chunk_size, workers, max_inflight, store_dir,
+                                     name)
+                running[future] = (index, fname, memory)
+                used += memory
+
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                index, fname, memory = running.pop(future)
+                used -= memory
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # e.g. the process was killed
+                    result = {'file': fname, 'action': action, 'ok': False,
+                              'error': '{}: {}'.format(type(e).__name__, e),
+                              'members': 0, 'bytes': 0, 'seconds': None}
+                results[index] = result
+                if callback is not None:
+                    callback(result)
+    return results
+
+
+def _parse_size(value):
+    """
+    Parses sizes like 512M or 2G
+    """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lists, unpacks or verifies many backups')
+    parser.add_argument('INPUT', nargs='+', help='backup files or directories')
+    parser.add_argument('-a', '--action', choices=ACTIONS, default='list')
+    parser.add_argument('-p', '--password', help='password of all backups')
+    parser.add_argument('--password-file',
+                        help='JSON object mapping file names or glob patterns to passwords')
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help='directory for the unpacked backups')
+    parser.add_argument('-P', '--processes', type=int,
+                        help='number of processes (default: number of CPUs)')
+    parser.add_argument('-j', '--workers', type=int,
+                        help='number of writer threads per process')
+    parser.add_argument('-m', '--memory-budget', type=_parse_size,
+                        help='memory the running jobs may use together, e.g. 4G')
+    parser.add_argument('--store', metavar='DIR',
+                        help='store the file contents of the unpacked backups once in this directory')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+
+    args = parser.parse_args()
+
+    password = args.password
+    if args.password_file:
+        password = PasswordLookup.load(args.password_file, args.password)
+
+    def report(result):
+        if args.json:
+            return
+        if result['ok']:
+            print('ok      {file}: {members} members, {bytes} bytes, {seconds:.2f} s'.format(**result))
+        else:
+            print('FAILED  {file}: {error}'.format(**result))
+        sys.stdout.flush()
+
+    results = run_batch(
+        args.INPUT,
+        action=args.action,
+        password=password,
+        processes=args.processes,
+        memory_budget=args.memory_budget,
+        output_dir=args.output_dir,
+        workers=args.workers,
+        callback=report,
+        store_dir=args.store
+        )
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if not all(result['ok'] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
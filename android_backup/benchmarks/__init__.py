@@ -0,0 +1,6 @@
+"""
+Benchmarks for android_backup: a generator for synthetic backup files
+(android_backup.benchmarks.generate) and a runner measuring the operations
+on them (android_backup.benchmarks.run)
+"""
+from .generate import PROFILES, generate
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Micro-benchmark of the crypto backends: PBKDF2 with the parameters of
+backups (two derivations per open) and AES-CBC throughput in the chunk
+sizes of stream mode (chunk_size) and the index checkpoints.
+
+    $ python -m android_backup.benchmarks.crypto -o crypto.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+from .. import crypto
+from ..android_backup import AndroidBackup
+
+
+CHUNK_SIZES = (64 * 1024, 1024 * 1024)
+
+
+def _best(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+
+def measure_pbkdf2(backend, rounds=AndroidBackup.ROUNDS, repeat=3):
+    """
+    :returns: the seconds of one derivation (64 byte salt, 256 bit key)
+    """
+    salt = os.urandom(64)
+    return _best(lambda: backend.pbkdf2('benchmark', salt, rounds, 32), repeat)
+
+
+def measure_cbc(backend, chunk_size, total=64 * 1024 * 1024, repeat=3):
+    """
+    :returns: (encryption MB/s, decryption MB/s) of total bytes passed in
+              chunk_size pieces through one cipher
+    """
+    key = os.urandom(32)
+    iv = os.urandom(16)
+    chunk = os.urandom(chunk_size)
+    count = max(1, total // chunk_size)
+
+    def run(method):
+        def func():
+            f = getattr(backend.aes_cbc(key, iv), method)
+            for _ in range(count):
+                f(chunk)
+        return count * chunk_size / _best(func, repeat) / 1e6
+
+    return run('encrypt'), run('decrypt')
+
+
+def run(backends=None, rounds=AndroidBackup.ROUNDS, chunk_sizes=CHUNK_SIZES,
+        total=64 * 1024 * 1024, repeat=3, log=None):
+    """
+    Measures the available backends (or the given names)
+
+    :returns: the results as dict
+    """
+    if backends is None:
+        backends = [backend.name for backend in crypto.available()]
+    results = []
+    for name in backends:
+        backend = crypto.load(name)
+        result = {
+            'backend': name,
+            'pbkdf2_seconds': measure_pbkdf2(backend, rounds, repeat),
+            'cbc': [],
+        }
+        for chunk_size in chunk_sizes if backend.has_cipher else ():
+            encrypt, decrypt = measure_cbc(backend, chunk_size, total, repeat)
+            result['cbc'].append({
+                'chunk_size': chunk_size,
+                'encrypt_mb_per_s': encrypt,
+                'decrypt_mb_per_s': decrypt,
+            })
+        if log is not None:
+            log('{}: PBKDF2 {:.1f} ms{}'.format(
+                name, result['pbkdf2_seconds'] * 1000,
+                ''.join(', CBC {chunk_size} B: encrypt {encrypt_mb_per_s:.0f} MB/s, '
+                        'decrypt {decrypt_mb_per_s:.0f} MB/s'.format(**cbc)
+                        for cbc in result['cbc'])))
+        results.append(result)
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'selected': crypto.automatic().name,
+        'rounds': rounds,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the crypto backends')
+    parser.add_argument('-b', '--backend', action='append', dest='backends',
+                        choices=crypto.BACKENDS,
+                        help='backend to measure (repeatable, default: all available)')
+    parser.add_argument('--rounds', type=int, default=AndroidBackup.ROUNDS,
+                        help='PBKDF2 rounds (default: %(default)s)')
+    parser.add_argument('--total', type=int, default=64,
+                        help='MiB encrypted and decrypted per chunk size (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help='write the JSON results to this file')
+
+    args = parser.parse_args()
+
+    report = run(
+        backends=args.backends,
+        rounds=args.rounds,
+        total=args.total * 1024 * 1024,
+        repeat=args.repeat,
+        log=lambda line: print(line, file=sys.stderr)
+        )
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Generator for synthetic backup files
+
+    $ python -m android_backup.benchmarks.generate -p small -c zlib -e aes out.ab
+"""
+import argparse
+import math
+import random
+import tarfile
+
+from ..android_backup import AndroidBackup, CompressionType, EncryptionType
+
+
+# member count and size range (log-uniformly distributed)
+PROFILES = {
+    # many small shared preferences
+    'small': {'members': 20000, 'min_size': 256, 'max_size': 8 * 1024},
+    # a few huge databases
+    'large': {'members': 4, 'min_size': 32 * 1024 * 1024, 'max_size': 64 * 1024 * 1024},
+    'mixed': {'members': 2000, 'min_size': 256, 'max_size': 16 * 1024 * 1024},
+}
+
+DOMAINS = ('sp', 'db', 'f')
+
+_BLOCK_SIZE = 4096
+
+
+class _Content:
+    """
+    Reproducible file content of the given compressibility
+    """
+    def __init__(self, rnd, compressibility):
+        self.rnd = rnd
+        self.compressibility = compressibility
+        words = [
+            bytes(rnd.choice(b'abcdefghijklmnopqrstuvwxyz') for _ in range(rnd.randint(2, 9)))
+            for _ in range(512)
+        ]
+        # text which zlib compresses well, but not trivially
+        self._text = b' '.join(rnd.choice(words) for _ in range(8 * _BLOCK_SIZE))
+
+    def _block(self, size):
+        if self.rnd.random() >= self.compressibility:
+            return self.rnd.getrandbits(8 * size).to_bytes(size, 'little')
+        start = self.rnd.randrange(len(self._text) - size)
+        return self._text[start:start + size]
+
+    def read(self, size):
+        return b''.join(self._block(min(_BLOCK_SIZE, size - pos))
+                        for pos in range(0, size, _BLOCK_SIZE))
+
+
+class _Reader:
+    """
+    File-like object returning size bytes of content
+    """
+    def __init__(self, content, size):
+        self.content = content
+        self.remaining = size
+
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        self.remaining -= n
+        return self.content.read(n)
+
+
+def generate(fname, members=1000, min_size=256, max_size=64 * 1024,
+             compressibility=0.8, compression=CompressionType.ZLIB,
+             encryption=EncryptionType.NONE, password=None, packages=10, seed=0):
+    """
+    Writes a synthetic backup file with members named
+    apps/<package>/<domain>/file<n>
+
+    :param members: the number of regular files
+    :param min_size: the minimal file size
+    :param max_size: the maximal file size (sizes are log-uniformly distributed)
+    :param compressibility: the fraction of text (vs. random) blocks
+    :param packages: the number of packages the members are spread over
+    :param seed: seed of the random content
+    :returns: the total size of the files
+    """
+    rnd = random.Random(seed)
+    content = _Content(rnd, compressibility)
+
+    ab = AndroidBackup()
+    ab.version = 3
+    ab.compression = compression
+    ab.encryption = encryption
+
+    total = 0
+    with open(fname, 'wb') as fp:
+        tar = ab.write_data(fp, password=password)
+        for i in range(members):
+            package = i * packages // members
+            member = tarfile.TarInfo('apps/pkg{}/{}/file{}'.format(
+                package, DOMAINS[i % len(DOMAINS)], i))
+            member.size = int(math.exp(rnd.uniform(math.log(min_size), math.log(max_size))))
+            member.mtime = 1500000000
+            tar.addfile(member, _Reader(content, member.size))
+            del tar.members[:]
+            total += member.size
+        tar.close()
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates a synthetic backup file')
+    parser.add_argument('OUT')
+    parser.add_argument('-p', '--profile', choices=sorted(PROFILES), default='mixed')
+    parser.add_argument('-n', '--members', type=int)
+    parser.add_argument('--compressibility', type=float, default=0.8)
+    parser.add_argument('-c', '--compression', choices=['none', 'zlib'], default='zlib')
+    parser.add_argument('-e', '--encryption', choices=['none', 'aes'], default='none')
+    parser.add_argument('--password', default='benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    kwargs = dict(PROFILES[args.profile])
+    if args.members is not None:
+        kwargs['members'] = args.members
+    total = generate(
+        args.OUT,
+        compressibility=args.compressibility,
+        compression=CompressionType[args.compression.upper()],
+        encryption=EncryptionType.AES256 if args.encryption == 'aes' else EncryptionType.NONE,
+        password=args.password,
+        seed=args.seed,
+        **kwargs
+        )
+    print('{}: {} bytes of file data'.format(args.OUT, total))
+
+
+if __name__ == "__main__":
+    main()
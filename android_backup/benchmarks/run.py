@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Benchmark runner: generates synthetic backups and measures the wall time,
+throughput and peak RSS of each operation in a fresh process. The results
+are written as JSON, so runs can be compared.
+
+    $ python -m android_backup.benchmarks.run -p small -p large -o results.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+from ..android_backup import AndroidBackup, CompressionType, EncryptionType
+from .generate import PROFILES, generate
+
+
+OPERATIONS = ('parse', 'list', 'get_files', 'unpack', 'pack')
+
+# (compression, encryption)
+VARIANTS = (
+    (CompressionType.NONE, EncryptionType.NONE),
+    (CompressionType.ZLIB, EncryptionType.NONE),
+    (CompressionType.NONE, EncryptionType.AES256),
+    (CompressionType.ZLIB, EncryptionType.AES256),
+)
+
+PASSWORD = 'benchmark'
+
+
+def _peak_rss():
+    """
+    :returns: the peak RSS of this process in KiB (None if unknown)
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def measure(op, fname, stream, workdir):
+    """
+    Runs a single operation (in the current process)
+
+    :param op: one of OPERATIONS
+    :param fname: the backup file
+    :param stream: whether the backup is read in stream mode
+    :param workdir: the directory for unpacked files
+    :returns: dict with seconds and peak_rss_kb
+    """
+    target_dir = os.path.join(workdir, 'unpacked')
+    manifest_fname = os.path.join(workdir, 'backup.manifest')
+
+    start = time.time()
+    if op == 'pack':
+        with AndroidBackup(fname, stream=stream) as ab:
+            out = AndroidBackup()
+            out.version = ab.version
+            out.compression = ab.compression
+            out.encryption = ab.encryption
+            out.pack(os.path.join(workdir, 'packed.ab'), source_dir=target_dir,
+                     password=PASSWORD, manifest_fname=manifest_fname)
+    else:
+        with AndroidBackup(fname, password=PASSWORD, stream=stream) as ab:
+            if op == 'list':
+                with open(os.devnull, 'w') as devnull:
+                    stdout, sys.stdout = sys.stdout, devnull
+                    try:
+                        ab.list()
+                    finally:
+                        sys.stdout = stdout
+            elif op == 'get_files':
+                ab.get_files()
+            elif op == 'unpack':
+                ab.unpack(target_dir=target_dir, manifest_fname=manifest_fname)
+    return {
+        'seconds': time.time() - start,
+        'peak_rss_kb': _peak_rss(),
+    }
+
+
+def _measure_in_child(op, fname, stream, workdir):
+    output = subprocess.check_output([
+        sys.executable, '-m', 'android_backup.benchmarks.run', '--measure',
+        op, fname, str(int(stream)), workdir,
+    ])
+    return json.loads(output.decode())
+
+
+def run(profiles=('mixed',), variants=VARIANTS, operations=OPERATIONS, repeat=3,
+        workdir=None, log=None):
+    """
+    Generates a backup per profile and variant and measures the operations
+    in stream and non-stream mode (pack only once, it does not read).
+    Each measurement runs in a new process; the fastest of repeat runs and
+    the highest peak RSS is reported.
+
+    :returns: the results as dict
+    """
+    results = []
+    own_workdir = workdir is None
+    if own_workdir:
+        workdir = tempfile.mkdtemp(prefix='android-backup-bench')
+    elif not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    try:
+        for profile in profiles:
+            for compression, encryption in variants:
+                fname = os.path.join(workdir, '{}-{}-{}.ab'.format(
+                    profile, compression.name.lower(), encryption.name.lower()))
+                size = generate(fname, compression=compression, encryption=encryption,
+                                password=PASSWORD, **PROFILES[profile])
+                for op in operations:
+                    for stream in ((True,) if op == 'pack' else (True, False)):
+                        shutil.rmtree(os.path.join(workdir, 'unpacked'), ignore_errors=True)
+                        if op == 'pack':
+                            # pack needs the files of a previous unpack
+                            _measure_in_child('unpack', fname, True, workdir)
+                        runs = [_measure_in_child(op, fname, stream, workdir)
+                                for _ in range(repeat)]
+                        seconds = min(r['seconds'] for r in runs)
+                        rss = [r['peak_rss_kb'] for r in runs if r['peak_rss_kb'] is not None]
+                        result = {
+                            'profile': profile,
+                            'compression': compression.name,
+                            'encryption': encryption.name,
+                            'operation': op,
+                            'stream': stream,
+                            'bytes': size,
+                            'file_bytes': os.path.getsize(fname),
+                            'seconds': seconds,
+                            # parse reads only the header
+                            'mb_per_s': size / seconds / 1e6 if op != 'parse' else None,
+                            'peak_rss_kb': max(rss) if rss else None,
+                        }
+                        if log is not None:
+                            log('{profile} {compression}/{encryption} {operation} '
+                                'stream={stream}: {seconds:.3f} s, {throughput} MB/s, '
+                                'peak RSS {peak_rss_kb} KiB'.format(
+                                    throughput='-' if result['mb_per_s'] is None else
+                                    '{:.1f}'.format(result['mb_per_s']),
+                                    **result))
+                        results.append(result)
+                os.unlink(fname)
+    finally:
+        if own_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.time(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--measure':
+        op, fname, stream, workdir = sys.argv[2:6]
+        print(json.dumps(measure(op, fname, stream == '1', workdir)))
+        return
+
+    parser = argparse.ArgumentParser(description='Benchmarks the backup operations')
+    parser.add_argument('-p', '--profile', action='append', dest='profiles',
+                        choices=sorted(PROFILES),
+                        help='backup profile (repeatable, default: mixed)')
+    parser.add_argument('--op', action='append', dest='operations', choices=OPERATIONS,
+                        help='operation to measure (repeatable, default: all)')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-w', '--workdir',
+                        help='directory for the generated files (default: a temporary one)')
+    parser.add_argument('-o', '--output', help='write the JSON results to this file')
+
+    args = parser.parse_args()
+
+    report = run(
+        profiles=args.profiles or ('mixed',),
+        operations=args.operations or OPERATIONS,
+        repeat=args.repeat,
+        workdir=args.workdir,
+        log=lambda line: print(line, file=sys.stderr)
+        )
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
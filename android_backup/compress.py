@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Block-parallel zlib compression (like pigz)
+"""
+import collections
+import concurrent.futures
+import os
+import struct
+import zlib
+
+
+# size of the deflate window
+WINDOW_SIZE = 32 * 1024
+
+
+def _deflate_block(data, dictionary, level, last):
+    """
+    Compresses one block as raw deflate data, using the preceding data
+    as preset dictionary. All but the last block end with a sync flush,
+    so the compressed blocks can be concatenated.
+    """
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                      zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    if last:
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _zlib_header(level):
+    """
+    Returns the two byte zlib header for the given compression level
+    """
+    if level == -1:
+        level = 6
+    if level < 2:
+        flevel = 0
+    elif level < 6:
+        flevel = 1
+    elif level == 6:
+        flevel = 2
+    else:
+        flevel = 3
+    cmf = 0x78  # deflate, 32 KiB window
+    flg = flevel << 6
+    flg += 31 - (cmf * 256 + flg) % 31
+    return bytes(bytearray([cmf, flg]))
+
+
+class ParallelCompressor:
+    """
+    Drop-in replacement for zlib.compressobj() which deflates blocks of the
+    input on a pool of threads (zlib releases the GIL) or processes.
+
+    Each block is primed with the preceding 32 KiB of input as dictionary
+    and all but the last one end with a sync flush, so the concatenated
+    blocks form one valid zlib stream with the Adler-32 of the whole input.
+    """
+    def __init__(self, level=-1, workers=None, block_size=1024 * 1024,
+                 executor=None):
+        """
+        :param level: the compression level
+        :param workers: number of threads (default: number of CPUs)
+        :param block_size: number of input bytes compressed at once
+        :param executor: an optional concurrent.futures.Executor to use
+                         instead of an own thread pool
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.level = level
+        self.block_size = block_size
+        self._own_executor = executor is None
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self._executor = executor
+        # limits the memory used by blocks waiting for compression
+        self._max_pending = 2 * workers
+        self._pending = bytearray()
+        self._futures = collections.deque()
+        self._dictionary = b''
+        self._adler = 1
+        self._header = _zlib_header(level)
+
+    def _submit(self, block, last=False):
+        self._adler = zlib.adler32(block, self._adler)
+        self._futures.append(self._executor.submit(
+            _deflate_block, block, self._dictionary, self.level, last))
+        self._dictionary = (self._dictionary + block[-WINDOW_SIZE:])[-WINDOW_SIZE:]
+
+    def _collect(self, wait=False):
+        """
+        Returns the compressed blocks which are finished (in input order)
+        """
+        futures = self._futures
+        res = []
+        while futures and (wait or futures[0].done() or
+                           len(futures) > self._max_pending):
+            res.append(futures.popleft().result())
+        return res
+
+    def compress(self, data):
+        pending = self._pending
+        pending += data
+        while len(pending) >= self.block_size:
+            self._submit(bytes(pending[:self.block_size]))
+            del pending[:self.block_size]
+
+        res = self._collect()
+        if self._header:
+            res.insert(0, self._header)
+            self._header = b''
+        return b''.join(res)
+
+    def flush(self):
+        self._submit(bytes(self._pending), last=True)
+        self._pending = bytearray()
+        res = self._collect(wait=True)
+        res.insert(0, self._header)
+        res.append(struct.pack('>I', self._adler & 0xffffffff))
+        if self._own_executor:
+            self._executor.shutdown()
+        return b''.join(res)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Streaming conversion between backups and (compressed) tar files
+
+    $ android-backup-convert backup.ab backup.tar.xz
+    $ android-backup-convert -f gz -t ab -e -p secret - - < backup.tgz > backup.ab
+"""
+import argparse
+import shutil
+import sys
+import tarfile
+
+from .android_backup import AndroidBackup, CompressionType, EncryptionType
+
+
+# tar is a plain tar, the others name the compression of a tar
+FORMATS = ('ab', 'tar', 'gz', 'xz', 'bz2')
+
+SUFFIXES = (
+    ('.ab', 'ab'),
+    ('.tar', 'tar'),
+    ('.tar.gz', 'gz'),
+    ('.tgz', 'gz'),
+    ('.tar.xz', 'xz'),
+    ('.txz', 'xz'),
+    ('.tar.bz2', 'bz2'),
+    ('.tbz2', 'bz2'),
+)
+
+
+def guess_format(fname):
+    """
+    :returns: the format (see FORMATS) of a file name, None if unknown
+    """
+    for suffix, fmt in sorted(SUFFIXES, key=lambda item: -len(item[0])):
+        if fname.lower().endswith(suffix):
+            return fmt
+    return None
+
+
+def _compressor(fp, compression):
+    """
+    :returns: a file object compressing into fp (which stays open when
+              it is closed)
+    """
+    if compression == 'gz':
+        import gzip
+        return gzip.GzipFile(fileobj=fp, mode='wb')
+    if compression == 'xz':
+        import lzma
+        return lzma.LZMAFile(fp, 'wb')
+    if compression == 'bz2':
+        import bz2
+        return bz2.BZ2File(fp, 'wb')
+    raise ValueError("Unknown compression {}".format(compression))
+
+
+def ab_to_tar(ab, out, compression=None, password=None):
+    """
+    Writes the tar data of a backup to out, as is, so the tar headers and
+    the member order are kept
+
+    :param ab: the parsed AndroidBackup
+    :param out: the file object to write to
+    :param compression: None (plain tar), 'gz', 'xz' or 'bz2'
+    :param password: optional password for decrypting the backup
+    """
+    data = ab.open_data(password)
+    if compression:
+        out = _compressor(out, compression)
+    shutil.copyfileobj(data, ab._wrap_file('write', out), ab.chunk_size)
+    if compression:
+        out.close()
+
+
+def tar_to_ab(source, out, compression=CompressionType.ZLIB,
+              encryption=EncryptionType.NONE, password=None, version=3,
+              workers=None, stats=None):
+    """
+    Writes the members of a tar (read in stream mode, with any compression
+    tarfile detects) in their order as backup to out
+
+    The headers are written in PAX format, which Android reads (GNU long
+    name records are converted).
+
+    :param source: the file object of the tar
+    :param out: the file object to write the backup to
+    :param password: the password for encrypting the backup
+    :param workers: number of threads compressing the data
+    :param stats: optional Stats
+    :returns: the number of members
+    """
+    ab = AndroidBackup(stats=stats)
+    ab.version = version
+    ab.compression = compression
+    ab.encryption = encryption
+
+    src = tarfile.open(fileobj=source, mode='r|*')
+    tar = ab.write_data(out, password=password, workers=workers)
+    count = 0
+    for member in ab._iterate('tar', src):
+        with ab._timed('tar'):
+            if member.isreg():
+                tar.addfile(member, src.extractfile(member))
+            else:
+                tar.addfile(member)
+        # TarFile remembers all members, which is not needed for writing
+        del tar.members[:]
+        count += 1
+    tar.close()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Converts backups to tar files (optionally compressed) and back')
+    parser.add_argument('IN', help='input file, - for stdin')
+    parser.add_argument('OUT', help='output file, - for stdout')
+    parser.add_argument('-f', '--from', dest='source_format', choices=FORMATS,
+                        help='input format (default: by file name)')
+    parser.add_argument('-t', '--to', dest='target_format', choices=FORMATS,
+                        help='output format (default: by file name)')
+    parser.add_argument('-p', '--password',
+                        help='password of the input backup or for encrypting the output')
+    parser.add_argument('-e', '--encrypt', action='store_true', help='encrypt the output backup')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='write an uncompressed backup')
+    parser.add_argument('-j', '--workers', type=int,
+                        help='number of threads compressing the output backup')
+    parser.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'],
+                        help='print the bytes and time per processing stage to stderr')
+
+    args = parser.parse_args()
+
+    source_format = args.source_format or guess_format(args.IN)
+    target_format = args.target_format or guess_format(args.OUT)
+    if source_format is None or target_format is None:
+        parser.error('unknown format, use --from/--to')
+    if (source_format == 'ab') == (target_format == 'ab'):
+        parser.error('converts from or to a backup only')
+    if args.encrypt and (target_format != 'ab' or not args.password):
+        parser.error('--encrypt requires a backup as output and a password')
+
+    stats = None
+    if args.stats:
+        from .stats import Stats
+        stats = Stats()
+
+    source = sys.stdin.buffer if args.IN == '-' else open(args.IN, 'rb')
+    out = sys.stdout.buffer if args.OUT == '-' else open(args.OUT, 'wb')
+    try:
+        if source_format == 'ab':
+            with AndroidBackup(source, stats=stats) as ab:
+                ab_to_tar(ab, out, None if target_format == 'tar' else target_format,
+                          password=args.password)
+        else:
+            tar_to_ab(
+                source, out,
+                compression=CompressionType.NONE if args.no_compression else CompressionType.ZLIB,
+                encryption=EncryptionType.AES256 if args.encrypt else EncryptionType.NONE,
+                password=args.password,
+                workers=args.workers,
+                stats=stats
+                )
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+        else:
+            out.flush()
+        if source is not sys.stdin.buffer:
+            source.close()
+
+    if stats is not None:
+        print(stats.report() if args.stats == 'text' else stats.to_json(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
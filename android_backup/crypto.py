@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Crypto backends providing AES-CBC and PBKDF2-HMAC-SHA1
+
+pycryptodome and cryptography (OpenSSL) provide both, hashlib only PBKDF2
+(paired with the fastest available AES). By default the fastest available
+implementation of each is used (see android_backup.benchmarks.crypto), the
+environment variable ANDROID_BACKUP_CRYPTO or select() chooses a backend.
+"""
+import os
+
+
+BACKENDS = ('cryptography', 'pycryptodome', 'hashlib')
+
+# order of the automatic selection, fastest first
+CIPHER_PREFERENCE = ('cryptography', 'pycryptodome')
+KDF_PREFERENCE = ('cryptography', 'pycryptodome', 'hashlib')
+
+
+def _to_bytes(password):
+    # like pycryptodome (and Java for these characters)
+    if isinstance(password, str):
+        return password.encode('latin-1')
+    return password
+
+
+class Backend:
+    """
+    Interface of the crypto backends
+    """
+    name = None
+    # whether aes_cbc is implemented
+    has_cipher = True
+
+    def aes_cbc(self, key, iv):
+        """
+        :returns: an AES cipher in CBC mode with encrypt(data) and
+                  decrypt(data) methods for multiples of the block size;
+                  consecutive calls continue the chain (only one of them
+                  may be used)
+        """
+        raise NotImplementedError("{} has no AES".format(self.name))
+
+    def pbkdf2(self, password, salt, rounds, length=32):
+        """
+        :returns: the PBKDF2-HMAC-SHA1 key of a password (str or bytes)
+        """
+        raise NotImplementedError("{} has no PBKDF2".format(self.name))
+
+    def random_bytes(self, n):
+        return os.urandom(n)
+
+    def __repr__(self):
+        return '<{} backend>'.format(self.name)
+
+
+class PyCryptodomeBackend(Backend):
+    name = 'pycryptodome'
+
+    def __init__(self):
+        from Crypto.Cipher import AES
+        from Crypto.Protocol.KDF import PBKDF2
+
+        self._aes = AES
+        self._pbkdf2 = PBKDF2
+
+    def aes_cbc(self, key, iv):
+        return self._aes.new(key, mode=self._aes.MODE_CBC, IV=iv)
+
+    def pbkdf2(self, password, salt, rounds, length=32):
+        return self._pbkdf2(_to_bytes(password), salt, dkLen=length, count=rounds)
+
+
+class _OpenSSLCipher:
+    """
+    AES-CBC of cryptography with the interface of pycryptodome
+    """
+    def __init__(self, cipher):
+        self._cipher = cipher
+
+    def encrypt(self, data):
+        # the context of the first call serves the following ones
+        self.encrypt = self._cipher.encryptor().update
+        return self.encrypt(data)
+
+    def decrypt(self, data):
+        self.decrypt = self._cipher.decryptor().update
+        return self.decrypt(data)
+
+
+class CryptographyBackend(Backend):
+    name = 'cryptography'
+
+    def __init__(self):
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+        self._hashes = hashes
+        self._cipher = Cipher
+        self._algorithms = algorithms
+        self._modes = modes
+        self._kdf = PBKDF2HMAC
+
+    def aes_cbc(self, key, iv):
+        return _OpenSSLCipher(self._cipher(self._algorithms.AES(key), self._modes.CBC(iv)))
+
+    def pbkdf2(self, password, salt, rounds, length=32):
+        kdf = self._kdf(algorithm=self._hashes.SHA1(), length=length, salt=salt,
+                        iterations=rounds)
+        return kdf.derive(_to_bytes(password))
+
+
+class HashlibBackend(Backend):
+    name = 'hashlib'
+    has_cipher = False
+
+    def __init__(self):
+        import hashlib
+
+        self._pbkdf2_hmac = hashlib.pbkdf2_hmac
+
+    def pbkdf2(self, password, salt, rounds, length=32):
+        return self._pbkdf2_hmac('sha1', _to_bytes(password), salt, rounds, length)
+
+
+_CLASSES = {
+    'pycryptodome': PyCryptodomeBackend,
+    'cryptography': CryptographyBackend,
+    'hashlib': HashlibBackend,
+}
+
+
+class _Combined(Backend):
+    """
+    AES of one backend, PBKDF2 of another one
+    """
+    def __init__(self, cipher, kdf):
+        self.name = cipher.name if cipher is kdf else '{}+{}'.format(cipher.name, kdf.name)
+        self.aes_cbc = cipher.aes_cbc
+        self.pbkdf2 = kdf.pbkdf2
+
+
+def load(name):
+    """
+    :param name: one of BACKENDS
+    :raises ImportError: if the library of the backend is not installed
+    """
+    return _CLASSES[name]()
+
+
+def available():
+    """
+    :returns: the backends which can be loaded
+    """
+    backends = []
+    for name in BACKENDS:
+        try:
+            backends.append(load(name))
+        except ImportError:
+            pass
+    return backends
+
+
+def _first(names, method):
+    for name in names:
+        try:
+            return load(name)
+        except ImportError:
+            pass
+    raise ImportError("No {} implementation, pycryptodome or cryptography required".format(method))
+
+
+def automatic():
+    """
+    :returns: the fastest available AES and PBKDF2 implementations
+    :raises ImportError: if neither pycryptodome nor cryptography is installed
+    """
+    cipher = _first(CIPHER_PREFERENCE, 'AES')
+    kdf = _first(KDF_PREFERENCE, 'PBKDF2')
+    if kdf.name == cipher.name:
+        kdf = cipher
+    return _Combined(cipher, kdf)
+
+
+_backend = None
+
+
+def select(name=None):
+    """
+    Selects the backend used for all backups
+
+    :param name: one of BACKENDS (default: the environment variable
+                 ANDROID_BACKUP_CRYPTO or the automatic selection)
+    :rtype: Backend
+    """
+    global _backend
+    if name is None:
+        name = os.environ.get('ANDROID_BACKUP_CRYPTO')
+    if name is None:
+        _backend = automatic()
+    else:
+        _backend = load(name)
+        if not _backend.has_cipher:
+            _backend = _Combined(_first(CIPHER_PREFERENCE, 'AES'), _backend)
+    return _backend
+
+
+def backend():
+    """
+    :returns: the selected backend (selecting it on first use)
+    """
+    if _backend is None:
+        return select()
+    return _backend
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Extraction helpers for AndroidBackup.unpack
+"""
+import collections
+import concurrent.futures
+import os
+import tarfile
+import threading
+
+
+class ParallelExtractor:
+    """
+    Extracts the members of a TarFile with a pool of writer threads.
+
+    The calling thread keeps decoding the stream and hands the payload of
+    each regular file to the pool, which creates, writes and chmods/utimes
+    the files. The payloads waiting in the pool are limited to max_inflight
+    bytes, larger members are extracted directly by the calling thread.
+    """
+    def __init__(self, tar, path, workers, max_inflight=64 * 1024 * 1024):
+        """
+        :param tar: the TarFile to extract (may be opened in stream mode)
+        :param path: the directory to extract into
+        :param workers: the number of writer threads
+        :param max_inflight: the maximal number of payload bytes held in memory
+        """
+        self.tar = tar
+        self.path = path
+        self.workers = workers
+        self.max_inflight = max_inflight
+        self._inflight = 0
+        self._cond = threading.Condition()
+        # directories which are known to exist
+        self._dirs = set()
+        self._futures = collections.deque()
+
+    def extract(self, members=None):
+        """
+        Extracts the given members (default: all) in archive order
+        """
+        if members is None:
+            members = self.tar
+
+        directories = []
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            try:
+                for member in members:
+                    self._check()
+                    if member.isreg() and member.size <= self.max_inflight:
+                        data = self.tar.extractfile(member).read()
+                        self._acquire(len(data))
+                        self._futures.append(pool.submit(self._write, member, data))
+                    elif member.isdir():
+                        directories.append(member)
+                        self.tar.extract(member, self.path, set_attrs=False)
+                        self._dirs.add(os.path.abspath(os.path.join(self.path, member.name)))
+                    else:
+                        if not member.isreg():
+                            # links may refer to files still being written
+                            self._wait()
+                        self.tar.extract(member, self.path)
+                self._wait()
+            finally:
+                for future in self._futures:
+                    future.cancel()
+
+        # set the attributes of directories after their content was written
+        # (like TarFile.extractall)
+        directories.sort(key=lambda member: member.name, reverse=True)
+        for member in directories:
+            dirpath = os.path.join(self.path, member.name)
+            self.tar.chown(member, dirpath, False)
+            self.tar.utime(member, dirpath)
+            self.tar.chmod(member, dirpath)
+
+    def _acquire(self, size):
+        with self._cond:
+            while self._inflight and self._inflight + size > self.max_inflight:
+                self._cond.wait()
+            self._inflight += size
+
+    def _release(self, size):
+        with self._cond:
+            self._inflight -= size
+            self._cond.notify_all()
+
+    def _check(self):
+        """
+        Removes finished writes and raises their errors
+        """
+        futures = self._futures
+        while futures and futures[0].done():
+            futures.popleft().result()
+
+    def _wait(self):
+        """
+        Waits for all pending writes
+        """
+        while self._futures:
+            self._futures.popleft().result()
+
+    def _makedirs(self, dirpath):
+        if dirpath in self._dirs:
+            return
+        if not os.path.isdir(dirpath):
+            try:
+                os.makedirs(dirpath)
+            except OSError:
+                # created by another writer in the meantime
+                if not os.path.isdir(dirpath):
+                    raise
+        self._dirs.add(dirpath)
+
+    def _write(self, member, data):
+        try:
+            root = os.path.abspath(self.path)
+            target = os.path.abspath(os.path.join(root, member.name))
+            if not target.startswith(root + os.sep):
+                raise tarfile.ExtractError(
+                    "{!r} would be extracted outside of {!r}".format(member.name, self.path))
+
+            self._makedirs(os.path.dirname(target))
+            with open(target, 'wb') as fp:
+                fp.write(data)
+            self.tar.chown(member, target, False)
+            self.tar.chmod(member, target)
+            self.tar.utime(member, target)
+        finally:
+            self._release(len(data))
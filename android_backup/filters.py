@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Member selection for AndroidBackup.unpack, list and get_files
+"""
+import fnmatch
+import re
+
+
+def _compile(patterns):
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:{})'.format(fnmatch.translate(pattern))
+                               for pattern in patterns))
+
+
+def package_of(name):
+    """
+    :returns: the package of a member named apps/<package>/... or None
+    """
+    parts = name.split('/', 3)
+    if len(parts) > 1 and parts[0] == 'apps':
+        return parts[1]
+    return None
+
+
+def domain_of(name):
+    """
+    :returns: the domain (f, db, sp, r, ...) of a member named
+              apps/<package>/<domain>/... or None
+    """
+    parts = name.split('/', 3)
+    if len(parts) > 3 and parts[0] == 'apps':
+        return parts[2]
+    return None
+
+
+class MemberFilter:
+    """
+    Selects backup members by package, domain and glob patterns (matched
+    against the whole member name). A member is selected if it matches all
+    given criteria and none of the exclude patterns.
+
+    Backups store the members of each package together, so with
+    early_exit the members are read only until all selected packages
+    were passed, which skips decrypting and inflating the rest.
+
+    >>> with AndroidBackup('backup.ab') as ab:
+    >>>   ab.unpack(member_filter=MemberFilter(packages=['com.example'],
+    >>>                                        domains=['db'], early_exit=True))
+    """
+    def __init__(self, packages=None, domains=None, include=None, exclude=None,
+                 early_exit=False):
+        """
+        :param packages: package names to select
+        :param domains: domains to select (e.g. f, db, sp)
+        :param include: glob patterns to select
+        :param exclude: glob patterns to skip
+        :param early_exit: stop reading after the selected packages
+                           (requires packages)
+        :raises ValueError: if early_exit is set without packages
+        """
+        if early_exit and not packages:
+            raise ValueError("early_exit requires packages")
+        self.packages = set(packages) if packages else None
+        self.domains = set(domains) if domains else None
+        self.include = _compile(include)
+        self.exclude = _compile(exclude)
+        self.early_exit = early_exit
+
+    def match(self, member):
+        """
+        :param member: a tarfile.TarInfo
+        :returns: True if the member is selected
+        """
+        name = member.name
+        if self.packages is not None and package_of(name) not in self.packages:
+            return False
+        if self.domains is not None and domain_of(name) not in self.domains:
+            return False
+        if self.include is not None and not self.include.match(name):
+            return False
+        if self.exclude is not None and self.exclude.match(name):
+            return False
+        return True
+
+    def __call__(self, members):
+        """
+        Filters an iterable of members (e.g. a TarFile)
+
+        :returns: generator of the selected members
+        """
+        pending = set(self.packages or ())
+        previous = None
+        for member in members:
+            if self.early_exit:
+                package = package_of(member.name)
+                if package != previous:
+                    # the members of the previous package are done
+                    pending.discard(previous)
+                    if not pending:
+                        return
+                    previous = package
+            if self.match(member):
+                yield member
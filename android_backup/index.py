@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Random access to single members of a backup file via a sidecar index (.abidx)
+
+The index records the position of each member in the decompressed tar
+stream together with restart points ("checkpoints") for the zlib and AES
+layers, so a member can be read by decrypting and inflating only the data
+between the nearest checkpoint and the member.
+"""
+import base64
+import binascii
+import json
+import os
+import tarfile
+import zlib
+
+from .android_backup import (CompressionType, EncryptionType, Proxy,
+                             _aes_cbc, _CBCDecryptor, _CBCEncryptor)
+
+
+# size of the deflate window, inflating from a checkpoint requires the
+# preceding output of this size as preset dictionary
+WINDOW_SIZE = 32 * 1024
+
+
+class _CheckpointInflater:
+    """
+    zlib decompressor which records checkpoints while inflating
+
+    Python's zlib module can not resume inflating at an arbitrary bit
+    position (zran's inflatePrime), so checkpoints are only taken at sync
+    flush points: the empty stored block (00 00 FF FF) of a sync flush ends
+    the preceding data on a byte boundary and a raw inflater primed with the
+    preceding 32 KiB of output can continue from there. Candidates are
+    confirmed by inflating the following data with such a fresh inflater and
+    comparing the results.
+    """
+    MARKER = b'\x00\x00\xff\xff'
+    # number of bytes which have to be inflated identically to confirm a candidate
+    VERIFY_SIZE = 64 * 1024
+
+    def __init__(self, interval):
+        self.interval = interval
+        # list of (compressed offset, uncompressed offset, window)
+        self.checkpoints = []
+        self._decompressor = zlib.decompressobj()
+        self._in = 0
+        self._out = 0
+        self._window = b''
+        self._tail = b''
+        # uncompressed offset of the last checkpoint
+        self._last = 0
+        # [decompressor, checkpoint, number of verified bytes]
+        self._candidate = None
+
+    def decompress(self, data):
+        res = bytearray()
+        pos = 0
+        # the last bytes of the previous chunk, for markers spanning chunks
+        tail = self._tail
+        haystack = tail + data
+        while (self._candidate is None and not self._decompressor.eof and
+               self._out - self._last >= self.interval):
+            i = haystack.find(self.MARKER, pos + len(tail) if pos else 0)
+            if i < 0:
+                break
+            end = i + len(self.MARKER) - len(tail)
+            res += self._inflate(data[pos:end])
+            pos = end
+            self._candidate = [
+                zlib.decompressobj(-zlib.MAX_WBITS, zdict=self._window),
+                (self._in, self._out, self._window),
+                0
+            ]
+        res += self._inflate(data[pos:])
+        self._tail = haystack[-(len(self.MARKER) - 1):]
+        return res
+
+    def _inflate(self, data):
+        res = self._decompressor.decompress(data)
+        self._in += len(data)
+        self._out += len(res)
+        if res:
+            self._window = (self._window + res[-WINDOW_SIZE:])[-WINDOW_SIZE:]
+
+        if self._candidate is not None:
+            decompressor, checkpoint, verified = self._candidate
+            try:
+                expected = decompressor.decompress(data)
+            except zlib.error:
+                expected = None
+            if expected != res:
+                self._candidate = None
+            elif verified + len(res) >= self.VERIFY_SIZE:
+                self.checkpoints.append(checkpoint)
+                self._last = checkpoint[1]
+                self._candidate = None
+            else:
+                self._candidate[2] = verified + len(res)
+        return res
+
+
+class _MemberReader:
+    """
+    File-like object reading `size` bytes from a stream
+    """
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.size = size
+        self.pos = 0
+
+    def read(self, n=-1):
+        remaining = self.size - self.pos
+        if n is None or n < 0 or n > remaining:
+            n = remaining
+        data = self.stream.read(n)
+        if len(data) < n:
+            raise IOError("Unexpected end of data")
+        self.pos += n
+        return data
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BackupIndex:
+    """
+    Index of the members of a backup file
+
+    >>> with AndroidBackup('backup.ab') as ab:
+    >>>   index = BackupIndex.build(ab)
+    >>>   index.save('backup.ab.abidx')
+    >>>   data = index.open('apps/com.example/f/file').read()
+    """
+    MAGIC = b'ANDROID BACKUP INDEX\n'
+    VERSION = 1
+    # minimal number of uncompressed bytes between two checkpoints
+    CHECKPOINT_INTERVAL = 16 * 1024 * 1024
+
+    def __init__(self, backup, start, members, checkpoints, fingerprint,
+                 master_key=None, master_iv=None):
+        """
+        :param backup: the parsed AndroidBackup the index belongs to
+        :param start: the offset of the (encrypted) payload in the backup file
+        :param members: list of dicts with the keys name, type, size, offset and offset_data
+        :param checkpoints: list of (compressed offset, uncompressed offset, window, IV)
+        :param fingerprint: the fingerprint of the backup file (see _fingerprint)
+        :param master_key: the master key of encrypted backups
+        :param master_iv: the IV of the encrypted data
+        """
+        self.backup = backup
+        self.start = start
+        self.members = members
+        self.checkpoints = checkpoints
+        self.fingerprint = fingerprint
+        self.master_key = master_key
+        self.master_iv = master_iv
+        self._by_name = dict((member['name'], member) for member in members)
+
+    @staticmethod
+    def _fingerprint(backup):
+        """
+        Size and CRC32 of the first 64 KiB of the backup file, used to detect
+        stale indices
+        """
+        fp = backup.fp
+        fp.seek(0, 2)
+        size = fp.tell()
+        fp.seek(0)
+        return {'size': size, 'crc32': zlib.crc32(fp.read(64 * 1024)) & 0xffffffff}
+
+    @staticmethod
+    def _payload_start(backup, password=None):
+        """
+        Seeks to the start of the (encrypted) payload
+
+        :returns: (master key, master IV, offset of the payload)
+        """
+        fp = backup.fp
+        fp.seek(backup.data_start)
+        if not backup.is_encrypted():
+            return None, None, backup.data_start
+
+        header = backup._read_encryption_header(fp)
+        master_key, master_iv = backup._unlock(header, password)
+        return master_key, master_iv, backup.data_start + header[5]
+
+    @classmethod
+    def build(cls, backup, password=None, interval=None):
+        """
+        Indexes a backup by reading it once
+
+        :param backup: a parsed AndroidBackup using a seekable file
+        :param password: optional password for decrypting the backup
+        :param interval: minimal distance of two checkpoints in the
+                         uncompressed data (default: CHECKPOINT_INTERVAL)
+        """
+        if interval is None:
+            interval = cls.CHECKPOINT_INTERVAL
+
+        fingerprint = cls._fingerprint(backup)
+        master_key, master_iv, start = cls._payload_start(backup, password)
+
+        fp = backup.fp
+        if master_key is not None:
+            decryptor = _CBCDecryptor(_aes_cbc(master_key, master_iv))
+            fp = Proxy(decryptor.decrypt, fp, backup.chunk_size, flush=decryptor.flush)
+
+        inflater = None
+        if backup.compression == CompressionType.ZLIB:
+            inflater = _CheckpointInflater(interval)
+            fp = Proxy(inflater.decompress, fp)
+
+        tar = tarfile.open(fileobj=fp, mode='r|')
+        members = []
+        for member in tar:
+            members.append({
+                'name': member.name,
+                'type': member.type.decode('latin-1'),
+                'size': member.size,
+                'offset': member.offset,
+                'offset_data': member.offset_data,
+            })
+
+        checkpoints = []
+        if inflater is not None:
+            for comp_offset, offset, window in inflater.checkpoints:
+                iv = None
+                if master_key is not None:
+                    # CBC: the previous ciphertext block is the IV of the next one
+                    block = comp_offset // 16 * 16
+                    iv = master_iv
+                    if block:
+                        backup.fp.seek(start + block - 16)
+                        iv = backup.fp.read(16)
+                checkpoints.append((comp_offset, offset, window, iv))
+
+        return cls(backup, start, members, checkpoints, fingerprint,
+                   master_key=master_key, master_iv=master_iv)
+
+    def save(self, fname):
+        """
+        Writes the index to the given file. The index of an encrypted backup
+        is encrypted with its master key
+        """
+        data = json.dumps({
+            'version': self.VERSION,
+            'fingerprint': self.fingerprint,
+            'members': self.members,
+            'checkpoints': [{
+                'in': comp_offset,
+                'out': offset,
+                'window': base64.b64encode(window).decode(),
+                'iv': iv and binascii.b2a_hex(iv).decode(),
+            } for comp_offset, offset, window, iv in self.checkpoints],
+        }).encode()
+        data = zlib.compress(data)
+
+        with open(fname, 'wb') as fp:
+            fp.write(self.MAGIC)
+            fp.write('{}\n'.format(self.VERSION).encode())
+            if self.master_key is None:
+                fp.write('{}\n'.format(EncryptionType.NONE.value).encode())
+            else:
+                iv = os.urandom(16)
+                encryptor = _CBCEncryptor(_aes_cbc(self.master_key, iv))
+                data = encryptor.encrypt(data) + encryptor.flush()
+                fp.write('{}\n'.format(EncryptionType.AES256.value).encode())
+                fp.write(binascii.b2a_hex(iv).upper() + b'\n')
+            fp.write(data)
+
+    @classmethod
+    def load(cls, fname, backup, password=None):
+        """
+        Reads an index file written by save
+
+        :param backup: the parsed AndroidBackup the index belongs to
+        :param password: optional password for decrypting the backup and the index
+        """
+        with open(fname, 'rb') as fp:
+            if fp.readline() != cls.MAGIC:
+                raise ValueError("{} is not a backup index".format(fname))
+            version = int(fp.readline().strip())
+            if version != cls.VERSION:
+                raise ValueError("Unsupported index version {}".format(version))
+            encryption = EncryptionType(fp.readline().strip().decode())
+            iv = None
+            if encryption == EncryptionType.AES256:
+                iv = binascii.a2b_hex(fp.readline().strip())
+            data = fp.read()
+
+        master_key, master_iv, start = cls._payload_start(backup, password)
+        if iv is not None:
+            if master_key is None:
+                raise ValueError("Index of an encrypted backup used for an unencrypted one")
+            decryptor = _CBCDecryptor(_aes_cbc(master_key, iv))
+            data = decryptor.decrypt(data) + decryptor.flush()
+        data = json.loads(zlib.decompress(data).decode())
+
+        fingerprint = cls._fingerprint(backup)
+        if data['fingerprint'] != fingerprint:
+            raise ValueError("Index {} does not match {}".format(fname, backup.fname))
+
+        checkpoints = [(
+            checkpoint['in'],
+            checkpoint['out'],
+            base64.b64decode(checkpoint['window']),
+            checkpoint['iv'] and binascii.a2b_hex(checkpoint['iv']),
+        ) for checkpoint in data['checkpoints']]
+        return cls(backup, start, data['members'], checkpoints, fingerprint,
+                   master_key=master_key, master_iv=master_iv)
+
+    def getnames(self):
+        """
+        Returns the member names in archive order
+        """
+        return [member['name'] for member in self.members]
+
+    def _stream_at(self, offset):
+        """
+        Returns a stream of the uncompressed tar data starting at the given offset
+        """
+        backup = self.backup
+        fp = backup.fp
+        start = self.start
+
+        if backup.compression == CompressionType.ZLIB:
+            comp_offset, out_offset, window, iv = 0, 0, b'', self.master_iv
+            for checkpoint in self.checkpoints:
+                if checkpoint[1] > offset:
+                    break
+                comp_offset, out_offset, window, iv = checkpoint
+        else:
+            comp_offset, out_offset, window, iv = offset, offset, None, None
+
+        block = comp_offset
+        if self.master_key is not None:
+            block = comp_offset // 16 * 16
+            if iv is None:
+                iv = self.master_iv
+                if block:
+                    fp.seek(start + block - 16)
+                    iv = fp.read(16)
+        fp.seek(start + block)
+
+        stream = fp
+        if self.master_key is not None:
+            decryptor = _CBCDecryptor(_aes_cbc(self.master_key, iv))
+            stream = Proxy(decryptor.decrypt, stream, backup.chunk_size, flush=decryptor.flush)
+            self._skip(stream, comp_offset - block)
+
+        if backup.compression == CompressionType.ZLIB:
+            if comp_offset:
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=window)
+            else:
+                decompressor = zlib.decompressobj()
+            stream = Proxy(decompressor.decompress, stream)
+            self._skip(stream, offset - out_offset)
+
+        return stream
+
+    @staticmethod
+    def _skip(stream, n):
+        while n > 0:
+            data = stream.read(min(n, 1024 * 1024))
+            if not data:
+                raise IOError("Unexpected end of data")
+            n -= len(data)
+
+    def open(self, name):
+        """
+        Returns a file-like object for reading the content of the given member
+        """
+        try:
+            member = self._by_name[name]
+        except KeyError:
+            raise KeyError("filename {!r} not found".format(name))
+        if member['type'] not in (tarfile.REGTYPE.decode(), tarfile.AREGTYPE.decode()):
+            raise ValueError("{} is not a regular file".format(name))
+        return _MemberReader(self._stream_at(member['offset_data']), member['size'])
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Cache for the unlocked master keys of encrypted backups
+"""
+import binascii
+import collections
+import errno
+import hashlib
+import hmac
+import json
+import os
+import threading
+
+
+class KeyCache:
+    """
+    Caches the master key and IV of encrypted backups, so opening the same
+    backup again skips both PBKDF2 derivations.
+
+    Entries are keyed by a fingerprint of the password (HMAC with a random
+    secret, never the password itself), the PBKDF2 salt and rounds and the
+    encrypted master key blob. The in-process cache is an LRU limited to
+    max_entries. If a path is given, entries are also stored in that
+    directory (mode 0700, files 0600, an existing directory accessible by
+    others is restricted to these), which therefore contains the unwrapped
+    master keys of the backups.
+
+    >>> cache = KeyCache(path=os.path.expanduser('~/.cache/android-backup-keys'))
+    >>> with AndroidBackup('backup.ab', password='secret', key_cache=cache) as ab:
+    >>>   ab.list()
+    """
+    def __init__(self, max_entries=128, path=None):
+        """
+        :param max_entries: the maximal number of entries kept in memory
+        :param path: optional directory for persisting the entries
+        """
+        self.max_entries = max_entries
+        self.path = path
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if path is None:
+            self._secret = os.urandom(32)
+        else:
+            self._secret = self._load_secret()
+
+    def _load_secret(self):
+        """
+        Reads (or creates) the secret of an on-disk cache
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o700)
+        self._check_permissions()
+        fname = os.path.join(self.path, 'secret')
+        try:
+            with open(fname, 'rb') as fp:
+                return fp.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        secret = os.urandom(32)
+        self._write(fname, secret)
+        return secret
+
+    def _check_permissions(self):
+        """
+        Makes sure that only the owner can access the cache directory
+
+        :raises PermissionError: if the directory belongs to another user
+        """
+        st = os.stat(self.path)
+        if hasattr(os, 'geteuid') and st.st_uid != os.geteuid():
+            raise PermissionError("Key cache {} is owned by another user".format(self.path))
+        if st.st_mode & 0o077:
+            os.chmod(self.path, 0o700)
+            for name in os.listdir(self.path):
+                os.chmod(os.path.join(self.path, name), 0o600)
+
+    @staticmethod
+    def _write(fname, data):
+        """
+        Atomically writes a file only readable by the owner
+        """
+        tmp = '{}.{}.tmp'.format(fname, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            os.rename(tmp, fname)
+        except Exception:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def _key(self, password, user_salt, rounds, master_blob):
+        if not isinstance(password, bytes):
+            password = password.encode('utf-8')
+        fingerprint = hmac.new(self._secret, password, hashlib.sha256).digest()
+        return hmac.new(self._secret, b'\0'.join([
+            fingerprint,
+            user_salt,
+            str(rounds).encode(),
+            hashlib.sha256(master_blob).digest(),
+        ]), hashlib.sha256).hexdigest()
+
+    def get(self, password, user_salt, rounds, master_blob):
+        """
+        :returns: the cached (master key, master IV) or None
+        """
+        key = self._key(password, user_salt, rounds, master_blob)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        if self.path is None:
+            return None
+        try:
+            with open(os.path.join(self.path, key), 'rb') as fp:
+                entry = json.loads(fp.read().decode())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        value = (binascii.a2b_hex(entry['key']), binascii.a2b_hex(entry['iv']))
+        self._remember(key, value)
+        return value
+
+    def put(self, password, user_salt, rounds, master_blob, master_key, master_iv):
+        """
+        Stores the unlocked master key and IV of a backup
+        """
+        key = self._key(password, user_salt, rounds, master_blob)
+        self._remember(key, (master_key, master_iv))
+        if self.path is not None:
+            self._write(os.path.join(self.path, key), json.dumps({
+                'key': binascii.b2a_hex(master_key).decode(),
+                'iv': binascii.b2a_hex(master_iv).decode(),
+            }).encode())
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes all entries (including the on-disk ones)
+        """
+        with self._lock:
+            self._entries.clear()
+        if self.path is not None:
+            for name in os.listdir(self.path):
+                if name != 'secret':
+                    os.unlink(os.path.join(self.path, name))
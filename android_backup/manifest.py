@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Member manifest written by AndroidBackup.unpack and read by AndroidBackup.pack
+
+The manifest is a JSON-lines file: a header line followed by one line per
+member in archive order. A member is an array of the values of FIELDS,
+optionally followed by an object with the rarely used fields (linkname,
+devmajor, devminor, pax). Owner and group names are interned: a line
+{"str": "..."} defines the next string id, members refer to it by number.
+The SHA-256 of regular files is recorded, so AndroidBackup.pack can tell
+which files were changed after unpacking.
+Pickled lists of TarInfo objects (the former format) are still read.
+"""
+import hashlib
+import json
+import os
+import pickle
+import tarfile
+
+
+FORMAT = 'android-backup-manifest'
+VERSION = 2
+FIELDS = ('name', 'type', 'mode', 'uid', 'gid', 'size', 'mtime', 'uname',
+          'gname', 'offset', 'offset_data', 'sha256')
+# version 1 did not record digests
+FIELDS_V1 = FIELDS[:-1]
+
+
+class ManifestEntry(tarfile.TarInfo):
+    """
+    TarInfo read from a manifest, with the SHA-256 (hex) of its content
+    at unpack time (None if unknown)
+    """
+    __slots__ = ('sha256',)
+
+    def __init__(self, name=''):
+        tarfile.TarInfo.__init__(self, name)
+        self.sha256 = None
+
+
+class DigestReader:
+    """
+    Wraps the file object of a TarFile and computes the SHA-256 of the data
+    read through it, i.e. of the member being extracted
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    def read(self, n=-1):
+        data = self.fileobj.read(n)
+        self._hash.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+def file_digest(fname, chunk_size=1024 * 1024):
+    """
+    :returns: the SHA-256 (hex) of a file
+    """
+    h = hashlib.sha256()
+    with open(fname, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def refresh(member, fname):
+    """
+    Compares a regular member with its unpacked file and updates size and
+    mtime of the member if the file was changed. Files with the recorded
+    size and mtime are not read, touched files are compared by digest.
+
+    :returns: True if the file was changed
+    """
+    st = os.stat(fname)
+    if st.st_size == member.size and int(st.st_mtime) == int(member.mtime):
+        return False
+    digest = getattr(member, 'sha256', None)
+    if st.st_size == member.size and digest is not None and file_digest(fname) == digest:
+        return False
+
+    member.size = st.st_size
+    member.mtime = int(st.st_mtime)
+    # PAX values would take precedence over the new ones
+    for key in ('size', 'mtime'):
+        member.pax_headers.pop(key, None)
+    return True
+
+
+class ManifestWriter:
+    """
+    Writes a manifest member by member
+
+    >>> with ManifestWriter('backup.manifest') as manifest:
+    >>>   for member in tar:
+    >>>     manifest.write(member)
+    """
+    def __init__(self, fname):
+        self.fp = open(fname, 'w')
+        self._strings = {}
+        self._write({'format': FORMAT, 'version': VERSION, 'fields': FIELDS})
+
+    def _write(self, obj):
+        self.fp.write(json.dumps(obj, separators=(',', ':'), sort_keys=True))
+        self.fp.write('\n')
+
+    def _intern(self, s):
+        try:
+            return self._strings[s]
+        except KeyError:
+            self._strings[s] = len(self._strings)
+            self._write({'str': s})
+            return self._strings[s]
+
+    def write(self, member, sha256=None):
+        """
+        Appends a member
+
+        :param member: the tarfile.TarInfo to record
+        :param sha256: the SHA-256 (hex) of the content of a regular file
+        """
+        uname = self._intern(member.uname)
+        gname = self._intern(member.gname)
+        entry = [
+            member.name,
+            member.type.decode('latin-1'),
+            member.mode,
+            member.uid,
+            member.gid,
+            member.size,
+            member.mtime,
+            uname,
+            gname,
+            member.offset,
+            member.offset_data,
+            sha256,
+        ]
+        # the usually empty fields
+        extra = {}
+        if member.linkname:
+            extra['linkname'] = member.linkname
+        if member.devmajor or member.devminor:
+            extra['devmajor'] = member.devmajor
+            extra['devminor'] = member.devminor
+        if member.pax_headers:
+            extra['pax'] = member.pax_headers
+        if extra:
+            entry.append(extra)
+        self._write(entry)
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _member(entry, fields, strings):
+    (name, type, mode, uid, gid, size, mtime, uname, gname, offset,
+     offset_data) = entry[:len(FIELDS_V1)]
+    extra = entry[len(fields)] if len(entry) > len(fields) else {}
+
+    member = ManifestEntry(name)
+    if len(fields) == len(FIELDS):
+        member.sha256 = entry[len(FIELDS_V1)]
+    member.type = type.encode('latin-1')
+    member.mode = mode
+    member.uid = uid
+    member.gid = gid
+    member.size = size
+    member.mtime = mtime
+    member.uname = strings[uname]
+    member.gname = strings[gname]
+    member.offset = offset
+    member.offset_data = offset_data
+    member.linkname = extra.get('linkname', '')
+    member.devmajor = extra.get('devmajor', 0)
+    member.devminor = extra.get('devminor', 0)
+    member.pax_headers = extra.get('pax', {})
+    return member
+
+
+def iter_manifest(fname):
+    """
+    Reads the members of a manifest lazily
+
+    :returns: generator of ManifestEntry (tarfile.TarInfo for pickles)
+    """
+    with open(fname, 'rb') as fp:
+        if fp.read(1) != b'{':
+            # legacy pickle
+            fp.seek(0)
+            for member in pickle.load(fp):
+                yield member
+            return
+        fp.seek(0)
+
+        header = json.loads(fp.readline().decode('utf-8'))
+        if header.get('format') != FORMAT:
+            raise ValueError("{} is not a backup manifest".format(fname))
+        fields = tuple(header.get('fields', ()))
+        if (header.get('version'), fields) not in ((1, FIELDS_V1), (VERSION, FIELDS)):
+            raise ValueError("Unsupported manifest version {}".format(header.get('version')))
+
+        strings = []
+        for line in fp:
+            entry = json.loads(line.decode('utf-8'))
+            if isinstance(entry, dict):
+                strings.append(entry['str'])
+            else:
+                yield _member(entry, fields, strings)
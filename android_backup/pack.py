@@ -41,6 +41,12 @@ def main():
     parser.add_argument('-p', '--password')
     parser.add_argument('-s', '--source-dir')
     parser.add_argument('-e', '--encrypt', action='store_true')
+    parser.add_argument('-j', '--workers', type=int,
+                        help='number of threads compressing the data')
+    parser.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'],
+                        help='print the bytes and time per processing stage to stderr')
+    parser.add_argument('--tar', metavar='FILE',
+                        help='copy unchanged files from the tar data kept by unpack')
 
     args = parser.parse_args()
 
@@ -50,12 +56,20 @@ def main():
     ab.encryption = android_backup.EncryptionType.NONE
     if args.encrypt:
         ab.encryption = android_backup.EncryptionType.AES256
+    if args.stats:
+        ab.stats = android_backup.Stats()
     
-    ab.pack(
+    changed = ab.pack(
         fname=args.OUT,
         source_dir=args.source_dir,
-        password=args.password
+        password=args.password,
+        workers=args.workers,
+        tar_fname=args.tar
         )
+    for name in changed:
+        print('changed: {}'.format(name))
+    if ab.stats is not None:
+        print(ab.stats.report() if args.stats == 'text' else ab.stats.to_json(), file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Threaded read pipeline: reading, decryption and decompression each run on
+their own thread, connected by bounded queues
+"""
+import queue
+import sys
+import threading
+import time
+
+from .android_backup import Proxy
+from .stats import Stats
+
+
+class _Error:
+    """
+    Wraps an exception raised by a stage thread
+    """
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class _QueueSource:
+    """
+    Minimal file-like object returning the chunks of a queue
+    """
+    def __init__(self, q):
+        self.queue = q
+        self.eof = False
+
+    def read(self, n=-1):
+        if self.eof:
+            return b''
+        item = self.queue.get()
+        if item is None:
+            self.eof = True
+            return b''
+        if isinstance(item, _Error):
+            self.eof = True
+            exc = item.exc_info[1]
+            raise exc.with_traceback(item.exc_info[2])
+        return item
+
+
+class Pipeline(Proxy):
+    """
+    Reads a source through a chain of transformer stages, each running
+    on its own thread.
+
+    A stage is a tuple (name, transformer, flush, max_input): transformer
+    and flush behave like the arguments of Proxy, max_input limits the size
+    of the data passed to one transformer call (e.g. to bound the output of
+    an inflater). The result is read like a Proxy by the calling thread.
+
+    The time spent and the bytes consumed and produced by each stage are
+    collected in `stats` (a Stats object).
+    """
+    def __init__(self, source, stages, chunk_size=1024 * 1024, depth=4, stats=None):
+        """
+        :param source: the file-like object to read from
+        :param stages: list of (name, transformer, flush, max_input)
+        :param chunk_size: number of bytes read from the source at once
+        :param depth: maximal number of chunks waiting between two stages
+        :param stats: the Stats to add to (default: a new one)
+        """
+        if stats is None:
+            stats = Stats()
+        self.stats = stats
+        self._stop = threading.Event()
+        self._threads = []
+
+        queues = [queue.Queue(depth) for _ in range(len(stages) + 1)]
+        self.stats.add('read', calls=0)
+        self._start(self._read, source, chunk_size, queues[0])
+        for (name, transformer, flush, max_input), q_in, q_out in zip(stages, queues, queues[1:]):
+            self.stats.add(name, calls=0)
+            self._start(self._transform, name, transformer, flush, max_input, q_in, q_out)
+
+        Proxy.__init__(self, lambda data: data, _QueueSource(queues[-1]))
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def _put(self, q, item):
+        """
+        Puts item into the queue unless the pipeline was closed
+
+        :returns: False if the pipeline was closed
+        """
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        """
+        Takes the next item from the queue unless the pipeline was closed
+
+        :returns: False if the pipeline was closed
+        """
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return False
+
+    def _read(self, source, chunk_size, q_out):
+        try:
+            while True:
+                start = time.perf_counter()
+                data = source.read(chunk_size)
+                self.stats.add('read', len(data), len(data), time.perf_counter() - start)
+                if not data:
+                    break
+                if not self._put(q_out, data):
+                    return
+            self._put(q_out, None)
+        except Exception:
+            self._put(q_out, _Error(sys.exc_info()))
+
+    def _transform(self, name, transformer, flush, max_input, q_in, q_out):
+        try:
+            while True:
+                item = self._get(q_in)
+                if item is False:
+                    return
+                if item is None or isinstance(item, _Error):
+                    break
+                with memoryview(item) as view:
+                    for pos in range(0, len(item), max_input or len(item)):
+                        chunk = view[pos:pos + max_input] if max_input else view
+                        start = time.perf_counter()
+                        data = transformer(chunk)
+                        self.stats.add(name, len(chunk), len(data), time.perf_counter() - start)
+                        if data and not self._put(q_out, data):
+                            return
+
+            if item is None and flush is not None:
+                start = time.perf_counter()
+                data = flush()
+                self.stats.add(name, 0, len(data), time.perf_counter() - start)
+                if data and not self._put(q_out, data):
+                    return
+            self._put(q_out, item)
+        except Exception:
+            self._put(q_out, _Error(sys.exc_info()))
+
+    def close(self):
+        """
+        Stops the stage threads and waits for them (the reading thread
+        finishes the read of the source in progress)
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Header-only inspection of backup files
+
+    $ android-backup-probe --json backups/
+"""
+import argparse
+import binascii
+import json
+import os
+import sys
+
+from .android_backup import AndroidBackup
+
+
+MAGIC = b'ANDROID BACKUP\n'
+
+# longest header line read (the encrypted master key has less than 256 hex digits)
+MAX_LINE = 1024
+
+
+class _HeaderReader:
+    """
+    File object limiting the length of header lines, so files which are
+    no backups are not read completely
+    """
+    def __init__(self, fp):
+        self.fp = fp
+
+    def readline(self, size=MAX_LINE):
+        return self.fp.readline(min(size, MAX_LINE))
+
+    def seek(self, *args):
+        return self.fp.seek(*args)
+
+    def seekable(self):
+        return True
+
+
+def probe(fname):
+    """
+    Reads the header of a backup file (and the key derivation parameters
+    of encrypted ones) without decrypting or decompressing anything
+
+    :returns: dict with file, size, ok and error and the header fields
+              version, compression, encryption, data_start and for
+              encrypted backups rounds, user_salt and checksum_salt (hex)
+    """
+    result = {'file': fname, 'ok': False, 'error': None}
+    try:
+        with open(fname, 'rb') as fp:
+            result['size'] = os.fstat(fp.fileno()).st_size
+            if fp.read(len(MAGIC)) != MAGIC:
+                raise ValueError("Not an android backup")
+
+            ab = AndroidBackup(_HeaderReader(fp))
+            ab.parse()
+            result['version'] = ab.version
+            result['compression'] = ab.compression.name
+            result['encryption'] = ab.encryption.value
+            result['data_start'] = ab.data_start
+            if ab.is_encrypted():
+                header = ab._read_encryption_header(ab.fp)
+                user_salt, ck_salt, rounds = header[:3]
+                result['rounds'] = rounds
+                result['user_salt'] = binascii.b2a_hex(user_salt).decode()
+                result['checksum_salt'] = binascii.b2a_hex(ck_salt).decode()
+                result['data_start'] += header[5]
+        result['ok'] = True
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shows the headers of backup files')
+    parser.add_argument('INPUT', nargs='+', help='backup files or directories')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+
+    args = parser.parse_args()
+
+    from .batch import find_backups
+
+    results = [probe(fname) for fname in find_backups(args.INPUT)]
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        print('{:<40} {:>7} {:<11} {:<10} {:>8}'.format(
+            'file', 'version', 'compression', 'encryption', 'rounds'))
+        for result in results:
+            if result['ok']:
+                print('{file:<40} {version:>7} {compression:<11} {encryption:<10} {rounds:>8}'.format(
+                    **dict(result, rounds=result.get('rounds', '-'))))
+            else:
+                print('{file:<40} {error}'.format(**result))
+    if not all(result['ok'] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Changes the password of backups or encrypts unencrypted ones, without
+decrypting and inflating the data
+
+    $ android-backup-rekey -p old -n new backup.ab rekeyed.ab
+"""
+import argparse
+
+from .android_backup import AndroidBackup
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Changes the password of a backup or encrypts an unencrypted one')
+    parser.add_argument('IN')
+    parser.add_argument('OUT')
+    parser.add_argument('-p', '--password', help='the current password')
+    parser.add_argument('-n', '--new-password', required=True)
+    parser.add_argument('--rounds', type=int,
+                        help='PBKDF2 rounds of the new password (default: {})'.format(
+                            AndroidBackup.ROUNDS))
+
+    args = parser.parse_args()
+
+    with AndroidBackup(args.IN) as ab:
+        if ab.is_encrypted():
+            ab.rekey(args.OUT, args.new_password, password=args.password, rounds=args.rounds)
+        else:
+            ab.encrypt(args.OUT, password=args.new_password, rounds=args.rounds)
+
+
+if __name__ == "__main__":
+    main()
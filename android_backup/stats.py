@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Instrumentation of the processing stages (key derivation, decryption,
+inflating, tar parsing, reading and writing files, ...)
+"""
+import collections
+import json
+import threading
+import time
+
+
+class _Timer:
+    """
+    Context manager measuring one call of a stage. Time spent in nested
+    timers is attributed to those, so the stage times add up to the total.
+    """
+    def __init__(self, stats, stage, bytes_in=0, bytes_out=0):
+        self.stats = stats
+        self.stage = stage
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self._children = 0.0
+
+    def __enter__(self):
+        self.stats._stack().append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self._start
+        stack = self.stats._stack()
+        stack.pop()
+        if stack:
+            stack[-1]._children += elapsed
+        self.stats.add(self.stage, self.bytes_in, self.bytes_out, elapsed - self._children)
+
+
+class _TimedFile:
+    """
+    File object wrapper measuring read and write calls
+    """
+    def __init__(self, stats, stage, fp):
+        self._stats = stats
+        self._stage = stage
+        self._fp = fp
+
+    def read(self, n=-1):
+        with self._stats.timed(self._stage) as timer:
+            data = self._fp.read(n)
+            timer.bytes_in = timer.bytes_out = len(data)
+        return data
+
+    def readline(self, *args):
+        with self._stats.timed(self._stage) as timer:
+            data = self._fp.readline(*args)
+            timer.bytes_in = timer.bytes_out = len(data)
+        return data
+
+    def write(self, data):
+        with self._stats.timed(self._stage, len(data), len(data)):
+            return self._fp.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+
+class Stats:
+    """
+    Counts calls, bytes in and out and the time spent per stage.
+
+    The stages of AndroidBackup are key_derivation, read, decrypt, inflate,
+    tar (header parsing and creation) and write (extracting a member,
+    writing the backup file) as well as deflate and encrypt when packing.
+    Times are exclusive: time spent in a stage triggered by another one
+    (e.g. inflating while a tar header is read) is not counted twice.
+
+    Observers are called with (stage, bytes_in, bytes_out, seconds) for
+    each measured call, e.g. to feed a monitoring system.
+
+    >>> stats = Stats()
+    >>> with AndroidBackup('backup.ab', stats=stats) as ab:
+    >>>   ab.unpack()
+    >>> print(stats.report())
+    """
+    def __init__(self, observer=None):
+        """
+        :param observer: optional callable(stage, bytes_in, bytes_out, seconds)
+        """
+        self.stages = collections.OrderedDict()
+        self.observers = []
+        if observer is not None:
+            self.observers.append(observer)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def add(self, stage, bytes_in=0, bytes_out=0, seconds=0.0, calls=1):
+        """
+        Records calls of a stage (thread-safe)
+        """
+        with self._lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = {
+                    'calls': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0}
+            entry['calls'] += calls
+            entry['bytes_in'] += bytes_in
+            entry['bytes_out'] += bytes_out
+            entry['seconds'] += seconds
+        if calls:
+            for observer in self.observers:
+                observer(stage, bytes_in, bytes_out, seconds)
+
+    def timed(self, stage, bytes_in=0, bytes_out=0):
+        """
+        :returns: a context manager measuring one call of stage, its
+                  bytes_in and bytes_out attributes may be updated
+        """
+        return _Timer(self, stage, bytes_in, bytes_out)
+
+    def wrap(self, stage, func):
+        """
+        Wraps a transformer (or flush) function, counting the length of
+        its argument as bytes in and of its result as bytes out
+        """
+        def wrapper(*args):
+            with self.timed(stage, len(args[0]) if args else 0) as timer:
+                data = func(*args)
+                timer.bytes_out = len(data)
+            return data
+        return wrapper
+
+    def wrap_file(self, stage, fp):
+        """
+        Wraps a file object, measuring its read, readline and write calls
+        """
+        return _TimedFile(self, stage, fp)
+
+    def iterate(self, stage, iterable):
+        """
+        Iterates over iterable, measuring each step
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.timed(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def __getitem__(self, stage):
+        return self.stages[stage]
+
+    def __contains__(self, stage):
+        return stage in self.stages
+
+    def as_dict(self):
+        """
+        :returns: the stages and the total time as dict
+        """
+        with self._lock:
+            stages = collections.OrderedDict(
+                (stage, dict(entry)) for stage, entry in self.stages.items())
+        return {
+            'stages': stages,
+            'seconds': sum(entry['seconds'] for entry in stages.values()),
+        }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def report(self):
+        """
+        :returns: the stages as text table
+        """
+        stats = self.as_dict()
+        lines = ['{:<16} {:>8} {:>14} {:>14} {:>10}'.format(
+            'stage', 'calls', 'bytes in', 'bytes out', 'seconds')]
+        for stage, entry in stats['stages'].items():
+            lines.append('{:<16} {calls:>8} {bytes_in:>14} {bytes_out:>14} {seconds:>10.3f}'.format(
+                stage, **entry))
+        lines.append('{:<16} {:>8} {:>14} {:>14} {:>10.3f}'.format(
+            'total', '', '', '', stats['seconds']))
+        return '\n'.join(lines)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Content-addressed object store shared by unpacked backups
+"""
+import errno
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+
+
+LINK_MODES = ('auto', 'reflink', 'hardlink', 'copy')
+
+# ioctl cloning a file on Linux (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    """
+    Creates dst as copy-on-write clone of src
+
+    :raises OSError: if the file system does not support it
+    """
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported")
+
+    with open(src, 'rb') as source, open(dst, 'wb') as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except OSError:
+            target.close()
+            os.unlink(dst)
+            raise
+
+
+class ObjectStore:
+    """
+    Stores the content of files once per SHA-256 (objects/<2 hex>/<62 hex>),
+    unpacked trees consist of links to the objects. Backups of the same
+    device from different days share most of their files, so they take
+    the disk space of a single one.
+
+    The digest is computed while a member is read from the backup.
+    Contents up to spool_size are kept in memory until the digest is
+    known, so known contents are not written at all; larger ones are
+    written to a temporary file first.
+
+    Trees are materialized with reflinks (copy-on-write clones) if the file
+    system supports them, otherwise with hardlinks (mode auto). Hardlinked
+    files share the object: they must not be modified in place, and mode
+    and mtime are those of the last backup unpacked. The manifest keeps
+    the actual ones.
+
+    >>> store = ObjectStore('backups/objects')
+    >>> with AndroidBackup('backup.ab') as ab:
+    >>>   ab.unpack(store=store)
+    """
+    def __init__(self, path, link='auto', spool_size=8 * 1024 * 1024,
+                 chunk_size=1024 * 1024):
+        """
+        :param path: the directory of the store (created if missing)
+        :param link: one of LINK_MODES
+        :param spool_size: maximal content size buffered in memory
+        :param chunk_size: number of bytes read at once
+        :raises ValueError: if link is not one of LINK_MODES
+        """
+        if link not in LINK_MODES:
+            raise ValueError("Unknown link mode {}".format(link))
+        self.path = path
+        self.link_mode = link
+        # cleared once the file system rejected a reflink in mode auto
+        self._reflink = link in ('auto', 'reflink')
+        self.spool_size = spool_size
+        self.chunk_size = chunk_size
+        # bytes written to new objects and bytes found in the store
+        self.stored_bytes = 0
+        self.reused_bytes = 0
+        self._tmp_dir = os.path.join(path, 'tmp')
+        os.makedirs(self._tmp_dir, exist_ok=True)
+
+    def object_path(self, digest):
+        """
+        :returns: the file of the object with the given SHA-256 (hex)
+        """
+        return os.path.join(self.path, 'objects', digest[:2], digest[2:])
+
+    def __contains__(self, digest):
+        return os.path.exists(self.object_path(digest))
+
+    def add(self, fileobj, size):
+        """
+        Reads size bytes from fileobj and stores them unless the store
+        already has them
+
+        :returns: the SHA-256 (hex) of the data
+        """
+        h = hashlib.sha256()
+        chunks = []
+        tmp = None
+        remaining = size
+        try:
+            while remaining:
+                data = fileobj.read(min(self.chunk_size, remaining))
+                if not data:
+                    raise ValueError("Unexpected end of data, {} bytes missing".format(remaining))
+                h.update(data)
+                remaining -= len(data)
+                if tmp is None and size <= self.spool_size:
+                    chunks.append(data)
+                    continue
+                if tmp is None:
+                    tmp = tempfile.NamedTemporaryFile(dir=self._tmp_dir, delete=False)
+                    tmp.writelines(chunks)
+                    chunks = None
+                tmp.write(data)
+
+            digest = h.hexdigest()
+            fname = self.object_path(digest)
+            if os.path.exists(fname):
+                self.reused_bytes += size
+                return digest
+
+            if tmp is None:
+                tmp = tempfile.NamedTemporaryFile(dir=self._tmp_dir, delete=False)
+                tmp.writelines(chunks)
+            tmp.close()
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            try:
+                # no replace: concurrent writers keep the first object
+                os.link(tmp.name, fname)
+                self.stored_bytes += size
+            except FileExistsError:
+                self.reused_bytes += size
+            return digest
+        finally:
+            if tmp is not None:
+                tmp.close()
+                os.unlink(tmp.name)
+
+    def link(self, digest, target):
+        """
+        Creates target as link (or copy) of an object
+        """
+        fname = self.object_path(digest)
+        if self._reflink:
+            try:
+                return _reflink(fname, target)
+            except OSError:
+                if self.link_mode == 'reflink':
+                    raise
+                self._reflink = False
+        if self.link_mode != 'copy':
+            try:
+                return os.link(fname, target)
+            except OSError as e:
+                # too many links or another file system
+                if e.errno not in (errno.EMLINK, errno.EXDEV, errno.EPERM):
+                    raise
+        shutil.copyfile(fname, target)
+
+    def extract(self, tar, member, path):
+        """
+        Extracts a regular member of a TarFile into the directory path by
+        storing its content and linking it
+
+        :returns: the SHA-256 (hex) of the content
+        """
+        root = os.path.abspath(path)
+        target = os.path.abspath(os.path.join(root, member.name))
+        if not target.startswith(root + os.sep):
+            raise tarfile.ExtractError(
+                "{!r} would be extracted outside of {!r}".format(member.name, path))
+
+        digest = self.add(tar.extractfile(member), member.size)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.lexists(target):
+            os.unlink(target)
+        self.link(digest, target)
+        tar.chown(member, target, False)
+        tar.chmod(member, target)
+        tar.utime(member, target)
+        return digest
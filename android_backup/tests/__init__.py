@@ -1,11 +1,51 @@
 import unittest
+import asyncio
 import base64
+import errno
+import hashlib
 import io
+import os
 import pickle
+import random
+import shutil
 import tarfile
+import tempfile
 import time
+import zlib
 
-from android_backup import AndroidBackup, EncryptionType, CompressionType
+import android_backup.android_backup
+from android_backup import crypto
+from android_backup import AndroidBackup, EncryptionType, CompressionType, KeyCache, MemberFilter, ObjectStore, Stats, probe
+from android_backup.android_backup import Proxy
+from android_backup.aio import AsyncBackup, _BlockingReader
+from android_backup.batch import PasswordLookup, run_batch
+from android_backup.benchmarks import crypto as crypto_benchmark, generate
+from android_backup.compress import ParallelCompressor
+from android_backup.convert import ab_to_tar, tar_to_ab
+from android_backup.index import BackupIndex, _CheckpointInflater
+from android_backup.manifest import iter_manifest
+from android_backup.pipeline import Pipeline
+from android_backup.verify import verify
+
+
+def make_tmpdir(test):
+    """
+    :returns: a temporary directory which is removed after the test
+    """
+    tmp = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, tmp)
+    return tmp
+
+
+def new_backup(compression=CompressionType.ZLIB, encryption=EncryptionType.NONE):
+    """
+    :returns: an AndroidBackup (version 3) for packing or writing data
+    """
+    ab = AndroidBackup()
+    ab.version = 3
+    ab.compression = compression
+    ab.encryption = encryption
+    return ab
 
 
 class UnpackTest(unittest.TestCase):
@@ -33,6 +73,28 @@ class UnpackTest(unittest.TestCase):
                 tar.extractfile(
                     'apps/eu.bluec0re.android-backup/r/settings.cfg').read()
 
+    def test_iter_members(self):
+        with AndroidBackup(io.BytesIO(TEST_DATA_NONENC), stream=False) as ab:
+            tar = ab.read_data()
+            expected = [tar.extractfile(member).read() if member.isreg() else None
+                        for member in tar]
+
+        with AndroidBackup(io.BytesIO(TEST_DATA_ENC_TEST), password='test') as ab:
+            names = []
+            for (member, data), content in zip(ab.iter_members(), expected):
+                names.append(member.name)
+                if content is None:
+                    self.assertIsNone(data)
+                elif len(names) % 2:
+                    # read in pieces
+                    self.assertEqual(data.read(10) + data.read(), content)
+                else:
+                    # skipped
+                    data.read(1)
+                    previous = data
+            self.assertListEqual(names, TEST_MEMBERS_NAMES)
+            self.assertTrue(previous.closed)
+
     def test_compressed_nonstream(self):
         with AndroidBackup(io.BytesIO(TEST_DATA_NONENC), stream=False) as ab:
             self.assertEqual(ab.version, 3)
@@ -73,6 +135,993 @@ class UnpackTest(unittest.TestCase):
             tar.extractfile(
                 'apps/eu.bluec0re.android-backup/r/settings.cfg').read()
 
+    def test_mmap(self):
+        tmp = make_tmpdir(self)
+        fname = os.path.join(tmp, 'backup.ab')
+        name = 'apps/eu.bluec0re.android-backup/r/settings.cfg'
+
+        with AndroidBackup(io.BytesIO(TEST_DATA_NONENC), stream=False) as ab:
+            expected = ab.read_data().extractfile(name).read()
+
+        for data in (TEST_DATA_NONENC, TEST_DATA_ENC_TEST):
+            with open(fname, 'wb') as fp:
+                fp.write(data)
+            for fp in (fname, io.BytesIO(data)):
+                with AndroidBackup(fp, password='test', stream=False, use_mmap=True) as ab:
+                    names = list(map(lambda f: f.name, ab.get_files()))
+                    self.assertListEqual(names, TEST_MEMBERS_NAMES)
+                    self.assertEqual(ab.read_data().extractfile(name).read(), expected)
+
+    def test_encrypted_threaded(self):
+        with AndroidBackup(io.BytesIO(TEST_DATA_ENC_TEST), password='test', threaded=True) as ab:
+            names = list(map(lambda f: f.name, ab.get_files()))
+            self.assertListEqual(names, TEST_MEMBERS_NAMES)
+            # all stages are done once the end was read
+            ab.pipeline.read()
+            stats = ab.pipeline.stats
+            self.assertEqual(stats['decrypt']['bytes_in'], stats['read']['bytes_out'])
+            self.assertEqual(stats['inflate']['bytes_in'], stats['decrypt']['bytes_out'])
+            self.assertGreater(stats['inflate']['bytes_out'], stats['inflate']['bytes_in'])
+
+    def test_pipeline_close(self):
+        class SlowSource(io.BytesIO):
+            def read(self, n=-1):
+                time.sleep(0.05)
+                return super(SlowSource, self).read(n)
+
+        pipeline = Pipeline(SlowSource(bytes(64 * 1024)), [('copy', bytes, None, None)],
+                            chunk_size=1024, depth=2)
+        threads = list(pipeline._threads)
+        self.assertEqual(len(pipeline.read(10)), 10)
+        # the copy stage waits for input when the pipeline is closed
+        pipeline.close()
+        self.assertFalse([thread for thread in threads if thread.is_alive()])
+
+    def test_encrypted_pipe(self):
+        fp = ShortReadPipe(TEST_DATA_ENC_TEST)
+        with AndroidBackup(fp, password='test', chunk_size=64) as ab:
+            self.assertEqual(ab.encryption, EncryptionType.AES256)
+
+            names = list(map(lambda f: f.name, ab.get_files()))
+            self.assertListEqual(names, TEST_MEMBERS_NAMES)
+
+
+    def test_unpack_pipe(self):
+        # unpacking needs only a single pass over the data
+        tmp = make_tmpdir(self)
+        target_dir = os.path.join(tmp, 'unpacked')
+        pickle_fname = os.path.join(tmp, 'backup.pickle')
+
+        with AndroidBackup(ShortReadPipe(TEST_DATA_ENC_TEST), password='test') as ab:
+            ab.unpack(target_dir=target_dir, pickle_fname=pickle_fname)
+
+        with open(pickle_fname, 'rb') as fp:
+            names = [member.name for member in pickle.load(fp)]
+        self.assertListEqual(names, TEST_MEMBERS_NAMES)
+        for name in names:
+            self.assertTrue(os.path.isfile(os.path.join(target_dir, name)))
+
+    def test_unpack_workers(self):
+        tmp = make_tmpdir(self)
+        pickle_fname = os.path.join(tmp, 'backup.pickle')
+
+        with AndroidBackup(io.BytesIO(TEST_DATA_NONENC)) as ab:
+            ab.unpack(target_dir=os.path.join(tmp, 'serial'),
+                      pickle_fname=pickle_fname)
+        with AndroidBackup(io.BytesIO(TEST_DATA_NONENC)) as ab:
+            # small limit: some members are written by the calling thread
+            ab.unpack(target_dir=os.path.join(tmp, 'parallel'),
+                      pickle_fname=pickle_fname, workers=4, max_inflight=2048)
+
+        for name in TEST_MEMBERS_NAMES:
+            with open(os.path.join(tmp, 'serial', name), 'rb') as fp:
+                expected = fp.read()
+            path = os.path.join(tmp, 'parallel', name)
+            with open(path, 'rb') as fp:
+                self.assertEqual(fp.read(), expected)
+            self.assertEqual(os.stat(path).st_mtime,
+                             os.stat(os.path.join(tmp, 'serial', name)).st_mtime)
+
+
+class PackTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = make_tmpdir(self)
+        self.source_dir = os.path.join(self.tmp, 'unpacked')
+        self.pickle_fname = os.path.join(self.tmp, 'backup.pickle')
+
+        with AndroidBackup(io.BytesIO(TEST_DATA_NONENC)) as ab:
+            ab.unpack(target_dir=self.source_dir, pickle_fname=self.pickle_fname)
+
+    def repack(self, compression, encryption, password=None, workers=None):
+        fname = os.path.join(self.tmp, 'backup.ab')
+        ab = new_backup(compression, encryption)
+        ab.pack(fname, source_dir=self.source_dir, password=password,
+                pickle_fname=self.pickle_fname, workers=workers)
+
+        with AndroidBackup(fname, password=password) as ab:
+            self.assertEqual(ab.compression, compression)
+            self.assertEqual(ab.encryption, encryption)
+            tar = ab.read_data()
+            names = []
+            for member in tar:
+                names.append(member.name)
+                with open(os.path.join(self.source_dir, member.name), 'rb') as fp:
+                    self.assertEqual(tar.extractfile(member).read(), fp.read())
+        self.assertListEqual(names, TEST_MEMBERS_NAMES)
+
+    def test_pack_plain(self):
+        self.repack(CompressionType.NONE, EncryptionType.NONE)
+
+    def test_pack_compressed(self):
+        self.repack(CompressionType.ZLIB, EncryptionType.NONE)
+
+    def test_pack_encrypted(self):
+        self.repack(CompressionType.ZLIB, EncryptionType.AES256, password='test')
+
+    def test_pack_parallel(self):
+        self.repack(CompressionType.ZLIB, EncryptionType.AES256, password='test',
+                    workers=2)
+
+
+class ParallelCompressorTest(unittest.TestCase):
+    def test_compress(self):
+        data = b''.join(b'%d ' % (i * i % 9973) for i in range(200000))
+        for level in (1, 6, 9):
+            compressor = ParallelCompressor(level=level, workers=3, block_size=64 * 1024)
+            res = b''.join(compressor.compress(data[i:i + 10000])
+                           for i in range(0, len(data), 10000))
+            res += compressor.flush()
+            # zlib checks header and Adler-32
+            self.assertEqual(zlib.decompress(res), data)
+
+
+class ManifestTest(unittest.TestCase):
+    def test_roundtrip(self):
+        tmp = make_tmpdir(self)
+        source_dir = os.path.join(tmp, 'unpacked')
+        manifest_fname = os.path.join(tmp, 'backup.manifest')
+
+        with AndroidBackup(io.BytesIO(TEST_DATA_NONENC)) as ab:
+            ab.unpack(target_dir=source_dir, manifest_fname=manifest_fname)
+
+        with open(manifest_fname, 'rb') as fp:
+            self.assertEqual(fp.read(1), b'{')
+        members = list(iter_manifest(manifest_fname))
+        self.assertListEqual([member.name for member in members], TEST_MEMBERS_NAMES)
+        for member, expected in zip(members, TEST_MEMBERS):
+            for attr in ('type', 'mode', 'uid', 'gid', 'size', 'mtime', 'uname',
+                         'gname', 'linkname', 'offset', 'offset_data'):
+                self.assertEqual(getattr(member, attr), getattr(expected, attr))
+
+        # the manifest and the former pickle result in the same backup
+        pickle_fname = os.path.join(tmp, 'backup.pickle')
+        with open(pickle_fname, 'wb') as fp:
+            pickle.dump(TEST_MEMBERS, fp)
+        ab = new_backup(CompressionType.NONE)
+        packed = []
+        for fname in (manifest_fname, pickle_fname):
+            out = os.path.join(tmp, 'backup.ab')
+            ab.pack(out, source_dir=source_dir, manifest_fname=fname)
+            with open(out, 'rb') as fp:
+                packed.append(fp.read())
+        self.assertEqual(packed[0], packed[1])
+
+    def test_incremental(self):
+        tmp = make_tmpdir(self)
+        source_dir = os.path.join(tmp, 'unpacked')
+        manifest_fname = os.path.join(tmp, 'backup.manifest')
+        tar_fname = os.path.join(tmp, 'backup.tar')
+
+        with AndroidBackup(io.BytesIO(TEST_DATA_NONENC)) as ab:
+            ab.unpack(target_dir=source_dir, manifest_fname=manifest_fname,
+                      tar_fname=tar_fname)
+
+        regular = [member for member in iter_manifest(manifest_fname) if member.isreg()]
+        for member in regular:
+            with open(os.path.join(source_dir, member.name), 'rb') as fp:
+                self.assertEqual(member.sha256, hashlib.sha256(fp.read()).hexdigest())
+
+        # edit one file, touch another one
+        edited = os.path.join(source_dir, regular[0].name)
+        with open(edited, 'ab') as fp:
+            fp.write(b'edited')
+        os.utime(os.path.join(source_dir, regular[1].name), None)
+
+        ab = new_backup()
+        packed = []
+        for fname in (None, tar_fname):
+            out = os.path.join(tmp, 'backup.ab')
+            changed = ab.pack(out, source_dir=source_dir, manifest_fname=manifest_fname,
+                              tar_fname=fname)
+            self.assertListEqual(changed, [regular[0].name])
+
+            with AndroidBackup(out) as repacked:
+                tar = repacked.read_data()
+                for member in tar:
+                    if member.isreg():
+                        with open(os.path.join(source_dir, member.name), 'rb') as fp:
+                            self.assertEqual(tar.extractfile(member).read(), fp.read())
+                    packed.append(member.name)
+        self.assertListEqual(packed, TEST_MEMBERS_NAMES * 2)
+
+
+class FilterTest(unittest.TestCase):
+    def test_match(self):
+        members = [tarfile.TarInfo(name) for name in TEST_MEMBERS_NAMES]
+        members.append(tarfile.TarInfo('apps/com.other/db/foo.db'))
+        members.append(tarfile.TarInfo('shared/0/DCIM/foo.jpg'))
+
+        def names(**kwargs):
+            return [member.name for member in MemberFilter(**kwargs)(members)]
+
+        self.assertListEqual(names(packages=['com.other']), ['apps/com.other/db/foo.db'])
+        self.assertListEqual(names(domains=['db']), [
+            'apps/eu.bluec0re.android-backup/db/foo.db', 'apps/com.other/db/foo.db'])
+        self.assertListEqual(names(include=['shared/*']), ['shared/0/DCIM/foo.jpg'])
+        self.assertListEqual(names(exclude=['*.db', 'shared/*']), [
+            'apps/eu.bluec0re.android-backup/_manifest',
+            'apps/eu.bluec0re.android-backup/r/settings.cfg',
+            'apps/eu.bluec0re.android-backup/sp/foo.xml'])
+
+    def test_early_exit(self):
+        read = []
+
+        def members():
+            for name in TEST_MEMBERS_NAMES + ['apps/com.other/db/foo.db', 'shared/0/foo']:
+                read.append(name)
+                yield tarfile.TarInfo(name)
+
+        member_filter = MemberFilter(packages=['eu.bluec0re.android-backup'], domains=['sp'],
+                                     early_exit=True)
+        self.assertListEqual([member.name for member in member_filter(members())],
+                             ['apps/eu.bluec0re.android-backup/sp/foo.xml'])
+        # stopped at the first member of the next package
+        self.assertListEqual(read, TEST_MEMBERS_NAMES + ['apps/com.other/db/foo.db'])
+
+        with self.assertRaises(ValueError):
+            MemberFilter(domains=['sp'], early_exit=True)
+
+    def test_unpack(self):
+        tmp = make_tmpdir(self)
+        manifest_fname = os.path.join(tmp, 'backup.manifest')
+
+        member_filter = MemberFilter(domains=['db', 'sp'])
+        with AndroidBackup(io.BytesIO(TEST_DATA_ENC_TEST), password='test') as ab:
+            ab.unpack(target_dir=tmp, manifest_fname=manifest_fname,
+                      member_filter=member_filter)
+        expected = TEST_MEMBERS_NAMES[2:]
+        self.assertListEqual([member.name for member in iter_manifest(manifest_fname)], expected)
+        for name in TEST_MEMBERS_NAMES:
+            self.assertEqual(os.path.exists(os.path.join(tmp, name)), name in expected)
+
+        with AndroidBackup(io.BytesIO(TEST_DATA_NONENC)) as ab:
+            files = ab.get_files(member_filter=member_filter)
+        self.assertListEqual([member.name for member in files], expected)
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_generate(self):
+        tmp = make_tmpdir(self)
+        fname = os.path.join(tmp, 'backup.ab')
+
+        for compression in CompressionType:
+            for encryption in EncryptionType:
+                total = generate(fname, members=30, min_size=10, max_size=100000,
+                                 compression=compression, encryption=encryption,
+                                 password='test', packages=3)
+                with AndroidBackup(fname, password='test') as ab:
+                    self.assertEqual(ab.compression, compression)
+                    self.assertEqual(ab.encryption, encryption)
+                    members = ab.get_files()
+                self.assertEqual(len(members), 30)
+                self.assertEqual(sum(member.size for member in members), total)
+                self.assertEqual(members[-1].name, 'apps/pkg2/f/file29')
+
+
+class AsyncTest(unittest.TestCase):
+    def test_members(self):
+        async def chunks():
+            for i in range(0, len(TEST_DATA_ENC_TEST), 100):
+                yield TEST_DATA_ENC_TEST[i:i + 100]
+
+        async def read(source):
+            result = []
+            async with AsyncBackup(source, password='test', chunk_size=16) as ab:
+                self.assertEqual(ab.encryption, EncryptionType.AES256)
+                async for member, data in ab.members():
+                    result.append((member.name, await data.read()))
+            return result
+
+        with AndroidBackup(io.BytesIO(TEST_DATA_ENC_TEST), password='test', stream=False) as ab:
+            tar = ab.read_data()
+            expected = [(member.name, tar.extractfile(member).read()) for member in tar]
+
+        self.assertListEqual(asyncio.run(read(chunks())), expected)
+
+        async def from_stream():
+            reader = asyncio.StreamReader()
+            reader.feed_data(TEST_DATA_ENC_TEST)
+            reader.feed_eof()
+            return await read(reader)
+        self.assertListEqual(asyncio.run(from_stream()), expected)
+
+    def test_close_early(self):
+        async def main():
+            # the rest of the backup never arrives
+            reader = asyncio.StreamReader()
+            reader.feed_data(TEST_DATA_NONENC[:600])
+            async with AsyncBackup(reader) as ab:
+                async for member, data in ab.members():
+                    return member.name
+        self.assertEqual(asyncio.run(main()), TEST_MEMBERS_NAMES[0])
+
+    def test_close_stalled(self):
+        # the producer starts its next read only after close() was called
+        read = _BlockingReader.read
+
+        def slow_read(reader, n=-1):
+            time.sleep(0.2)
+            return read(reader, n)
+
+        _BlockingReader.read = slow_read
+        self.addCleanup(setattr, _BlockingReader, 'read', read)
+
+        async def main():
+            # the rest of the backup never arrives
+            reader = asyncio.StreamReader()
+            reader.feed_data(TEST_DATA_NONENC[:900])
+            ab = AsyncBackup(reader)
+            await ab.parse()
+            async for member, data in ab.members():
+                break
+            # the producer waits in slow_read
+            await asyncio.sleep(0.1)
+            try:
+                await asyncio.wait_for(ab.close(), 5)
+            except asyncio.TimeoutError:
+                # release the executor thread
+                reader.feed_eof()
+                raise
+            return member.name
+        self.assertEqual(asyncio.run(main()), TEST_MEMBERS_NAMES[0])
+
+
+class BatchTest(unittest.TestCase):
+    def test_batch(self):
+        tmp = make_tmpdir(self)
+        inputs = os.path.join(tmp, 'in')
+        os.mkdir(inputs)
+        for name, data in (('enc.ab', TEST_DATA_ENC_TEST), ('plain.ab', TEST_DATA_NONENC),
+                           ('truncated.ab', TEST_DATA_NONENC[:300])):
+            with open(os.path.join(inputs, name), 'wb') as fp:
+                fp.write(data)
+
+        output_dir = os.path.join(tmp, 'out')
+        results = run_batch([inputs], action='unpack', processes=2, memory_budget=1,
+                            password=PasswordLookup({'enc*': 'test'}), output_dir=output_dir)
+        self.assertListEqual([os.path.basename(r['file']) for r in results],
+                             ['enc.ab', 'plain.ab', 'truncated.ab'])
+        self.assertListEqual([r['ok'] for r in results], [True, True, False])
+        self.assertIsNotNone(results[2]['error'])
+        self.assertEqual(results[0]['members'], len(TEST_MEMBERS_NAMES))
+        for name in TEST_MEMBERS_NAMES:
+            self.assertTrue(os.path.exists(os.path.join(output_dir, 'enc.ab_unpacked', name)))
+
+        # wrong password
+        results = run_batch([os.path.join(inputs, 'enc.ab')], action='verify',
+                            password='wrong', processes=1)
+        self.assertFalse(results[0]['ok'])
+
+        with self.assertRaises(ValueError):
+            run_batch([inputs], action='extract')
+
+    def test_batch_same_names(self):
+        tmp = make_tmpdir(self)
+        inputs = os.path.join(tmp, 'in')
+        for sub, data in (('a', TEST_DATA_ENC_TEST), ('b', TEST_DATA_NONENC)):
+            os.makedirs(os.path.join(inputs, sub))
+            with open(os.path.join(inputs, sub, 'backup.ab'), 'wb') as fp:
+                fp.write(data)
+
+        # unpacked next to each other by their relative path
+        output_dir = os.path.join(tmp, 'out')
+        results = run_batch([inputs], action='unpack', processes=2, password='test',
+                            output_dir=output_dir)
+        self.assertListEqual([r['ok'] for r in results], [True, True])
+        for sub in ('a', 'b'):
+            self.assertListEqual(
+                sorted(member.name for member in iter_manifest(
+                    os.path.join(output_dir, sub, 'backup.ab.manifest'))),
+                sorted(TEST_MEMBERS_NAMES))
+
+        # the same name from two inputs is unpacked only once
+        results = run_batch([os.path.join(inputs, 'a', 'backup.ab'),
+                             os.path.join(inputs, 'b', 'backup.ab')],
+                            action='unpack', processes=2, password='test',
+                            output_dir=os.path.join(tmp, 'flat'))
+        self.assertListEqual([r['ok'] for r in results], [True, False])
+        self.assertIn('already used', results[1]['error'])
+
+
+class ProbeTest(unittest.TestCase):
+    def test_probe(self):
+        tmp = make_tmpdir(self)
+        results = []
+        for name, data in (('enc.ab', TEST_DATA_ENC_TEST), ('plain.ab', TEST_DATA_NONENC),
+                           ('other.ab', b'\0' * 100000)):
+            fname = os.path.join(tmp, name)
+            with open(fname, 'wb') as fp:
+                fp.write(data)
+            results.append(probe(fname))
+
+        enc, plain, other = results
+        self.assertTrue(enc['ok'])
+        self.assertEqual(enc['version'], 3)
+        self.assertEqual(enc['compression'], 'ZLIB')
+        self.assertEqual(enc['encryption'], 'AES-256')
+        self.assertEqual(enc['rounds'], 10000)
+        self.assertEqual(len(enc['user_salt']), 128)
+        with AndroidBackup(io.BytesIO(TEST_DATA_ENC_TEST)) as ab:
+            header_len = ab._read_encryption_header(ab.fp)[5]
+            self.assertEqual(enc['data_start'], ab.data_start + header_len)
+
+        self.assertTrue(plain['ok'])
+        self.assertEqual(plain['encryption'], 'none')
+        self.assertNotIn('rounds', plain)
+        self.assertFalse(other['ok'])
+
+
+class StatsTest(unittest.TestCase):
+    def test_nested(self):
+        calls = []
+        stats = Stats(observer=lambda *args: calls.append(args[0]))
+        with stats.timed('outer'):
+            time.sleep(0.02)
+            with stats.timed('inner', 3, 5):
+                time.sleep(0.05)
+        self.assertEqual(calls, ['inner', 'outer'])
+        self.assertEqual(stats['inner']['bytes_in'], 3)
+        self.assertEqual(stats['inner']['bytes_out'], 5)
+        # the inner time is not counted for outer
+        self.assertGreaterEqual(stats['inner']['seconds'], 0.05)
+        self.assertLess(stats['outer']['seconds'], 0.05)
+
+    def test_unpack(self):
+        tmp = make_tmpdir(self)
+
+        stats = Stats()
+        with AndroidBackup(io.BytesIO(TEST_DATA_ENC_TEST), password='test', stats=stats) as ab:
+            ab.unpack(target_dir=tmp, manifest_fname=os.path.join(tmp, 'backup.manifest'))
+        for stage in ('read', 'key_derivation', 'decrypt', 'inflate', 'tar', 'write'):
+            self.assertIn(stage, stats)
+        self.assertEqual(stats['inflate']['bytes_in'], stats['decrypt']['bytes_out'])
+        self.assertEqual(stats['write']['calls'], len(TEST_MEMBERS_NAMES))
+        self.assertEqual(stats['write']['bytes_in'], sum(member.size for member in TEST_MEMBERS))
+        self.assertIn('key_derivation', stats.report())
+
+
+class SpliceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = make_tmpdir(self)
+        # uncompressed, unencrypted backup in a real file
+        self.fname = os.path.join(self.tmp, 'backup.ab')
+        with AndroidBackup(io.BytesIO(TEST_DATA_NONENC)) as ab:
+            with open(self.fname, 'wb') as fp:
+                fp.write(b'ANDROID BACKUP\n3\n0\nnone\n')
+                tar = ab.read_data()
+                for member in tar:
+                    fp.write(member.tobuf(tarfile.GNU_FORMAT))
+                    if member.isreg():
+                        data = tar.extractfile(member).read()
+                        fp.write(data + b'\0' * (-len(data) % tarfile.BLOCKSIZE))
+                fp.write(b'\0' * 2 * tarfile.RECORDSIZE)
+
+    def unpack(self, name, source, **kwargs):
+        target_dir = os.path.join(self.tmp, name)
+        manifest_fname = target_dir + '.manifest'
+        with AndroidBackup(source) as ab:
+            ab.unpack(target_dir=target_dir, manifest_fname=manifest_fname, **kwargs)
+        return target_dir, list(iter_manifest(manifest_fname))
+
+    def check(self, name):
+        with open(self.fname, 'rb') as fp:
+            # not backed by a file, read through tarfile
+            expected_dir, expected = self.unpack('expected', io.BytesIO(fp.read()))
+        target_dir, members = self.unpack(name, self.fname)
+        self.assertListEqual([member.name for member in members], TEST_MEMBERS_NAMES)
+        for member, other in zip(members, expected):
+            self.assertEqual(member.offset_data, other.offset_data)
+            if member.isreg():
+                self.assertIsNone(member.sha256)
+                path = os.path.join(target_dir, member.name)
+                with open(path, 'rb') as fp, open(os.path.join(expected_dir, member.name), 'rb') as other_fp:
+                    self.assertEqual(fp.read(), other_fp.read())
+                self.assertEqual(os.stat(path).st_mtime, member.mtime)
+        return target_dir
+
+    def test_unpack(self):
+        self.check('unpacked')
+
+    def test_fallback(self):
+        module = android_backup.android_backup
+        self.addCleanup(setattr, module, '_SPLICE_FUNCS', module._SPLICE_FUNCS)
+        module._SPLICE_FUNCS = module._SPLICE_FUNCS[-1:]
+        self.check('fallback')
+
+    def test_fallback_per_call(self):
+        module = android_backup.android_backup
+        self.addCleanup(setattr, module, '_SPLICE_FUNCS', module._SPLICE_FUNCS)
+
+        def failing(code):
+            def func(src, offset, dst, count):
+                raise OSError(code, os.strerror(code))
+            return func
+
+        with tempfile.TemporaryFile() as src, tempfile.TemporaryFile() as dst:
+            src.write(b'data' * 1000)
+            src.flush()
+            # unsupported files: the next function is used, the failing one kept
+            unsupported = failing(errno.EXDEV)
+            module._SPLICE_FUNCS = (unsupported, module._pread_write)
+            module._splice(src.fileno(), 4, dst.fileno(), 3996)
+            self.assertIn(unsupported, module._SPLICE_FUNCS)
+            # missing in the kernel: removed
+            missing = failing(errno.ENOSYS)
+            module._SPLICE_FUNCS = (missing, module._pread_write)
+            module._splice(src.fileno(), 0, dst.fileno(), 4)
+            self.assertNotIn(missing, module._SPLICE_FUNCS)
+            dst.seek(0)
+            self.assertEqual(dst.read(), b'data' * 1000)
+
+    def test_pack(self):
+        source_dir = self.check('unpacked')
+        tar_fname = os.path.join(self.tmp, 'backup.tar')
+        with AndroidBackup(io.BytesIO(TEST_DATA_NONENC)) as ab:
+            ab.unpack(target_dir=os.path.join(self.tmp, 'cached'), tar_fname=tar_fname,
+                      manifest_fname=os.path.join(self.tmp, 'cached.manifest'))
+
+        ab = new_backup(CompressionType.NONE)
+        for manifest, base in (('unpacked.manifest', None), ('cached.manifest', tar_fname)):
+            out = os.path.join(self.tmp, 'packed.ab')
+            ab.pack(out, source_dir=source_dir, tar_fname=base,
+                    manifest_fname=os.path.join(self.tmp, manifest))
+            with AndroidBackup(out) as packed:
+                tar = packed.read_data()
+                for member in tar:
+                    if member.isreg():
+                        with open(os.path.join(source_dir, member.name), 'rb') as fp:
+                            self.assertEqual(tar.extractfile(member).read(), fp.read())
+
+
+class StoreTest(unittest.TestCase):
+    def test_dedup(self):
+        tmp = make_tmpdir(self)
+        store = ObjectStore(os.path.join(tmp, 'store'), link='hardlink', spool_size=1000)
+
+        regular = [member for member in TEST_MEMBERS if member.isreg()]
+        trees = []
+        for day in ('day1', 'day2'):
+            target_dir = os.path.join(tmp, day)
+            manifest_fname = target_dir + '.manifest'
+            with AndroidBackup(io.BytesIO(TEST_DATA_NONENC)) as ab:
+                ab.unpack(target_dir=target_dir, manifest_fname=manifest_fname, store=store)
+            members = [member for member in iter_manifest(manifest_fname) if member.isreg()]
+            self.assertListEqual([member.name for member in members],
+                                 [member.name for member in regular])
+            for member in members:
+                path = os.path.join(target_dir, member.name)
+                with open(path, 'rb') as fp:
+                    self.assertEqual(member.sha256, hashlib.sha256(fp.read()).hexdigest())
+                self.assertTrue(os.path.samefile(path, store.object_path(member.sha256)))
+            trees.append(target_dir)
+
+        size = sum(member.size for member in regular)
+        unique = set(member.sha256 for member in members)
+        self.assertEqual(store.stored_bytes + store.reused_bytes, 2 * size)
+        self.assertGreaterEqual(store.reused_bytes, size)
+        self.assertEqual(len(os.listdir(os.path.join(tmp, 'store', 'tmp'))), 0)
+        self.assertEqual(sum(len(files) for _, _, files in
+                             os.walk(os.path.join(tmp, 'store', 'objects'))), len(unique))
+
+        # a materialized tree can be repacked
+        ab = new_backup()
+        out = os.path.join(tmp, 'backup.ab')
+        self.assertListEqual(ab.pack(out, source_dir=trees[0],
+                                     manifest_fname=trees[0] + '.manifest'), [])
+        with AndroidBackup(out) as repacked:
+            self.assertListEqual([member.name for member in repacked.get_files()],
+                                 TEST_MEMBERS_NAMES)
+
+        with self.assertRaises(ValueError):
+            ObjectStore(os.path.join(tmp, 'store'), link='symlink')
+
+
+class ConvertTest(unittest.TestCase):
+    def test_roundtrip(self):
+        for compression in (None, 'gz', 'xz', 'bz2'):
+            tar = io.BytesIO()
+            with AndroidBackup(io.BytesIO(TEST_DATA_ENC_TEST), password='test') as ab:
+                ab_to_tar(ab, tar, compression)
+            tar.seek(0)
+            with tarfile.open(fileobj=tar, mode='r:*') as plain:
+                self.assertListEqual(plain.getnames(), TEST_MEMBERS_NAMES)
+            tar.seek(0)
+
+            out = io.BytesIO()
+            count = tar_to_ab(tar, out, encryption=EncryptionType.AES256, password='other')
+            self.assertEqual(count, len(TEST_MEMBERS_NAMES))
+            out.seek(0)
+            with AndroidBackup(out, password='other') as ab, \
+                    AndroidBackup(io.BytesIO(TEST_DATA_ENC_TEST), password='test') as orig:
+                converted = ab.read_data()
+                expected = orig.read_data()
+                for member, other in zip(converted, expected):
+                    self.assertEqual(member.name, other.name)
+                    self.assertEqual(member.mtime, other.mtime)
+                    if member.isreg():
+                        self.assertEqual(converted.extractfile(member).read(),
+                                         expected.extractfile(other).read())
+
+
+class RekeyTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = make_tmpdir(self)
+
+    def check(self, fname, password):
+        with AndroidBackup(fname, password=password) as ab:
+            self.assertEqual(ab.encryption, EncryptionType.AES256)
+            self.assertListEqual([member.name for member in ab.get_files()], TEST_MEMBERS_NAMES)
+
+    def test_rekey(self):
+        fname = os.path.join(self.tmp, 'backup.ab')
+        with open(fname, 'wb') as fp:
+            fp.write(TEST_DATA_ENC_TEST)
+        out = os.path.join(self.tmp, 'rekeyed.ab')
+        with AndroidBackup(fname) as ab:
+            ab.rekey(out, 'new', password='test', rounds=1000)
+        self.check(out, 'new')
+        self.assertEqual(probe(out)['rounds'], 1000)
+        # the encrypted data is unchanged
+        with open(out, 'rb') as fp:
+            self.assertTrue(TEST_DATA_ENC_TEST.endswith(fp.read()[-1024:]))
+
+    def test_encode_utf8(self):
+        # Java maps each byte to a (sign extended) char, backslashes included
+        self.assertEqual(AndroidBackup.encode_utf8(b'\\u12\x80A'),
+                         '\\u12\uff80A'.encode('utf-8'))
+
+    def test_encrypt(self):
+        out = os.path.join(self.tmp, 'encrypted.ab')
+        with AndroidBackup(io.BytesIO(TEST_DATA_NONENC)) as ab:
+            ab.encrypt(out, password='new', rounds=1000)
+        self.check(out, 'new')
+        self.assertEqual(probe(out)['rounds'], 1000)
+
+
+class VerifyTest(unittest.TestCase):
+    def check(self, data, error, password='test'):
+        result = verify(io.BytesIO(data), password=password)
+        self.assertFalse(result['ok'])
+        self.assertIn(error, result['error'])
+        self.assertIsNotNone(result['offset'])
+        return result
+
+    def test_valid(self):
+        for data in (TEST_DATA_NONENC, TEST_DATA_ENC_TEST):
+            result = verify(io.BytesIO(data), password='test')
+            self.assertTrue(result['ok'], result['error'])
+            self.assertEqual(result['members'], len(TEST_MEMBERS_NAMES))
+            self.assertEqual(result['bytes'], sum(member.size for member in TEST_MEMBERS))
+
+    def test_errors(self):
+        self.check(TEST_DATA_ENC_TEST, 'PasswordError', password='wrong')
+        self.check(TEST_DATA_NONENC[:-10], 'truncated')
+        corrupt = bytearray(TEST_DATA_NONENC)
+        # Adler-32
+        corrupt[-2] ^= 1
+        self.check(bytes(corrupt), 'incorrect data check')
+        corrupt = bytearray(TEST_DATA_ENC_TEST)
+        corrupt[-3] ^= 1
+        self.check(bytes(corrupt), 'Invalid padding')
+
+    def test_tar_header(self):
+        tar = io.BytesIO()
+        with AndroidBackup(io.BytesIO(TEST_DATA_NONENC)) as ab:
+            ab_to_tar(ab, tar)
+        data = bytearray(tar.getvalue())
+        offset = TEST_MEMBERS[2].offset
+        # a corrupt name, tarfile would stop at this member
+        data[offset] ^= 1
+        result = self.check(b'ANDROID BACKUP\n3\n0\nnone\n' + bytes(data), 'checksum')
+        self.assertEqual(result['tar_offset'], offset)
+        self.assertEqual(result['members'], 2)
+
+        # truncated member data
+        result = self.check(b'ANDROID BACKUP\n3\n0\nnone\n' + tar.getvalue()[:offset - 100],
+                            'truncated')
+        self.assertEqual(result['member'], TEST_MEMBERS[1].name)
+
+    def test_offset(self):
+        # fixed keys, salts and IVs, the backups are the same on every run
+        rnd = random.Random(0)
+        module = android_backup.android_backup
+        self.addCleanup(setattr, module, '_random_bytes', module._random_bytes)
+        module._random_bytes = lambda n: bytes(rnd.getrandbits(8) for _ in range(n))
+
+        tmp = make_tmpdir(self)
+        fname = os.path.join(tmp, 'backup.ab')
+
+        # flips the byte at pos(members) of the encrypted data, which garbles
+        # its block, expects the error at expected(members)
+        def check(compression, pos, expected):
+            generate(fname, members=100, min_size=1000, max_size=64 * 1024,
+                     compression=compression, encryption=EncryptionType.AES256,
+                     password='test')
+            with AndroidBackup(fname, password='test', stream=False) as ab:
+                members = ab.get_files()
+            with open(fname, 'rb') as fp:
+                data = bytearray(fp.read())
+            # the encrypted data follows the header and encryption lines
+            start = 0
+            for _ in range(9):
+                start = data.index(b'\n', start) + 1
+            data[start + pos(members)] ^= 0x55
+            with open(fname, 'wb') as fp:
+                fp.write(data)
+
+            # the first pass decodes far ahead of the tar check
+            for threaded in (False, True):
+                result = verify(fname, password='test', chunk_size=256 * 1024,
+                                threaded=threaded)
+                self.assertFalse(result['ok'])
+                self.assertEqual(result['offset'], start + expected(members))
+
+        # a tar header in the middle (uncompressed), detected at its start
+        check(CompressionType.NONE, lambda members: members[50].offset + 20,
+              lambda members: members[50].offset)
+        # the zlib header, detected at its second byte
+        check(CompressionType.ZLIB, lambda members: 0, lambda members: 1)
+
+
+class IndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = make_tmpdir(self)
+        self.source_dir = os.path.join(self.tmp, 'unpacked')
+        self.pickle_fname = os.path.join(self.tmp, 'backup.pickle')
+
+        # compressible but not trivial content
+        members = []
+        for i in range(8):
+            member = tarfile.TarInfo('apps/com.example/f/file{}'.format(i))
+            data = b''.join(b'%d:%d ' % (i, j * j) for j in range(20000))
+            member.size = len(data)
+            path = os.path.join(self.source_dir, member.name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as fp:
+                fp.write(data)
+            members.append(member)
+        with open(self.pickle_fname, 'wb') as fp:
+            pickle.dump(members, fp)
+        self.names = [member.name for member in members]
+
+    def check(self, compression, encryption, password=None):
+        fname = os.path.join(self.tmp, 'backup.ab')
+        ab = new_backup(compression, encryption)
+        ab.SYNC_FLUSH_INTERVAL = 64 * 1024
+        ab.pack(fname, source_dir=self.source_dir, password=password,
+                pickle_fname=self.pickle_fname)
+
+        with AndroidBackup(fname, password=password) as ab:
+            index = BackupIndex.build(ab, interval=128 * 1024)
+            index.save(fname + '.abidx')
+            self.assertListEqual(index.getnames(), self.names)
+            if compression == CompressionType.ZLIB:
+                self.assertGreater(len(index.checkpoints), 0)
+
+        with AndroidBackup(fname, password=password) as ab:
+            for name in reversed(self.names):
+                with open(os.path.join(self.source_dir, name), 'rb') as fp:
+                    self.assertEqual(ab.open_member(name).read(), fp.read())
+
+    def test_index_plain(self):
+        self.check(CompressionType.NONE, EncryptionType.NONE)
+
+    def test_index_compressed(self):
+        self.check(CompressionType.ZLIB, EncryptionType.NONE)
+
+    def test_index_encrypted(self):
+        self.check(CompressionType.ZLIB, EncryptionType.AES256, password='test')
+
+    def test_index_foreign(self):
+        # backups without sync flushes can be indexed too (without checkpoints)
+        fname = os.path.join(self.tmp, 'backup.ab')
+        with open(fname, 'wb') as fp:
+            fp.write(TEST_DATA_ENC_TEST)
+        with AndroidBackup(fname, password='test') as ab:
+            index = ab.build_index()
+            self.assertListEqual(index.getnames(), TEST_MEMBERS_NAMES)
+            self.assertEqual(len(index.checkpoints), 0)
+        with AndroidBackup(fname, password='test', stream=False) as ab:
+            name = 'apps/eu.bluec0re.android-backup/r/settings.cfg'
+            self.assertEqual(ab.open_member(name).read(),
+                             ab.read_data().extractfile(name).read())
+
+    def test_index_stream(self):
+        # file objects without a name need an explicit index file
+        with AndroidBackup(io.BytesIO(TEST_DATA_ENC_TEST), password='test') as ab:
+            with self.assertRaises(ValueError):
+                ab.build_index()
+            index_fname = os.path.join(self.tmp, 'stream.abidx')
+            self.assertListEqual(ab.build_index(index_fname).getnames(), TEST_MEMBERS_NAMES)
+            self.assertTrue(os.path.exists(index_fname))
+
+    def test_marker_across_chunks(self):
+        compressor = zlib.compressobj()
+        data = compressor.compress(b''.join(b'%d ' % (j * j) for j in range(20000)))
+        data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        marker = len(data)
+        data += compressor.compress(b'x' * 100000) + compressor.flush()
+
+        def checkpoints(split):
+            inflater = _CheckpointInflater(interval=1)
+            for chunk in (data[:1000], data[1000:split], data[split:]):
+                inflater.decompress(chunk)
+            return [checkpoint[:2] for checkpoint in inflater.checkpoints]
+
+        expected = checkpoints(marker)
+        self.assertEqual(expected[0][0], marker)
+        # the marker ends 2 bytes into the third chunk
+        self.assertEqual(checkpoints(marker - 2), expected)
+
+
+class KeyCacheTest(unittest.TestCase):
+    def setUp(self):
+        # count the key derivations
+        self.derivations = 0
+        pbkdf2 = android_backup.android_backup._pbkdf2
+
+        def counting_pbkdf2(*args, **kwargs):
+            self.derivations += 1
+            return pbkdf2(*args, **kwargs)
+
+        android_backup.android_backup._pbkdf2 = counting_pbkdf2
+        self.addCleanup(setattr, android_backup.android_backup, '_pbkdf2', pbkdf2)
+
+    def open(self, cache, password='test'):
+        with AndroidBackup(io.BytesIO(TEST_DATA_ENC_TEST), password=password,
+                           key_cache=cache) as ab:
+            return [member.name for member in ab.get_files()]
+
+    def test_memory(self):
+        cache = KeyCache()
+        self.assertListEqual(self.open(cache), TEST_MEMBERS_NAMES)
+        self.assertEqual(self.derivations, 2)
+        self.assertListEqual(self.open(cache), TEST_MEMBERS_NAMES)
+        self.assertEqual(self.derivations, 2)
+
+        # a different password is not served from the cache
+        with self.assertRaises(Exception):
+            self.open(cache, password='wrong')
+        self.assertGreater(self.derivations, 2)
+
+    def test_disk(self):
+        tmp = make_tmpdir(self)
+        path = os.path.join(tmp, 'keys')
+
+        self.open(KeyCache(path=path))
+        self.assertEqual(self.derivations, 2)
+        for name in os.listdir(path):
+            self.assertEqual(os.stat(os.path.join(path, name)).st_mode & 0o077, 0)
+
+        self.assertListEqual(self.open(KeyCache(path=path)), TEST_MEMBERS_NAMES)
+        self.assertEqual(self.derivations, 2)
+
+    def test_disk_permissions(self):
+        tmp = make_tmpdir(self)
+        path = os.path.join(tmp, 'keys')
+
+        self.open(KeyCache(path=path))
+        os.chmod(path, 0o755)
+        for name in os.listdir(path):
+            os.chmod(os.path.join(path, name), 0o644)
+
+        # an existing directory readable by others is restricted again
+        self.assertListEqual(self.open(KeyCache(path=path)), TEST_MEMBERS_NAMES)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+        for name in os.listdir(path):
+            self.assertEqual(os.stat(os.path.join(path, name)).st_mode & 0o777, 0o600)
+
+    @unittest.skipUnless(hasattr(os, 'geteuid') and os.geteuid() == 0, 'requires root')
+    def test_disk_foreign_owner(self):
+        tmp = make_tmpdir(self)
+        path = os.path.join(tmp, 'keys')
+        os.makedirs(path, 0o700)
+        os.chown(path, 12345, 12345)
+        with self.assertRaises(PermissionError):
+            KeyCache(path=path)
+
+    def test_lru(self):
+        cache = KeyCache(max_entries=2)
+        for i in range(3):
+            cache.put('pw', b'salt%d' % i, 10000, b'blob', b'key', b'iv')
+        self.assertIsNone(cache.get('pw', b'salt0', 10000, b'blob'))
+        self.assertEqual(cache.get('pw', b'salt2', 10000, b'blob'), (b'key', b'iv'))
+
+
+class CryptoTest(unittest.TestCase):
+    def setUp(self):
+        self.backends = crypto.available()
+        self.addCleanup(setattr, crypto, '_backend', crypto._backend)
+
+    def test_backends(self):
+        expected = hashlib.pbkdf2_hmac('sha1', b'test', b'salt', 100, 32)
+        key, iv, data = b'k' * 32, b'i' * 16, os.urandom(4096)
+        ciphers = [backend for backend in self.backends if backend.has_cipher]
+        for backend in self.backends:
+            self.assertEqual(backend.pbkdf2('test', b'salt', 100), expected)
+            if not backend.has_cipher:
+                continue
+            # consecutive calls continue the chain
+            cipher = backend.aes_cbc(key, iv)
+            encrypted = cipher.encrypt(data[:1024]) + cipher.encrypt(data[1024:])
+            for other in ciphers:
+                self.assertEqual(other.aes_cbc(key, iv).decrypt(encrypted), data)
+
+    def test_select(self):
+        for backend in self.backends:
+            selected = crypto.select(backend.name)
+            self.assertTrue(selected.has_cipher)
+            with AndroidBackup(io.BytesIO(TEST_DATA_ENC_TEST), password='test') as ab:
+                self.assertListEqual([member.name for member in ab.get_files()],
+                                     TEST_MEMBERS_NAMES)
+        self.assertEqual(crypto.select().name, crypto.automatic().name)
+
+    def test_benchmark(self):
+        report = crypto_benchmark.run(rounds=10, chunk_sizes=(1024,), total=4096, repeat=1)
+        self.assertEqual(len(report['results']), len(self.backends))
+        for result in report['results']:
+            self.assertGreater(result['pbkdf2_seconds'], 0)
+
+
+class ShortReadPipe(io.BytesIO):
+    """
+    Non-seekable stream which returns at most 7 bytes per read
+    """
+    def read(self, n=-1):
+        if n is None or n < 0 or n > 7:
+            n = 7
+        return super(ShortReadPipe, self).read(n)
+
+    def seekable(self):
+        return False
+
+    def seek(self, *args):
+        raise io.UnsupportedOperation('seek')
+
+    def tell(self):
+        raise io.UnsupportedOperation('tell')
+
+
+class ProxyTest(unittest.TestCase):
+    def test_read(self):
+        proxy = Proxy(lambda data: data.upper(), io.BytesIO(b'abcdefghij' * 10), 7)
+        self.assertEqual(proxy.read(3), b'ABC')
+        self.assertEqual(proxy.read(12), b'DEFGHIJABCDE')
+        self.assertEqual(len(proxy.read()), 85)
+        self.assertEqual(proxy.read(3), b'')
+        self.assertEqual(proxy.tell(), 100)
+
+    def test_readinto(self):
+        proxy = Proxy(lambda data: data.upper(), io.BytesIO(b'abcdefghij' * 10), 7)
+        buf = bytearray(13)
+        self.assertEqual(proxy.readinto(buf), 13)
+        self.assertEqual(buf, b'ABCDEFGHIJABC')
+        self.assertEqual(proxy.read(2), b'DE')
+        buf = bytearray(200)
+        self.assertEqual(proxy.readinto(buf), 85)
+        self.assertEqual(proxy.readinto(buf), 0)
+
 
 TEST_MEMBERS = pickle.loads(base64.b64decode("""
 gAJdcQAoY3RhcmZpbGUKVGFySW5mbwpxASmBcQJOfXEDKFgEAAAAbmFtZXEEWCkAAABhcHBzL2V1
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 # License: Apache-2.0
 import argparse
-from android_backup import AndroidBackup
+import android_backup
 import os
 import sys
 
@@ -40,21 +40,71 @@ def main():
     parser.add_argument('-l', '--list', action='store_true')
     parser.add_argument('-p', '--password')
     parser.add_argument('-t', '--target-dir')
-    parser.add_argument('IN', type=AndroidBackup)
+    parser.add_argument('-j', '--workers', type=int,
+                        help='number of threads writing the extracted files')
+    parser.add_argument('--tar', metavar='FILE',
+                        help='keep the uncompressed tar data in FILE for faster repacking')
+    parser.add_argument('--package', action='append', dest='packages', metavar='PKG',
+                        help='only the members of this package (repeatable)')
+    parser.add_argument('--domain', action='append', dest='domains', metavar='DOMAIN',
+                        help='only the members of this domain, e.g. db, sp, f (repeatable)')
+    parser.add_argument('--include', action='append', metavar='GLOB',
+                        help='only the members matching this pattern (repeatable)')
+    parser.add_argument('--exclude', action='append', metavar='GLOB',
+                        help='skip the members matching this pattern (repeatable)')
+    parser.add_argument('--early-exit', action='store_true',
+                        help='stop reading after the members of the selected packages')
+    parser.add_argument('--store', metavar='DIR',
+                        help='store the file contents once in this directory, shared by backups, '
+                             'and link the unpacked files to it')
+    parser.add_argument('--link', choices=['auto', 'reflink', 'hardlink', 'copy'], default='auto',
+                        help='how files are linked to the store (default: reflinks if supported, '
+                             'else hardlinks)')
+    parser.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'],
+                        help='print the bytes and time per processing stage to stderr')
+    parser.add_argument('IN')
 
     args = parser.parse_args()
+    if args.early_exit and not args.packages:
+        parser.error('--early-exit requires --package')
 
-    with args.IN as infile:
+    member_filter = None
+    if args.packages or args.domains or args.include or args.exclude:
+        member_filter = android_backup.MemberFilter(
+            packages=args.packages, domains=args.domains, include=args.include,
+            exclude=args.exclude, early_exit=args.early_exit)
+
+    store = None
+    if args.store:
+        store = android_backup.ObjectStore(args.store, link=args.link)
+
+    stats = None
+    if args.stats:
+        stats = android_backup.Stats()
+
+    with android_backup.AndroidBackup(args.IN, stats=stats) as infile:
         if args.list:
             infile.list(
-                password=args.password
+                password=args.password,
+                member_filter=member_filter
                 )
         else:
             infile.unpack(
                 target_dir=args.target_dir,
-                password=args.password
+                password=args.password,
+                workers=args.workers,
+                tar_fname=args.tar,
+                member_filter=member_filter,
+                store=store
                 )
 
+    if store is not None and not args.list:
+        print('store: {} bytes added, {} bytes already stored'.format(
+            store.stored_bytes, store.reused_bytes), file=sys.stderr)
+
+    if stats is not None:
+        print(stats.report() if args.stats == 'text' else stats.to_json(), file=sys.stderr)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# License: Apache-2.0
+"""
+Integrity check of backups, decoding everything without writing files
+
+    $ android-backup-verify -P 8 --password-file passwords.json backups/
+"""
+import argparse
+import json
+import sys
+import tarfile
+import time
+import zlib
+
+from .android_backup import AndroidBackup, BackupError, CompressionType, _CBCDecryptor
+
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+
+# bytes decoded at once when locating an error
+PIECE_SIZE = 16 * 1024
+
+# header types whose data describes the next member
+_EXTENDED_TYPES = (tarfile.XHDTYPE, tarfile.XGLTYPE,
+                   tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK)
+
+
+def _padded(size):
+    return -(-size // BLOCKSIZE) * BLOCKSIZE
+
+
+def _pax_size(data):
+    """
+    :returns: the size record of a pax extended header, None if it has none
+    """
+    size = None
+    pos = 0
+    while pos < len(data) and data[pos:pos + 1] != b'\0':
+        length = int(data[pos:data.index(b' ', pos)])
+        if length <= 0:
+            raise ValueError("Invalid record length")
+        keyword, _, value = data[pos:pos + length].partition(b' ')[2].partition(b'=')
+        if keyword == b'size':
+            size = int(value)
+        pos += length
+    return size
+
+
+class _TarChecker:
+    """
+    Walks the tar headers of the decoded data instead of tarfile, which
+    takes a corrupt header after the first one for the end of the archive.
+    Checks the checksum of each header, reads the data of each member
+    completely and expects the end-of-archive marker.
+    """
+    def __init__(self, fp, chunk_size=1024 * 1024):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        # tar offset of the header being checked and its member name
+        self.offset = 0
+        self.member = None
+        # number of decoded bytes read
+        self.pos = 0
+        self.members = 0
+        self.bytes = 0
+        # position in the tar data of an error found by the checker (not
+        # by the decoding)
+        self.error_pos = None
+
+    def _error(self, message, pos=None):
+        self.error_pos = self.pos if pos is None else pos
+        return BackupError(message)
+
+    def _read(self, n):
+        data = self.fp.read(n)
+        self.pos += len(data)
+        if len(data) != n:
+            raise self._error("Unexpected end of the tar data")
+        return data
+
+    def _skip(self, n):
+        while n:
+            data = self.fp.read(min(n, self.chunk_size))
+            if not data:
+                raise self._error("Data of {!r} is truncated".format(self.member))
+            self.pos += len(data)
+            n -= len(data)
+
+    def run(self):
+        # size record of a pax header applying to the next member
+        size = None
+        while True:
+            self.offset = self.pos
+            block = self.fp.read(BLOCKSIZE)
+            self.pos += len(block)
+            if not block:
+                raise self._error("End-of-archive marker is missing")
+            if len(block) != BLOCKSIZE:
+                raise self._error("Tar header is truncated")
+            if block == tarfile.NUL * BLOCKSIZE:
+                if self._read(BLOCKSIZE) != tarfile.NUL * BLOCKSIZE:
+                    raise self._error("Invalid end-of-archive marker", self.offset + BLOCKSIZE)
+                break
+
+            try:
+                info = tarfile.TarInfo.frombuf(block, tarfile.ENCODING, 'surrogateescape')
+            except tarfile.HeaderError as e:
+                raise self._error("Invalid tar header: {}".format(e), self.offset)
+
+            if info.type in _EXTENDED_TYPES:
+                data = self._read(_padded(info.size))
+                if info.type == tarfile.XHDTYPE:
+                    try:
+                        size = _pax_size(data[:info.size])
+                    except ValueError:
+                        raise self._error("Invalid pax header", self.offset)
+                continue
+
+            self.member = info.name
+            if size is not None:
+                info.size = size
+                size = None
+            if info.isreg() or info.type not in tarfile.SUPPORTED_TYPES:
+                self._skip(_padded(info.size))
+                self.bytes += info.size
+            self.members += 1
+
+        # the decoder checks padding, length and checksum at the end
+        self.offset = self.pos
+        self.member = None
+        while self.fp.read(self.chunk_size):
+            pass
+
+
+def _replay(decompressor, data, limit=None):
+    """
+    Feeds data byte by byte to a decompressor
+
+    :returns: the index of the byte at which it fails or produces more
+              than limit bytes in total (len(data) if neither happens)
+    """
+    out = 0
+    for i in range(len(data)):
+        try:
+            out += len(decompressor.decompress(data[i:i + 1]))
+        except zlib.error:
+            return i
+        if limit is not None and out > limit:
+            return i
+    return len(data)
+
+
+def _locate(ab, password=None, tar_pos=None):
+    """
+    Decodes the backup again, in small pieces and without threads, to find
+    where the first error is detected. The first pass decodes ahead of the
+    tar check in large chunks, so its read position says little.
+
+    :param ab: the parsed AndroidBackup (a seekable file)
+    :param tar_pos: the position in the tar data of an error found by the
+                    tar check, None if decrypting or inflating failed
+    :returns: the offset in the backup file of the byte at which the error
+              is detected, None if the file is not seekable
+    """
+    fp = ab.fp
+    seekable = getattr(fp, 'seekable', None)
+    if seekable is None or not seekable():
+        return None
+    fp.seek(ab.data_start)
+    decryptor = None
+    if ab.is_encrypted():
+        try:
+            decryptor = _CBCDecryptor(ab._cipher(fp, password))
+        except BackupError:
+            # the master key
+            return fp.tell()
+    start = fp.tell()
+    decompressor = None
+    if ab.compression == CompressionType.ZLIB:
+        decompressor = zlib.decompressobj()
+
+    # number of decrypted (i.e. compressed) and of tar bytes so far
+    pos = out = 0
+    while True:
+        piece = fp.read(PIECE_SIZE)
+        data = piece
+        if decryptor is not None:
+            try:
+                data = decryptor.decrypt(piece) if piece else decryptor.flush()
+            except BackupError:
+                # the padding of the last block (or an incomplete block)
+                return start + pos
+
+        if decompressor is None:
+            if tar_pos is not None and out + len(data) > tar_pos:
+                return start + tar_pos
+            out += len(data)
+        else:
+            saved = decompressor.copy()
+            try:
+                res = decompressor.decompress(data)
+            except zlib.error:
+                return start + pos + _replay(saved, data)
+            if tar_pos is not None and out + len(res) > tar_pos:
+                return start + pos + _replay(saved, data, tar_pos - out)
+            out += len(res)
+        pos += len(data)
+        if not piece:
+            # truncated data or tar, detected at its end
+            return start + pos
+
+
+def verify(fname, password=None, chunk_size=1024 * 1024, threaded=False, key_cache=None):
+    """
+    Decodes a backup completely without writing anything and checks the
+    master key checksum (i.e. the password), the padding of the encrypted
+    data, the end and Adler-32 of the compressed data, the checksum of each
+    tar header, that the data of each member is complete and the
+    end-of-archive marker.
+
+    :param fname: the backup file (or a file object)
+    :param password: the password of encrypted backups
+    :param threaded: decrypt and inflate in background threads
+    :param key_cache: optional KeyCache
+    :returns: dict with file, ok, error, members and bytes (checked so far),
+              seconds, and for errors offset (of the byte in the backup
+              file at which the error is detected, None for non-seekable
+              files), tar_offset (of the header of the member with the
+              error) and member (its name)
+    """
+    start = time.time()
+    result = {'file': fname, 'ok': False, 'error': None, 'members': 0, 'bytes': 0,
+              'offset': None, 'tar_offset': None, 'member': None}
+    checker = None
+    try:
+        with AndroidBackup(fname, password=password, chunk_size=chunk_size,
+                           threaded=threaded, key_cache=key_cache) as ab:
+            try:
+                checker = _TarChecker(ab.open_data(), chunk_size)
+                checker.run()
+            except Exception:
+                if ab.pipeline is not None:
+                    # stop the threads reading the file
+                    ab.pipeline.close()
+                    ab.pipeline = None
+                try:
+                    result['offset'] = _locate(ab, password, checker and checker.error_pos)
+                except Exception:
+                    pass
+                raise
+        result['ok'] = True
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        if checker is not None:
+            result['tar_offset'] = checker.offset
+            result['member'] = checker.member
+    if checker is not None:
+        result['members'] = checker.members
+        result['bytes'] = checker.bytes
+    result['seconds'] = time.time() - start
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Checks backups for corruption and wrong passwords')
+    parser.add_argument('INPUT', nargs='+', help='backup files or directories')
+    parser.add_argument('-p', '--password', help='password of all backups')
+    parser.add_argument('--password-file',
+                        help='JSON object mapping file names or glob patterns to passwords')
+    parser.add_argument('-P', '--processes', type=int,
+                        help='number of processes (default: number of CPUs)')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+
+    args = parser.parse_args()
+
+    from .batch import PasswordLookup, run_batch
+
+    password = args.password
+    if args.password_file:
+        password = PasswordLookup.load(args.password_file, args.password)
+
+    def report(result):
+        if args.json:
+            return
+        if result['ok']:
+            print('ok      {file}: {members} members, {bytes} bytes'.format(**result))
+        else:
+            print('FAILED  {file}: {error} (offset {offset}, tar offset {tar_offset}, '
+                  'member {member})'.format(**dict(
+                      {'offset': None, 'tar_offset': None, 'member': None}, **result)))
+        sys.stdout.flush()
+
+    results = run_batch(args.INPUT, action='verify', password=password,
+                        processes=args.processes, callback=report)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if not all(result['ok'] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,8 @@
 from setuptools import setup
-import sys
-
-deps = []
-if sys.version_info[:2] < (3,4):
-    deps.append('enum34')
 
 setup(
     name='android_backup',
-    version='0.2.0',
+    version='0.3.0',
     description='Unpack and repack android backups',
     url='https://github.com/bluec0re/android-backup-tools',
     author='BlueC0re',
@@ -20,16 +15,26 @@ setup(
 
         'License :: OSI Approved :: Apache Software License',
 
-        'Programming Language :: Python :: 2',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
-    packages=['android_backup'],
+    packages=['android_backup', 'android_backup.benchmarks'],
     keywords='android backup pack unpack development',
     entry_points={
         'console_scripts': [
             'android-backup-unpack=android_backup.unpack:main',
             'android-backup-pack=android_backup.pack:main',
+            'android-backup-batch=android_backup.batch:main',
+            'android-backup-probe=android_backup.probe:main',
+            'android-backup-convert=android_backup.convert:main',
+            'android-backup-rekey=android_backup.rekey:main',
+            'android-backup-verify=android_backup.verify:main',
         ],
     },
-    install_requires=deps,
+    python_requires='>=3.7',
 )